@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  bulk.py
+#
+import os
+import sys
+import json
+import time
+import multiprocessing
+from collections import deque
+from datetime import timedelta
+
+CHUNK = 256            # queries per batch handed to a worker
+PROGRESS_EVERY = 5.0   # seconds between progress lines
+CKPT_SUFFIX = '.ckpt'
+
+#==============================================================================
+def readChunks(f, first, size):
+    # yields (number of lines before the chunk, [lines], input offset after
+    # the chunk) reading f from where it is positioned
+    lines = []
+    pos = f.tell()
+    for raw in f:
+        pos += len(raw)
+        lines.append(raw.decode('utf-8'))
+        if len(lines) >= size:
+            yield first, lines, pos
+            first += len(lines)
+            lines = []
+    if lines:
+        yield first, lines, pos
+
+#==============================================================================
+def loadCheckpoint(path):
+    try:
+        with open(path, 'r') as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+#==============================================================================
+def saveCheckpoint(path, state):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        f.write(json.dumps(state))
+    os.replace(tmp, path)
+
+#==============================================================================
+class Progress:
+    # throughput since this run started; the ETA is taken from the share of
+    # the input bytes read, the number of queries is not known upfront
+    def __init__(self, size, offset, queries):
+        self._size = size
+        self._offset = offset
+        self._queries = queries
+        self._start = time.monotonic()
+        self._last = self._start
+
+    def update(self, offset, queries, force=False):
+        now = time.monotonic()
+        if not force and now - self._last < PROGRESS_EVERY:
+            return
+        self._last = now
+        elapsed = max(now - self._start, 1e-9)
+        rate = (queries - self._queries) / elapsed
+        byteRate = (offset - self._offset) / elapsed
+        done = 100.0 * offset / self._size if self._size else 100.0
+        eta = timedelta(seconds=int((self._size - offset) / byteRate)) if byteRate > 0 else '?'
+        print(f'BULK: {queries} QUERIES, {rate:.1f} q/s, {done:.1f}%, ELAPSED {timedelta(seconds=int(elapsed))}, ETA {eta}',
+              file=sys.stderr, flush=True)
+
+#==============================================================================
+def runBulk(inPath, outPath, run, workers=0, chunkSize=CHUNK, resume=False, initWorker=None):
+    # run(first, lines) -> [output line bytes] answers one chunk of input
+    # lines, in a pool of forked workers when workers > 0 (they inherit
+    # whatever the caller loaded). results are written in input order and
+    # after every chunk the output is synced and the checkpoint moved on, so
+    # an interrupted run resumes at the first chunk it had not written
+    st = os.stat(inPath)
+    ckptPath = outPath + CKPT_SUFFIX
+    state = {'input': os.path.abspath(inPath), 'size': st.st_size, 'mtime': st.st_mtime_ns,
+             'lines': 0, 'queries': 0, 'in_offset': 0, 'out_offset': 0, 'done': False}
+    if resume:
+        ck = loadCheckpoint(ckptPath)
+        if ck is None:
+            print(f'NO CHECKPOINT {ckptPath}, STARTING FROM THE BEGINNING', file=sys.stderr, flush=True)
+        elif (ck['input'], ck['size'], ck['mtime']) != (state['input'], state['size'], state['mtime']):
+            raise ValueError(f'{ckptPath} was written for another version of {inPath}')
+        else:
+            state = ck
+            print(f'RESUMING AFTER LINE {state["lines"]}, {state["queries"]} QUERIES DONE', file=sys.stderr, flush=True)
+    if state['done']:
+        print(f'{outPath} IS COMPLETE', file=sys.stderr, flush=True)
+        return 0
+
+    out = open(outPath, 'r+b' if state['out_offset'] else 'wb')
+    out.truncate(state['out_offset'])
+    out.seek(state['out_offset'])
+    inp = open(inPath, 'rb')
+    inp.seek(state['in_offset'])
+    progress = Progress(st.st_size, state['in_offset'], state['queries'])
+    pool = multiprocessing.get_context('fork').Pool(workers, initWorker) if workers > 0 else None
+    pending = deque()
+
+    def commit():
+        result, lines, end = pending.popleft()
+        if pool is not None:
+            result = result.get()
+        out.writelines(result)
+        out.flush()
+        os.fsync(out.fileno())
+        state.update(lines=state['lines'] + lines, queries=state['queries'] + len(result),
+                     in_offset=end, out_offset=out.tell())
+        saveCheckpoint(ckptPath, state)
+        progress.update(end, state['queries'])
+
+    try:
+        for first, lines, end in readChunks(inp, state['lines'], chunkSize):
+            result = pool.apply_async(run, (first, lines)) if pool is not None else run(first, lines)
+            pending.append((result, len(lines), end))
+            while len(pending) > 2 * workers: # keep every worker busy, no more
+                commit()
+        while pending:
+            commit()
+        state['done'] = True
+        saveCheckpoint(ckptPath, state)
+        progress.update(state['in_offset'], state['queries'], True)
+    except KeyboardInterrupt:
+        print(f'INTERRUPTED AFTER LINE {state["lines"]}, RUN AGAIN WITH -resume TO CONTINUE', file=sys.stderr, flush=True)
+        return 1
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        inp.close()
+        out.close()
+    return 0
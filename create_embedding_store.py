@@ -2,15 +2,23 @@
 
 import sys
 import os
+import io
 import numpy as np
 import hnswlib
 import json
 import fileinput
 import locale
 import faiss
+import time
+import queue
 import argparse
+import threading
+import multiprocessing
+from collections import deque
 # import pickle
 from datetime import datetime
+from bulk import readChunks, loadCheckpoint, saveCheckpoint
+from vector_cache import VectorCache
 from sentence_transformers import SentenceTransformer
 
 
@@ -25,43 +33,47 @@ parser.add_argument( '-faiss', action='store_const', const=True, default=False,
 parser.add_argument( '-s', action='store_const', const=True, default=False, dest='runSearch', help='run interactive search' )
 parser.add_argument( '-t', dest='idxType', type=str, default="l2", help='index type: l2, ivf, cosine, ip', metavar="SYMBOL" )
 parser.add_argument( '-i', dest='inFile', help='text file', required=True, metavar="FILE" )
-parser.add_argument( '-o', dest='outDir', help='output file', required=True, metavar="FILE" )
+parser.add_argument( '-o', dest='outDir', help='output file', metavar="FILE" )
+parser.add_argument( '-neighbours', action='store_const', const=True, default=False, dest='neighbours', help='precompute neighbours within -mat of every label' )
+parser.add_argument( '-mat', dest='mat', type=float, default=0.089, help='maximum acceptable distance for precomputed neighbours', metavar="FLOAT" )
+parser.add_argument( '-kmax', dest='kMax', type=int, default=200, help='most precomputed neighbours kept per label', metavar="INT" )
+parser.add_argument( '-chunk', dest='chunk', type=int, default=10000, help='lines encoded and inserted at a time', metavar="INT" )
+parser.add_argument( '-ckpt', dest='ckptEvery', type=float, default=300, help='seconds between checkpoints of the partial index', metavar="SEC" )
+parser.add_argument( '-resume', action='store_const', const=True, default=False, dest='resume', help='continue an interrupted build from its checkpoint' )
+parser.add_argument( '-cache', dest='cacheFile', help='embedding cache kept across builds, only texts not in it are encoded', metavar="FILE" )
+parser.add_argument( '-procs', dest='procs', type=int, default=0, help='encoder processes, each with its own model; 0 encodes in this process', metavar="INT" )
+parser.add_argument( '-threads', dest='threads', type=int, default=1, help='torch intra-op threads per encoder process', metavar="INT" )
+parser.add_argument( '-bench', dest='bench', help='encoder throughput for a comma separated list of -procs values, e.g. 0,1,2,4', metavar="LIST" )
+parser.add_argument( '-benchlines', dest='benchLines', type=int, default=20000, help='input lines encoded by -bench', metavar="INT" )
 
 locale.setlocale( locale.LC_ALL, '')
 
+MODEL_NAME = 'all-MiniLM-L6-v2'
 IVFTYPE = 'ivf'
 PQTYPE  = 'pq'
 NHSWTYPES = set(['l2', 'ip', 'cosine'])
 IDX_FILE = 'index.idx'
 IDX_INFO = 'index-info.json'
+NBR_FILE = 'neighbours.npz'
+NBR_BATCH = 4096
+CKPT_FILE = 'build.ckpt'
+PARTIAL_FILE = 'index.idx.partial'
+VEC_FILE = 'vectors.f32' # embeddings kept on disk for -neighbours
 
-def createNhswLibIndex(dim, sentence_embeddings, idxType, idxDir):
-    tp = 'l2'
-    if idxType in NHSWTYPES:
-        tp = idxType
-    sz = len(sentence_embeddings)
-    ids = np.arange(sz)
-    index = hnswlib.Index(space=tp, dim=dim)  # possible options are l2, cosine or ip
+def hnswType(idxType):
+    return idxType if idxType in NHSWTYPES else 'l2'
+
+def createNhswLibIndex(dim, idxType, size):
+    index = hnswlib.Index(space=hnswType(idxType), dim=dim)  # possible options are l2, cosine or ip
 
     # Initializing index - the maximum number of elements should be known beforehand
-    index.init_index(max_elements=sz, ef_construction=200, M=16)
+    index.init_index(max_elements=size, ef_construction=200, M=16)
     index.set_num_threads(8)
     print(f'DEFAULT NUMBER OF THREADS: {index.num_threads}')
-    # Element insertion (can be called several times):
-    print(f'SENTENCE EMBEDDINGS: {len(sentence_embeddings)}')
-    index.add_items(sentence_embeddings, ids)
-
-    # Controlling the recall by setting ef:
-    index.set_ef(50)  # ef should always be > k
-
-    idxOpts = {'dim': dim, 'threads':8, 'idxLib':'hnswlib', 'type': tp}
-    os.makedirs(name=idxDir, mode=0x1ED, exist_ok=True)
-    index.save_index(os.path.join(idxDir,IDX_FILE))
-    f = open(os.path.join(idxDir,IDX_INFO), 'w'); f.write(json.dumps(idxOpts)); f.close()
     return index
 
 #==============================================================================
-def createFaissIndex(dim, sentence_embeddings, idxType, idxDir ):
+def createFaissIndex(dim, idxType):
     print(f'\nCREATING FAISS index')
     nlist = dim // 300
     if nlist < 5:
@@ -77,19 +89,327 @@ def createFaissIndex(dim, sentence_embeddings, idxType, idxDir ):
     else:
         index = quantizer
 
-    index.nprobe = 20
+    if hasattr(index, 'nprobe'): # only the ivf indexes probe lists
+        index.nprobe = 20
+    return index
+
+#==============================================================================
+def addVectors(index, vecs, start, isFaiss):
+    # element insertion, called once per chunk; an untrained faiss index is
+    # trained on the first chunk it gets
+    if isFaiss:
+        if not index.is_trained:
+            print("Training FAISS...")
+            index.train(vecs)
+        index.add(vecs)
+    else:
+        index.add_items(vecs, np.arange(start, start + len(vecs)))
+
+#==============================================================================
+def saveIndex(index, path, isFaiss):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    if isFaiss:
+        faiss.write_index(index, tmp)
+    else:
+        index.save_index(tmp)
+    os.replace(tmp, path)
+
+#==============================================================================
+def loadPartialIndex(path, state, size):
+    if state['lib'] == 'faiss':
+        return faiss.read_index(path)
+    index = hnswlib.Index(space=hnswType(state['type']), dim=state['dim'])
+    index.load_index(path, max_elements=size)
+    index.set_num_threads(8)
+    return index
+
+#==============================================================================
+def writeIndexInfo(idxDir, dim, idxType, isFaiss):
+    if isFaiss:
+        idxOpts = {'dim': dim,  'idxLib':'faiss', 'type': idxType}
+    else:
+        idxOpts = {'dim': dim, 'threads':8, 'idxLib':'hnswlib', 'type': hnswType(idxType)}
+    f = open(os.path.join(idxDir,IDX_INFO), 'w'); f.write(json.dumps(idxOpts)); f.close()
+
+#==============================================================================
+def countLines(path):
+    # lines as readChunks splits them, to size the hnswlib index upfront
+    n = 0
+    last = b'\n'
+    with open(path, 'rb') as f:
+        while True:
+            b = f.read(16 * 1024 * 1024)
+            if not b:
+                break
+            n += b.count(b'\n')
+            last = b[-1:]
+    return n + (last != b'\n')
+
+#==============================================================================
+def recordText(line):
+    # the text loadRecords would give for the line: the key of a prefix row
+    line = line.rstrip('\r\n')
+    j, ok = txtToJson(line)
+    return j[0] if ok else line
+
+#==============================================================================
+ENCODER = None # the model of an encoder process
+
+def initEncoder(threads):
+    global ENCODER
+    import torch
+    torch.set_num_threads(threads)
+    ENCODER = SentenceTransformer(MODEL_NAME)
+
+def encodeTexts(texts, model=None):
+    return (ENCODER if model is None else model).encode(texts, normalize_embeddings=True)
+
+#==============================================================================
+class EncoderPool:
+    # procs processes, each loading its own model with torch pinned to the
+    # given intra-op threads. spawned rather than forked, torch's thread pools
+    # do not survive a fork. a chunk is always encoded whole by one process,
+    # so its vectors do not depend on how many processes there are
+    def __init__(self, procs, threads):
+        self.procs = procs
+        self._pool = multiprocessing.get_context('spawn').Pool(procs, initEncoder, (threads,))
+
+    def warm(self):
+        # a first round of empty tasks, so that model loading is not timed
+        self._pool.map(encodeTexts, [['']] * self.procs, chunksize=1)
+
+    def submit(self, texts):
+        return self._pool.apply_async(encodeTexts, (texts,))
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+#==============================================================================
+def encodeChunks(chunks, model, cache=None, pool=None):
+    # (first, lines, end) chunks in, (first, vectors, end) out in the same
+    # order. only the distinct texts of a chunk not in the cache are encoded,
+    # here or in the encoder pool with two chunks per process in flight
+    pending = deque()
+
+    def collect():
+        first, texts, end, X, missing, todo, job = pending.popleft()
+        if todo:
+            enc = job.get() if pool is not None else job
+            if X is None:
+                X = np.empty((len(texts), enc.shape[1]), dtype=np.float32)
+            encoded = dict(zip(todo, enc))
+            for i in missing:
+                X[i] = encoded[texts[i]]
+            if cache is not None:
+                cache.add(todo, enc)
+        return first, X, end
+
+    for first, lines, end in chunks:
+        texts = [recordText(l) for l in lines]
+        X, missing = cache.lookup(texts) if cache is not None else (None, range(len(texts)))
+        todo = list(dict.fromkeys(texts[i] for i in missing))
+        job = None
+        if todo:
+            job = pool.submit(todo) if pool is not None else encodeTexts(todo, model)
+        pending.append((first, texts, end, X, missing, todo, job))
+        while len(pending) > (2 * pool.procs if pool is not None else 0):
+            yield collect()
+    while pending:
+        yield collect()
 
-    if not index.is_trained:
-        print("Training FAISS...")
-        index.train(sentence_embeddings)
-    index.add(sentence_embeddings)
-    print(f'index total: {index.ntotal}')
+#==============================================================================
+def benchEncoders(model, opts):
+    # texts/s encoding the first opts.benchLines input lines with each -procs
+    # value, model loading excluded; the vectors are compared to the first run
+    with open(opts.inFile, 'rb') as f:
+        lines = [l for _, l in zip(range(opts.benchLines), f)]
+    chunk = max(1, opts.chunk)
+    base = None
+    for procs in [int(p) for p in opts.bench.split(',')]:
+        pool = EncoderPool(procs, opts.threads) if procs > 0 else None
+        try:
+            if pool is not None:
+                pool.warm()
+            start = time.monotonic()
+            X = [X for _, X, _ in encodeChunks(readChunks(io.BytesIO(b''.join(lines)), 0, chunk), model, None, pool)]
+            elapsed = max(time.monotonic() - start, 1e-9)
+        finally:
+            if pool is not None:
+                pool.close()
+        X = np.concatenate(X) if X else np.empty((0, 0), dtype=np.float32)
+        if base is None:
+            base = X
+        same = 'IDENTICAL' if np.array_equal(base, X) else f'MAX DIFFERENCE {np.abs(base - X).max():.3g}'
+        print(f'PROCS {procs} THREADS {opts.threads if procs else "default"}: {len(lines) / elapsed:.1f} texts/s, '
+              f'{len(lines)} IN {elapsed:.2f}s, VECTORS {same}', flush=True)
 
-    idxOpts = {'dim': dim,  'idxLib':'faiss', 'type': idxType}
+#==============================================================================
+def buildIndex(model, opts, cache=None):
+    # chunked build: chunk i + 1 is encoded while the insert thread adds
+    # chunk i, so at most three chunks of vectors are held at a time (plus
+    # two per process encoding them with -procs, in order all the same). every
+    # opts.ckptEvery seconds the partial index is saved with the input
+    # offset it covers; -resume reopens it and carries on from that offset
+    isFaiss = opts.createFaiss
+    idxDir = opts.outDir
     os.makedirs(name=idxDir, mode=0o755, exist_ok=True)
-    faiss.write_index(index, os.path.join(idxDir, IDX_FILE))
+    st = os.stat(opts.inFile)
+    ckptPath = os.path.join(idxDir, CKPT_FILE)
+    partialPath = os.path.join(idxDir, PARTIAL_FILE)
+    vecPath = os.path.join(idxDir, VEC_FILE)
+    state = {'input': os.path.abspath(opts.inFile), 'size': st.st_size, 'mtime': st.st_mtime_ns,
+             'lib': 'faiss' if isFaiss else 'hnswlib', 'type': opts.idxType, 'neighbours': opts.neighbours,
+             'dim': None, 'lines': 0, 'in_offset': 0}
+    total = countLines(opts.inFile)
+    index = None
+    if opts.resume:
+        ck = loadCheckpoint(ckptPath)
+        keys = ('input', 'size', 'mtime', 'lib', 'type', 'neighbours')
+        if ck is None:
+            print(f'NO CHECKPOINT {ckptPath}, STARTING FROM THE BEGINNING')
+        elif any(ck[k] != state[k] for k in keys):
+            raise ValueError(f'{ckptPath} was written for another input file or index type')
+        else:
+            state = ck
+            index = loadPartialIndex(partialPath, state, total)
+            print(f'RESUMING AFTER LINE {state["lines"]} OF {total}')
+    vecs = None
+    if opts.neighbours:
+        vecs = open(vecPath, 'r+b' if state['lines'] else 'wb')
+        vecs.truncate(state['lines'] * (state['dim'] or 0) * 4)
+        vecs.seek(0, os.SEEK_END)
+
+    chunks = queue.Queue(maxsize=1)
+    failed = []
+
+    def checkpoint(lines, offset):
+        saveIndex(index, partialPath, isFaiss)
+        if vecs is not None:
+            vecs.flush()
+            os.fsync(vecs.fileno())
+        state.update(lines=lines, in_offset=offset)
+        saveCheckpoint(ckptPath, state)
+
+    def insert():
+        last = time.monotonic()
+        started = last
+        done = state['lines']
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if failed:
+                continue # drain until the reader stops
+            first, X, end = item
+            try:
+                addVectors(index, X, first, isFaiss)
+                if vecs is not None:
+                    vecs.write(np.ascontiguousarray(X, dtype=np.float32).tobytes())
+                if time.monotonic() - last >= opts.ckptEvery:
+                    checkpoint(first + len(X), end)
+                    last = time.monotonic()
+            except Exception as e:
+                failed.append(e)
+                continue
+            rate = (first + len(X) - done) / max(time.monotonic() - started, 1e-9)
+            hits = f' cache hits: {100.0 * cache.stats()["hit_rate"]:.1f}%' if cache is not None else ''
+            sys.stderr.write(f'\rindexed: {first + len(X)}/{total} {rate:.0f}/s{hits}')
+
+    pool = EncoderPool(opts.procs, opts.threads) if opts.procs > 0 else None
+    t = threading.Thread(target=insert, name='index-insert')
+    t.start()
+    try:
+        with open(opts.inFile, 'rb') as f:
+            f.seek(state['in_offset'])
+            for first, X, end in encodeChunks(readChunks(f, state['lines'], max(1, opts.chunk)), model, cache, pool):
+                if index is None:
+                    state['dim'] = X.shape[1]
+                    index = createFaissIndex(X.shape[1], opts.idxType) if isFaiss else \
+                            createNhswLibIndex(X.shape[1], opts.idxType, total)
+                chunks.put((first, X, end))
+                if failed:
+                    break
+    finally:
+        if pool is not None:
+            pool.close()
+        chunks.put(None)
+        t.join()
+        sys.stderr.write('\n')
+    if failed:
+        raise failed[0]
+    if index is None:
+        raise ValueError(f'{opts.inFile} is empty')
+
+    if not isFaiss:
+        # Controlling the recall by setting ef:
+        index.set_ef(50)  # ef should always be > k
+    print(f'index total: {index.ntotal if isFaiss else index.get_current_count()}')
+    saveIndex(index, os.path.join(idxDir, IDX_FILE), isFaiss)
+    writeIndexInfo(idxDir, state['dim'], opts.idxType, isFaiss)
+    for path in (partialPath, ckptPath):
+        if os.path.exists(path):
+            os.remove(path)
+    if vecs is not None:
+        vecs.close()
+    return index, state['dim']
+
+#==============================================================================
+def selfSearch(index, xq, isFaiss, mat, kmax):
+    # neighbours within mat of every vector of xq, nearest first, at most kmax
+    total = index.ntotal if isFaiss else index.get_current_count()
+    limit = max(1, min(kmax, total))
+    Ds, Is = [None] * len(xq), [None] * len(xq)
+    if isFaiss:
+        try:
+            lims, D, I = index.range_search(xq, float(np.nextafter(np.float32(mat), np.float32(np.inf))))
+            for i in range(len(xq)):
+                d, l = D[lims[i]:lims[i + 1]], I[lims[i]:lims[i + 1]]
+                order = np.argsort(d, kind='stable')[:limit]
+                Ds[i], Is[i] = d[order], l[order]
+            return Ds, Is
+        except RuntimeError: # index type without range search support
+            pass
+    rows = np.arange(len(xq))
+    k = min(10, limit)
+    while len(rows):
+        D, I = index.search(xq[rows], k) if isFaiss else searchWithHnsw(index, xq[rows], k)
+        done = (D[:, -1] > mat) | (k >= limit)
+        for r, d, l in zip(rows[done], D[done], I[done]):
+            m = (d <= mat) & (l >= 0)
+            Ds[r], Is[r] = d[m], l[m]
+        rows = rows[~done]
+        k = min(k * 2, limit)
+    return Ds, Is
+
+#==============================================================================
+def createNeighbourTable(index, sentence_embeddings, isFaiss, mat, kmax, idxDir, rows=None):
+    # one batched self search over every indexed vector, stored as
+    # per label slices of flat label/distance arrays. rows are the ascending
+    # labels of the vectors when not their positions (a compacted base),
+    # labels between them get empty slices
+    print(f'\nCREATING NEIGHBOUR TABLE, MAT: {mat} KMAX: {kmax}')
+    sz = len(sentence_embeddings)
+    size = sz if rows is None else (int(rows[-1]) + 1 if sz else 0)
+    offsets = np.zeros(size + 1, dtype=np.int64)
+    labels, distances = [], []
+    for start in range(0, sz, NBR_BATCH):
+        D, I = selfSearch(index, sentence_embeddings[start:start + NBR_BATCH], isFaiss, mat, kmax)
+        for i in range(len(D)):
+            offsets[(start + i if rows is None else rows[start + i]) + 1] = len(D[i])
+        labels.extend(I)
+        distances.extend(D)
+        sys.stderr.write(f'\rneighbours: {min(start + NBR_BATCH, sz)}/{sz}')
+    sys.stderr.write('\n')
+    np.cumsum(offsets, out=offsets)
+    labels = np.concatenate(labels).astype(np.int32) if labels else np.empty(0, np.int32)
+    distances = np.concatenate(distances).astype(np.float32) if distances else np.empty(0, np.float32)
+    np.savez(os.path.join(idxDir, NBR_FILE), offsets=offsets, labels=labels, distances=distances, mat=np.float32(mat))
+
+    with open(os.path.join(idxDir, IDX_INFO), 'r') as f: idxOpts = json.loads(f.read())
+    idxOpts.update({'neighbours': NBR_FILE, 'mat': mat, 'kmax': kmax})
     f = open(os.path.join(idxDir,IDX_INFO), 'w'); f.write(json.dumps(idxOpts)); f.close()
-    return index
+    print(f'NEIGHBOURS: {len(labels)} AVG PER LABEL: {len(labels) / max(1, sz):.2f}')
 
 #==============================================================================
 '''
@@ -158,33 +478,38 @@ def searchWithHnsw(index, query, dist):
 
 if __name__ == "__main__":
     opts = parser.parse_args()
+    if not opts.outDir and not opts.bench:
+        parser.error('-o is required')
 
-    recs = loadRecords(opts.inFile)
-    cnt = 1
-    for rec in recs :
-        print( rec )
-        cnt += 1
-        if cnt > 440:
-            break
+    if opts.bench:
+        benchEncoders(SentenceTransformer(MODEL_NAME), opts)
+        sys.exit(0)
 
     print("CREATING EMBEDDINGS...\n")
     t1 = datetime.now()
-    model = SentenceTransformer('all-MiniLM-L6-v2')
-    sentence_embeddings = model.encode(recs, normalize_embeddings=True) #.tolist()
-
-    shape = sentence_embeddings.shape
-    print(sentence_embeddings.shape)
-
-    if opts.createFaiss :
-        index =  createFaissIndex(shape[1], sentence_embeddings, opts.idxType, opts.outDir)
-    else:
-        print('CREATE HNSWLIB')
-        index = createNhswLibIndex(shape[1], sentence_embeddings, opts.idxType, opts.outDir )
+    model = SentenceTransformer(MODEL_NAME)
+    cache = VectorCache(opts.cacheFile, MODEL_NAME, True, model.get_sentence_embedding_dimension()) \
+            if opts.cacheFile else None
+    index, dim = buildIndex(model, opts, cache)
 
     print(f'TIME TO CREATE INDEX: {datetime.now() - t1}')
+    if cache is not None:
+        c = cache.stats()
+        print(f'EMBEDDING CACHE: {c["hits"]} HITS, {c["misses"]} MISSES, HIT RATE {100.0 * c["hit_rate"]:.1f}%, {c["rows"]} VECTORS')
+        cache.close()
+
+    if opts.neighbours:
+        t1 = datetime.now()
+        # the embeddings written during the build, mapped, not loaded
+        vecPath = os.path.join(opts.outDir, VEC_FILE)
+        sentence_embeddings = np.memmap(vecPath, dtype=np.float32, mode='r').reshape(-1, dim)
+        createNeighbourTable(index, sentence_embeddings, opts.createFaiss, opts.mat, opts.kMax, opts.outDir)
+        del sentence_embeddings
+        os.remove(vecPath)
+        print(f'TIME TO CREATE NEIGHBOUR TABLE: {datetime.now() - t1}')
 
     if opts.runSearch:
-        searchIdx(recs, model, index, opts.createFaiss)
+        searchIdx(loadRecords(opts.inFile), model, index, opts.createFaiss)
 
     # bee is sitting on yellow flower
     # byciclist sitting on a bike
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  generation.py
+#
+import gc
+import threading
+import traceback
+from datetime import datetime
+
+#==============================================================================
+class Generation:
+    # one loaded set of index/records/prefixes, parts are set as attributes
+    # by the server loading it (records, prefixes, pdict, searcher ...)
+    def __init__(self, gid, paths, close=None, **parts):
+        self.id = gid
+        self.paths = dict(paths)
+        self.loaded = datetime.now()
+        self.active = 0
+        self.retired = False
+        self.onClose = close
+        self.loadTimes = {}
+        self.__dict__.update(parts)
+
+    def close(self):
+        if self.onClose is not None:
+            self.onClose(self)
+
+#==============================================================================
+class Generations:
+    # the generation requests run against: a request acquires the current
+    # one when it starts and keeps it until it is done. reload loads and
+    # warms the next generation aside (load does both) and swaps it in, the
+    # old one is closed and dropped once its last request released it
+    def __init__(self, load, paths, start=True):
+        self._load = load # load(gid, paths) -> Generation
+        self._paths = dict(paths)
+        self._cond = threading.Condition()
+        self._current = None
+        self._next = 2
+        self._reloading = False
+        self._retiring = 0
+        self.lastError = None
+        if start:
+            self.start()
+
+    def start(self):
+        # loads the first generation, left to the caller with start=False
+        gen = self._load(1, self._paths)
+        with self._cond:
+            self._current = gen
+
+    def current(self):
+        return self._current
+
+    def acquire(self):
+        with self._cond:
+            gen = self._current
+            gen.active += 1
+            return gen
+
+    def release(self, gen):
+        with self._cond:
+            gen.active -= 1
+            if gen.active == 0:
+                self._cond.notify_all()
+
+    def reload(self, paths=None, wait=False):
+        # paths overrides some of the current ones; False when a reload
+        # is already running
+        with self._cond:
+            if self._reloading or self._current is None:
+                return False
+            self._reloading = True
+            gid = self._next
+            self._next += 1
+            paths = dict(self._current.paths, **(paths or {}))
+        if wait:
+            self._reload(gid, paths, True)
+        else:
+            threading.Thread(target=self._reload, args=(gid, paths, False), name=f'reload-{gid}', daemon=True).start()
+        return True
+
+    def _reload(self, gid, paths, wait):
+        try:
+            print(f'LOADING GENERATION {gid}: {paths}', flush=True)
+            gen = self._load(gid, paths)
+        except Exception as e:
+            traceback.print_exc()
+            with self._cond:
+                self.lastError = f'generation {gid}: {e}'
+                self._reloading = False
+            return
+        self.swap(gen, wait)
+        with self._cond:
+            self.lastError = None
+            self._reloading = False
+
+    def swap(self, gen, wait=False):
+        # with wait the old generation is released before returning
+        with self._cond:
+            old = self._current
+            self._current = gen
+            old.retired = True
+            self._retiring += 1
+        print(f'GENERATION {gen.id} IN SERVICE, RETIRING {old.id}', flush=True)
+        if wait:
+            self._retire([old])
+            return
+        threading.Thread(target=self._retire, args=([old],), name=f'retire-{old.id}', daemon=True).start()
+
+    def _retire(self, box):
+        old = box.pop() # the thread must not keep it alive after del
+        with self._cond:
+            while old.active > 0:
+                self._cond.wait()
+        try:
+            old.close()
+        except Exception:
+            traceback.print_exc()
+        gid = old.id
+        del old
+        gc.collect()
+        with self._cond:
+            self._retiring -= 1
+        print(f'GENERATION {gid} RELEASED', flush=True)
+
+    def drain(self, timeout=None):
+        # waits for the requests running on any generation to finish
+        with self._cond:
+            return self._cond.wait_for(lambda: self._current.active == 0 and not self._retiring, timeout)
+
+    def stats(self):
+        with self._cond:
+            gen = self._current
+            return {'generation': gen.id, 'loaded': gen.loaded.isoformat(), 'paths': gen.paths,
+                    'load_seconds': {k: round(v, 3) for k, v in gen.loadTimes.items()},
+                    'active': gen.active, 'reloading': self._reloading, 'retiring': self._retiring,
+                    'last_error': self.lastError}
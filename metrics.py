@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  metrics.py
+#
+import os
+import time
+import pickle
+import threading
+from bisect import bisect_left
+from collections import deque
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (0, 1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+RETIRE_EVERY = 5.0 # seconds between folds of the shards of dead threads
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+SHARE_EVERY = 1.0 # seconds between dumps of a worker's values when shared
+RETIRED_FILE = 'retired.pickle'
+
+_trace = threading.local()
+
+#==============================================================================
+def startTrace():
+    # per request record of what traced histograms observe in this thread,
+    # plus whatever the request adds to it; read by the slow query log
+    t = {'stages': {}, 'expansions': {}}
+    _trace.current = t
+    return t
+
+#==============================================================================
+def endTrace():
+    t = getattr(_trace, 'current', None)
+    _trace.current = None
+    return t
+
+#==============================================================================
+def currentTrace():
+    return getattr(_trace, 'current', None)
+
+#==============================================================================
+def addTrace(other):
+    # stage timings taken in another thread (the batch scheduler) on behalf
+    # of the current request
+    t = getattr(_trace, 'current', None)
+    if t is None or not other:
+        return
+    for stage, v in other['stages'].items():
+        t['stages'][stage] = t['stages'].get(stage, 0.0) + v
+
+#==============================================================================
+def traceExpansion(term, size):
+    t = getattr(_trace, 'current', None)
+    if t is not None:
+        t['expansions'][term] = size
+
+#==============================================================================
+def formatValue(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+#==============================================================================
+def formatLabels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    esc = lambda s: str(s).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{n}="{esc(v)}"' for n, v in pairs) + '}'
+
+#==============================================================================
+def loadValues(path, default=None):
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return default
+
+#==============================================================================
+def saveValues(path, values):
+    tmp = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(values, f)
+    os.replace(tmp, path)
+
+#==============================================================================
+class Registry:
+    # every thread writes to its own shard (a plain dict of lists only that
+    # thread mutates), so recording takes no lock; a scrape sums the shards.
+    # a new thread's shard is queued on a deque, not registered under the
+    # lock: request threads are short lived, one per connection. the queue
+    # is drained and the shards of dead threads folded into one retired
+    # shard by a background thread and by scrapes, never by a request.
+    # forked workers share() a directory: each one dumps its values there
+    # and a scrape answered by any of them sums the dumps of all of them
+    def __init__(self):
+        self._metrics = []
+        self._local = threading.local()
+        self._new = deque() # shards of new threads, appended without a lock
+        self._shards = []
+        self._retired = {}
+        self._retirer = None # pid the retiring thread runs in
+        self._lock = threading.Lock()
+        self._dir = None
+        self._dumpLock = threading.Lock()
+
+    def shard(self):
+        values = getattr(self._local, 'values', None)
+        if values is None:
+            values = self._local.values = {}
+            self._new.append((threading.current_thread(), values))
+            if self._retirer != os.getpid(): # threads do not survive a fork
+                self._retirer = os.getpid()
+                threading.Thread(target=self._retireLoop, name='metrics-retire', daemon=True).start()
+        return values
+
+    def _retireLoop(self):
+        while True:
+            time.sleep(RETIRE_EVERY)
+            with self._lock:
+                self._retire()
+
+    def _merge(self, into, values):
+        # values may be another thread's shard: dict.copy() and list() are
+        # single calls that thread can not interleave with, iterating is not
+        for key, v in values.copy().items():
+            v = list(v)
+            acc = into.get(key)
+            if acc is None:
+                into[key] = v
+            else:
+                for n in range(len(v)):
+                    acc[n] += v[n]
+
+    def _retire(self):
+        # under self._lock, the only place the queue is drained
+        while self._new:
+            self._shards.append(self._new.popleft())
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                self._merge(self._retired, values)
+        self._shards = alive
+
+    def _collectLocal(self):
+        with self._lock:
+            self._retire()
+            total = {}
+            self._merge(total, self._retired)
+            for thread, values in self._shards:
+                self._merge(total, values)
+        return total
+
+    def collect(self):
+        # sum of every shard: {(metric, label values): [values]}, of every
+        # worker when shared; the scraping worker dumps its own values first
+        # so each worker is counted from its latest dump and totals never
+        # go backwards whichever worker answers
+        if self._dir is None:
+            return self._collectLocal()
+        self.dump()
+        byName = {m.name: m for m in self._metrics}
+        total = {}
+        for (name, labelValues), v in self._gather().items():
+            if name in byName:
+                total[(byName[name], labelValues)] = v
+        return total
+
+    def share(self, path):
+        # in a forked worker: values inherited from the parent are dropped,
+        # from now on they are dumped to path every SHARE_EVERY seconds
+        self._lock = threading.Lock()
+        self._dumpLock = threading.Lock()
+        self._local = threading.local()
+        self._new = deque()
+        self._shards = []
+        self._retired = {}
+        self._retirer = None
+        self._dir = path
+        threading.Thread(target=self._dumpLoop, name='metrics-share', daemon=True).start()
+
+    def _dumpLoop(self):
+        while True:
+            time.sleep(SHARE_EVERY)
+            try:
+                self.dump()
+            except Exception:
+                pass
+
+    def dump(self):
+        if self._dir is None:
+            return
+        with self._dumpLock:
+            values = {(m.name, labelValues): v for (m, labelValues), v in self._collectLocal().items()}
+            saveValues(os.path.join(self._dir, f'{os.getpid()}.pickle'), values)
+
+    def _gather(self):
+        # the dumps are read before the retired file: a worker folded in the
+        # meantime is then skipped as listed there, never counted twice
+        dumps = {}
+        for name in os.listdir(self._dir):
+            if name.endswith('.pickle') and name != RETIRED_FILE:
+                values = loadValues(os.path.join(self._dir, name))
+                if values is not None:
+                    dumps[int(name[:-len('.pickle')])] = values
+        retired = loadValues(os.path.join(self._dir, RETIRED_FILE), {'pids': set(), 'values': {}})
+        total = {}
+        self._merge(total, retired['values'])
+        for pid, values in dumps.items():
+            if pid not in retired['pids']:
+                self._merge(total, values)
+        return total
+
+    def fold(self, path, pid):
+        # in the parent once worker pid exited: its last dump is kept in the
+        # retired file, less its gauges (what it had in flight is gone)
+        pidPath = os.path.join(path, f'{pid}.pickle')
+        values = loadValues(pidPath)
+        if values is None:
+            return
+        gauges = {m.name for m in self._metrics if m.kind == 'gauge'}
+        retiredPath = os.path.join(path, RETIRED_FILE)
+        retired = loadValues(retiredPath, {'pids': set(), 'values': {}})
+        self._merge(retired['values'], {k: v for k, v in values.items() if k[0] not in gauges})
+        retired['pids'].add(pid)
+        saveValues(retiredPath, retired)
+        os.unlink(pidPath)
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(self, name, help, labels))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.register(Gauge(self, name, help, labels, fn))
+
+    def histogram(self, name, help, buckets, labels=(), traced=False):
+        return self.register(Histogram(self, name, help, buckets, labels, traced))
+
+    def expose(self):
+        # prometheus text exposition format
+        total = self.collect()
+        lines = []
+        for m in self._metrics:
+            lines.append(f'# HELP {m.name} {m.help}')
+            lines.append(f'# TYPE {m.name} {m.kind}')
+            lines.extend(m.lines(sorted(((k[1], v) for k, v in total.items() if k[0] is m), key=lambda e: e[0])))
+        return '\n'.join(lines) + '\n'
+
+#==============================================================================
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, registry, name, help, labels=()):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def add(self, value=1, *labelValues):
+        values = self._registry.shard()
+        key = (self, labelValues)
+        v = values.get(key)
+        if v is None:
+            values[key] = [value]
+        else:
+            v[0] += value
+
+    def lines(self, series):
+        return [f'{self.name}{formatLabels(self.labels, lv)} {formatValue(v[0])}' for lv, v in series]
+
+#==============================================================================
+class Gauge(Counter):
+    # either added to like a counter (in flight requests) or read from fn
+    # at scrape time (sizes of what is loaded)
+    kind = 'gauge'
+
+    def __init__(self, registry, name, help, labels=(), fn=None):
+        Counter.__init__(self, registry, name, help, labels)
+        self.fn = fn
+
+    def lines(self, series):
+        if self.fn is None:
+            return Counter.lines(self, series)
+        try:
+            return [f'{self.name} {formatValue(self.fn())}']
+        except Exception:
+            return []
+
+#==============================================================================
+class Timer:
+    __slots__ = ('_histogram', '_labelValues', '_start')
+
+    def __init__(self, histogram, labelValues):
+        self._histogram = histogram
+        self._labelValues = labelValues
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start, *self._labelValues)
+
+#==============================================================================
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, registry, name, help, buckets, labels=(), traced=False):
+        self._registry = registry
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self.traced = traced
+
+    def observe(self, value, *labelValues):
+        # per bucket counts (not cumulative), then sum and count
+        if self.traced:
+            t = getattr(_trace, 'current', None)
+            if t is not None:
+                stage = labelValues[0] if labelValues else self.name
+                t['stages'][stage] = t['stages'].get(stage, 0.0) + value
+        values = self._registry.shard()
+        key = (self, labelValues)
+        v = values.get(key)
+        if v is None:
+            v = values[key] = [0] * (len(self.buckets) + 3)
+        v[bisect_left(self.buckets, value)] += 1
+        v[-2] += value
+        v[-1] += 1
+
+    def time(self, *labelValues):
+        return Timer(self, labelValues)
+
+    def lines(self, series):
+        out = []
+        for lv, v in series:
+            cumulative = 0
+            for b, c in zip(self.buckets + (float('inf'),), v):
+                cumulative += c
+                out.append(f'{self.name}_bucket{formatLabels(self.labels, lv, ("le", formatValue(b)))} {cumulative}')
+            out.append(f'{self.name}_sum{formatLabels(self.labels, lv)} {formatValue(v[-2])}')
+            out.append(f'{self.name}_count{formatLabels(self.labels, lv)} {v[-1]}')
+        return out
+
+#==============================================================================
+REGISTRY = Registry()
+REQUESTS = REGISTRY.counter('search_requests_total', 'HTTP requests by method and status', ('method', 'status'))
+IN_FLIGHT = REGISTRY.gauge('search_requests_in_flight', 'requests being served')
+REQUEST_SECONDS = REGISTRY.histogram('search_request_seconds', 'search request latency', LATENCY_BUCKETS)
+STAGE_SECONDS = REGISTRY.histogram('search_stage_seconds', 'search request latency by stage', LATENCY_BUCKETS, ('stage',), True)
+RESULT_ROWS = REGISTRY.histogram('search_result_rows', 'records matching a query', SIZE_BUCKETS)
+RETURNED_ROWS = REGISTRY.histogram('search_returned_rows', 'records returned in a response', SIZE_BUCKETS)
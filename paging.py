@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  paging.py
+#
+import json
+import base64
+import hashlib
+from query_cache import canonicalTree
+
+PAGE_KEYS = set(['limit', 'offset', 'cursor', 'stream'])
+CHUNK_SIZE = 64 * 1024
+
+#==============================================================================
+def queryHash(query_json):
+    # a cursor is only valid for the query it was issued for, whatever page
+    q = {k: v for k, v in query_json.items() if k not in PAGE_KEYS}
+    s = json.dumps(canonicalTree(q), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(s.encode('utf-8')).hexdigest()[:16]
+
+#==============================================================================
+def makeCursor(query_json, offset):
+    c = json.dumps({'q': queryHash(query_json), 'o': offset}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(c.encode('utf-8')).decode('ascii')
+
+#==============================================================================
+def pageRequest(query_json):
+    # (offset, limit) asked for by the query, limit None means everything;
+    # raises ValueError on a malformed or foreign cursor
+    limit = query_json.get('limit')
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+        raise ValueError('limit must be a non negative integer')
+    offset = query_json.get('offset', 0)
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        raise ValueError('offset must be a non negative integer')
+    cursor = query_json.get('cursor')
+    if cursor:
+        try:
+            c = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            offset = int(c['o'])
+            h = c['q']
+        except Exception:
+            raise ValueError('invalid cursor')
+        if h != queryHash(query_json) or offset < 0:
+            raise ValueError('cursor does not belong to this query')
+    return offset, limit
+
+#==============================================================================
+def pageResults(query_json, results, offset, limit):
+    # results are sorted posting arrays so pages are stable between calls;
+    # returns the page and the cursor of the next one or None. limit 0 only
+    # asks for the total, it gets no cursor: the next page would be this one
+    if results is None:
+        return results, None
+    end = len(results) if limit is None else min(len(results), offset + limit)
+    page = results[offset:end]
+    return page, makeCursor(query_json, end) if end < len(results) and limit != 0 else None
+
+#==============================================================================
+def isStreaming(query_json):
+    return 'stream' in query_json and query_json['stream'] is True
+
+#==============================================================================
+def streamEnvelope(d, blobs):
+    # yields the response as byte pieces: d without its data, with blobs
+    # (any iterable of record JSON bytes) spliced one by one into the data list
+    head = dict(d)
+    head.pop('data', None)
+    yield b'{"data": ['
+    sep = b''
+    for b in blobs:
+        yield sep
+        yield b
+        sep = b', '
+    yield b'], ' + json.dumps(head)[1:].encode('utf-8')
+
+#==============================================================================
+def envelope(d, blobs):
+    return b''.join(streamEnvelope(d, blobs))
+
+#==============================================================================
+def writeChunked(wfile, pieces, chunkSize=CHUNK_SIZE):
+    # HTTP/1.1 chunked transfer encoding, pieces are buffered up to
+    # chunkSize bytes so small records do not turn into tiny chunks
+    buf = []
+    size = 0
+    for piece in pieces:
+        b = piece.encode('utf-8') if isinstance(piece, str) else piece
+        buf.append(b)
+        size += len(b)
+        if size >= chunkSize:
+            wfile.write(b'%x\r\n%s\r\n' % (size, b''.join(buf)))
+            buf = []
+            size = 0
+    if size:
+        wfile.write(b'%x\r\n%s\r\n' % (size, b''.join(buf)))
+    wfile.write(b'0\r\n\r\n')
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  postings.py
+#
+import json
+import fileinput
+import numpy as np
+
+KEYS = '_keys_'
+EMPTY = np.empty(0, dtype=np.int32)
+
+#==============================================================================
+def toPostings(ids):
+    # sorted, duplicate free int32 array
+    if not len(ids):
+        return EMPTY
+    a = np.asarray(ids, dtype=np.int32)
+    if len(a) > 1 and not np.all(a[1:] > a[:-1]):
+        a = np.unique(a)
+    return a
+
+#==============================================================================
+def intersect(a, b):
+    # binary search the smaller list in the larger one, this is what
+    # galloping intersection amounts to when both sides are in memory
+    if len(a) > len(b):
+        a, b = b, a
+    if not len(a):
+        return EMPTY
+    idx = np.searchsorted(b, a)
+    idx[idx == len(b)] = 0
+    return a[b[idx] == a]
+
+#==============================================================================
+def union(a, b):
+    if not len(a):
+        return b
+    if not len(b):
+        return a
+    return np.union1d(a, b).astype(np.int32, copy=False)
+
+#==============================================================================
+def unionAll(lists):
+    lists = [l for l in lists if len(l)]
+    if not lists:
+        return EMPTY
+    if len(lists) == 1:
+        return lists[0]
+    return np.unique(np.concatenate(lists))
+
+#==============================================================================
+def difference(a, b):
+    # rows of a that are not in b
+    if not len(a) or not len(b):
+        return a
+    idx = np.searchsorted(b, a)
+    idx[idx == len(b)] = 0
+    return a[b[idx] != a]
+
+#==============================================================================
+def toIds(a):
+    return [] if a is None else a.tolist()
+
+#==============================================================================
+def loadPrefixes(path):
+    # same file format as loadRecords reads: one [prefix, [ids]] per line,
+    # the id lists become posting arrays, the _keys_ row stays as is
+    pfxs = []
+    for line in fileinput.input( path ):
+        l = line.strip('\n')
+        try:
+            j = json.loads(l)
+        except:
+            pfxs.append(l)
+            continue
+        if isinstance(j, list) and len(j) == 2 and j[0] != KEYS and isinstance(j[1], list):
+            j[1] = toPostings(j[1])
+        pfxs.append(j)
+
+    return pfxs
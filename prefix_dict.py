@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  prefix_dict.py
+#
+import re
+import numpy as np
+from bisect import bisect_left, bisect_right
+from postings import unionAll
+
+KEYS = '_keys_'
+wc_rx = re.compile('[*?]')
+
+#==============================================================================
+def globToRegex(pattern):
+    # '*' is any run of characters, '?' any single one, the way the LIKE
+    # queries treated them; keys never contain '\n' so it is the separator
+    out = []
+    for c in pattern:
+        if c == '*':
+            out.append('[^\n]*')
+        elif c == '?':
+            out.append('[^\n]')
+        else:
+            out.append(re.escape(c))
+    return re.compile('^' + ''.join(out) + '$', re.M)
+
+#==============================================================================
+def literalPrefix(pattern):
+    m = wc_rx.search(pattern)
+    return pattern if m is None else pattern[:m.start()]
+
+#==============================================================================
+class StrList:
+    # read-only list of the utf-8 strings stored back to back in buf, item i
+    # is buf[offsets[i]:offsets[i + 1] - sep], decoded when it is asked for
+    def __init__(self, buf, offsets, sep=0):
+        self._buf = buf
+        self._offsets = offsets
+        self._sep = sep
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return str(self._buf[self._offsets[i]:self._offsets[i + 1] - self._sep], 'utf-8')
+
+#==============================================================================
+class PrefixDict:
+    # in-process replacement of the sqlite pfx table: keys are kept sorted
+    # (case folded) so 'field:literal*' patterns become a bisect range, and
+    # the rest of the pattern is matched by one regex pass over that range
+    # of a newline joined blob instead of per-row LIKE
+    def __init__(self, pfxs, rows=None):
+        # rows limits the dictionary to some rows of pfxs, all by default
+        entries = []
+        self._pfxs = pfxs
+        self._exact = {}
+        self._universe = {}
+        for row in range(len(pfxs)) if rows is None else rows:
+            pfx = pfxs[row]
+            if not isinstance(pfx, list) or not pfx or pfx[0] == KEYS:
+                continue
+            key = str(pfx[0])
+            entries.append((key.lower(), row, key))
+            self._exact.setdefault(key, row)
+        entries.sort()
+        self._lower = [e[0] for e in entries]
+        self._rows = [e[1] for e in entries]
+        self._keys = [e[2] for e in entries]
+        self._starts = []
+        pos = 0
+        for k in self._lower:
+            self._starts.append(pos)
+            pos += len(k) + 1
+        self._end = pos
+        self._blob = ''.join(k + '\n' for k in self._lower)
+        self._blobBytes = None
+
+    @classmethod
+    def fromSnapshot(cls, pfxs, arrays, end):
+        # the dictionary dump() wrote, over buffers of a mapped snapshot:
+        # nothing is sorted or copied, the regex blob is decoded on first use
+        self = cls.__new__(cls)
+        self._pfxs = pfxs
+        self._exact = None
+        self._universe = {}
+        self._blobBytes = arrays['folded']
+        self._lower = StrList(arrays['folded'], arrays['folded_offsets'], 1)
+        self._rows = arrays['rows']
+        self._keys = StrList(arrays['keys'], arrays['keys_offsets'])
+        self._starts = arrays['starts']
+        self._end = end
+        self._blob = None
+        return self
+
+    def dump(self):
+        # (arrays, end) for fromSnapshot: the folded blob with byte offsets,
+        # rows, verbatim keys in the same order and the blob char starts
+        folded = self._blob.encode('utf-8')
+        keys = [k.encode('utf-8') for k in self._keys]
+        arrays = {'folded': folded,
+                  'folded_offsets': np.cumsum([0] + [len(k.encode('utf-8')) + 1 for k in self._lower], dtype=np.uint64),
+                  'rows': np.asarray(self._rows, dtype=np.int32),
+                  'keys': b''.join(keys),
+                  'keys_offsets': np.cumsum([0] + [len(k) for k in keys], dtype=np.uint64),
+                  'starts': np.asarray(self._starts, dtype=np.uint64)}
+        return arrays, self._end
+
+    def rebind(self, pfxs):
+        # postings are read from pfxs from now on (same rows, some of them
+        # patched by a live ingest), memoized universes are dropped
+        self._pfxs = pfxs
+        self._universe = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def get(self, key):
+        # row of a verbatim key or None
+        if self._exact is not None:
+            return self._exact.get(key)
+        # entries are sorted by (folded key, row), the first verbatim match
+        # is the first row the key appeared on as with the dict
+        lo, hi = self.foldedRange(key)
+        for i in range(lo, hi):
+            if self._keys[i] == key:
+                return self._rows[i]
+        return None
+
+    def foldedRange(self, key):
+        key = key.lower()
+        lo = bisect_left(self._lower, key)
+        return lo, bisect_right(self._lower, key, lo)
+
+    def getFolded(self, key):
+        # row of a key compared case-insensitively or None
+        key = key.lower()
+        i = bisect_left(self._lower, key)
+        return self._rows[i] if i < len(self._lower) and self._lower[i] == key else None
+
+    def keyRange(self, prefix):
+        prefix = prefix.lower()
+        lo = bisect_left(self._lower, prefix)
+        if not prefix:
+            return lo, len(self._lower)
+        return lo, bisect_left(self._lower, prefix[:-1] + chr(ord(prefix[-1]) + 1), lo)
+
+    def _scan(self, pattern):
+        # positions (in sorted order) of keys matching the glob pattern
+        pattern = pattern.lower()
+        lo, hi = self.keyRange(literalPrefix(pattern))
+        if lo >= hi:
+            return []
+        start = self._starts[lo]
+        end = self._starts[hi] if hi < len(self._starts) else self._end
+        if self._blob is None:
+            self._blob = str(self._blobBytes, 'utf-8')
+        rx = globToRegex(pattern)
+        # a pattern matching '' also matches after the last '\n' of the range
+        return [bisect_right(self._starts, m.start()) - 1 for m in rx.finditer(self._blob, start, end)
+                if m.start() < end]
+
+    def match(self, pattern, limit):
+        # rows of keys matching pattern, shortest first, at most limit
+        found = sorted(self._scan(pattern), key=lambda i: (len(self._keys[i]), self._rows[i]))
+        return [(self._keys[i], self._rows[i]) for i in (found if limit < 0 else found[:limit])]
+
+    def matchAll(self, pattern):
+        # rows of every key matching pattern, in no particular order
+        return [self._rows[i] for i in self._scan(pattern)]
+
+    def size(self, rows):
+        # total posting length of rows, an upper bound of their union
+        return sum(len(self._pfxs[r][1]) for r in rows)
+
+    def postings(self, rows):
+        return unionAll([self._pfxs[r][1] for r in rows])
+
+    def universe(self, field):
+        # ids of every record having a key under field, or of every record
+        # having any key when field is empty; plain fields are memoized
+        if field in self._universe:
+            return self._universe[field]
+        if not field:
+            st = self.postings(self._rows)
+        elif wc_rx.search(field):
+            return self.postings(self.matchAll(field + ':*'))
+        else:
+            lo, hi = self.keyRange(field + ':')
+            st = self.postings(self._rows[lo:hi])
+        self._universe[field] = st
+        return st
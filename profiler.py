@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  profiler.py
+#
+import os
+import sys
+import json
+import time
+import threading
+from datetime import datetime
+from query_cache import canonicalQuery
+
+SAMPLE_INTERVAL = 0.005 # seconds between stack samples
+MAX_SECONDS = 300       # longest profile one request may ask for
+# innermost frames of a thread that is parked, not working
+IDLE_FRAMES = set([('selectors.py', 'select'), ('threading.py', 'wait'), ('socket.py', 'accept'),
+                   ('socket.py', 'readinto'), ('queue.py', 'get')])
+
+#==============================================================================
+def frameName(f):
+    code = f.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{f.f_lineno})'
+
+#==============================================================================
+def isIdle(f):
+    return (os.path.basename(f.f_code.co_filename), f.f_code.co_name) in IDLE_FRAMES
+
+#==============================================================================
+class SamplingProfiler:
+    # wall clock stack sampler: every interval the stacks of all threads are
+    # read with sys._current_frames, nothing is installed in the threads
+    # being sampled so an idle server pays nothing; the result is in the
+    # collapsed format flamegraph.pl and speedscope read
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def requestDone(self):
+        self.requests += 1
+
+    def busy(self):
+        return self._lock.locked()
+
+    def profile(self, seconds, requests=0, interval=SAMPLE_INTERVAL, idle=False):
+        # samples for seconds, or until requests more requests completed
+        # when that comes first; returns None if a profile is already running
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            stacks = {}
+            me = threading.get_ident()
+            start = time.monotonic()
+            deadline = start + min(max(seconds, 0.0), MAX_SECONDS)
+            until = self.requests + requests if requests > 0 else None
+            samples = 0
+            while time.monotonic() < deadline and (until is None or self.requests < until):
+                for ident, f in sys._current_frames().items():
+                    if ident == me or (not idle and isIdle(f)):
+                        continue
+                    stack = []
+                    while f is not None:
+                        stack.append(frameName(f))
+                        f = f.f_back
+                    key = ';'.join(reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+                samples += 1
+                time.sleep(interval)
+            elapsed = time.monotonic() - start
+        finally:
+            self._lock.release()
+        print(f'PROFILE: {samples} SAMPLES IN {elapsed:.2f}s, {len(stacks)} STACKS', flush=True)
+        return ''.join(f'{k} {v}\n' for k, v in sorted(stacks.items()))
+
+#==============================================================================
+class SlowQueryLog:
+    # one JSON line per request slower than thresholdMs: the canonical query,
+    # its stage timings and wildcard/not expansion sizes, appended to path
+    # or printed when there is no path
+    def __init__(self, thresholdMs, path=None):
+        self.threshold = thresholdMs / 1000.0
+        self._path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', buffering=1, encoding='utf-8') if path else None
+
+    def check(self, elapsed, trace):
+        if trace is None or elapsed < self.threshold or 'query' not in trace:
+            return False
+        rec = {'time': datetime.now().isoformat(), 'ms': round(elapsed * 1000.0, 3),
+               'query': canonicalQuery(trace['query']),
+               'stages': {k: round(v * 1000.0, 3) for k, v in sorted(trace['stages'].items())},
+               'expansions': trace['expansions']}
+        for k in ('status', 'total', 'count', 'cached'):
+            if k in trace:
+                rec[k] = trace[k]
+        line = json.dumps(rec)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + '\n')
+            else:
+                print(f'SLOW QUERY: {line}', flush=True)
+        return True
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+PROFILER = SamplingProfiler()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  query_cache.py
+#
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+SET_OPERANDS = set(['and', 'or'])
+STAT_INTERVAL = 1.0 # seconds between checks of the watched files
+
+#==============================================================================
+def canonicalTree(q):
+    # and/or children are sorted and deduplicated, everything else
+    # (select, filter_fields, wel ...) is kept as is because it shapes
+    # the response
+    if isinstance(q, dict):
+        c = {}
+        for k in q:
+            if k in SET_OPERANDS and isinstance(q[k], list):
+                children = {}
+                for qq in q[k]:
+                    cc = canonicalTree(qq)
+                    children[json.dumps(cc, sort_keys=True)] = cc
+                c[k] = [children[i] for i in sorted(children)]
+            else:
+                c[k] = q[k]
+        return c
+    return q
+
+#==============================================================================
+def canonicalQuery(q):
+    return json.dumps(canonicalTree(q), sort_keys=True, separators=(',', ':'))
+
+#==============================================================================
+def filesVersion(paths):
+    v = []
+    for path in paths:
+        if os.path.isdir(path):
+            v.extend(filesVersion(sorted(os.path.join(path, f) for f in os.listdir(path))))
+            continue
+        try:
+            st = os.stat(path)
+            v.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            v.append((path, 0, 0))
+    return tuple(v)
+
+#==============================================================================
+class QueryCache:
+    # response cache keyed by canonical query, bounded by bytes, entries
+    # expire after ttl seconds and everything is dropped when any of the
+    # watched index/records/prefix files changes on disk
+    def __init__(self, maxBytes, ttl, watchFiles=()):
+        self._maxBytes = maxBytes
+        self._ttl = ttl
+        self._watchFiles = list(watchFiles)
+        self._map = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._version = filesVersion(self._watchFiles)
+        self._checked = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _checkVersion(self, now):
+        if now - self._checked < STAT_INTERVAL:
+            return
+        self._checked = now
+        v = filesVersion(self._watchFiles)
+        if v != self._version:
+            self._version = v
+            self._map.clear()
+            self._bytes = 0
+            self.invalidations += 1
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._checkVersion(now)
+            e = self._map.get(key)
+            if e is not None and self._ttl > 0 and now - e[0] > self._ttl:
+                del self._map[key]
+                self._bytes -= len(key) + len(e[1])
+                e = None
+            if e is None:
+                self.misses += 1
+                return None
+            self._map.move_to_end(key)
+            self.hits += 1
+            return e[1]
+
+    def put(self, key, value):
+        sz = len(key) + len(value)
+        if sz > self._maxBytes:
+            return
+        with self._lock:
+            old = self._map.pop(key, None)
+            if old is not None:
+                self._bytes -= len(key) + len(old[1])
+            self._map[key] = (time.monotonic(), value)
+            self._bytes += sz
+            while self._bytes > self._maxBytes:
+                k, e = self._map.popitem(last=False)
+                self._bytes -= len(k) + len(e[1])
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._map.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._map), 'bytes': self._bytes, 'max_bytes': self._maxBytes,
+                    'ttl': self._ttl, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  query_plan.py
+#
+import json
+from query_cache import canonicalTree
+from postings import intersect, unionAll, difference
+
+SET_OPERANDS = set(['and', 'or'])
+
+#==============================================================================
+def nodeKey(q):
+    return json.dumps(canonicalTree(q), sort_keys=True, separators=(',', ':'))
+
+#==============================================================================
+class Negation:
+    # leaf result of a '!term': the rows of universe that are not in match.
+    # match is a term or query dict evaluated by the planner, or an
+    # (estimate, evaluate) tuple; universe is an (estimate, evaluate) tuple
+    def __init__(self, match, universe):
+        self.match = match
+        self.universe = universe
+
+#==============================================================================
+class QueryPlanner:
+    # evaluates one query tree: and children run from the smallest estimated
+    # cardinality to the largest and stop as soon as the intersection is
+    # empty, negated children are subtracted from what the others left,
+    # identical subtrees and terms are evaluated once per request.
+    #
+    # leaf(term) returns None when the term adds no constraint, a query dict
+    # to evaluate in place of the term (wildcard expansion), a Negation, or
+    # a tuple (estimate, evaluate) where evaluate() returns a posting array
+    def __init__(self, leaf):
+        self._leaf = leaf
+        self._leaves = {}
+        self._estimates = {}
+        self._results = {}
+        self._nodes = {}
+
+    def _resolve(self, term):
+        if term not in self._leaves:
+            self._leaves[term] = self._leaf(term)
+        return self._leaves[term]
+
+    def _isNegation(self, q):
+        return isinstance(q, str) and isinstance(self._resolve(q), Negation)
+
+    def estimate(self, q):
+        if isinstance(q, str):
+            r = self._resolve(q)
+            if r is None:
+                return 0
+            if isinstance(r, Negation):
+                return r.universe[0]
+            return self.estimate(r) if isinstance(r, dict) else r[0]
+        key = nodeKey(q)
+        if key not in self._estimates:
+            est = 0
+            for k in q:
+                if k not in SET_OPERANDS:
+                    continue
+                ests = [self.estimate(qq) for qq in q[k] if isinstance(qq, (str, dict))]
+                if k == 'and':
+                    est = min(ests) if ests else 0
+                else:
+                    est = sum(ests)
+            self._estimates[key] = est
+        return self._estimates[key]
+
+    def _evalTuple(self, key, r):
+        if key not in self._results:
+            self._results[key] = r[1]()
+            return self._results[key], False
+        return self._results[key], True
+
+    def _evalMatch(self, term, neg):
+        if isinstance(neg.match, (str, dict)):
+            return self.evaluate(neg.match)
+        st, memo = self._evalTuple(('match', term), neg.match)
+        return st, {'est': neg.match[0], 'rows': len(st), 'memo': memo}
+
+    def _evalTerm(self, term):
+        r = self._resolve(term)
+        if r is None:
+            return None, {'term': term, 'est': 0, 'rows': None}
+        if isinstance(r, dict):
+            st, p = self.evaluate(r)
+            return st, {'term': term, 'expansion': p}
+        if isinstance(r, Negation):
+            m, p = self._evalMatch(term, r)
+            universe, memo = self._evalTuple(('universe', term), r.universe)
+            st = difference(universe, m) if m is not None else universe
+            return st, {'term': term, 'not': p, 'universe': len(universe), 'rows': len(st)}
+        st, memo = self._evalTuple(term, r)
+        return st, {'term': term, 'est': r[0], 'rows': len(st), 'memo': memo}
+
+    def _evalAnd(self, children):
+        negs = [qq for qq in children if self._isNegation(qq)]
+        children = sorted([qq for qq in children if not self._isNegation(qq)], key=self.estimate)
+        results = None
+        steps = []
+        skipped = []
+        for n, qq in enumerate(children):
+            st, p = self.evaluate(qq)
+            steps.append(p)
+            if st is None:
+                continue
+            results = st if results is None else intersect(results, st)
+            if not len(results):
+                skipped = [nodeKey(c) if isinstance(c, dict) else c for c in children[n + 1:]] + negs
+                return results, steps, skipped
+        # a negation inside 'and' is a set difference against the siblings,
+        # only an 'and' made of negations alone starts from the universe
+        for qq in negs:
+            if results is not None and not len(results):
+                skipped.append(qq)
+                continue
+            r = self._resolve(qq)
+            m, p = self._evalMatch(qq, r)
+            if results is None:
+                results, memo = self._evalTuple(('universe', qq), r.universe)
+            if m is not None:
+                results = difference(results, m)
+            steps.append({'term': qq, 'not': p, 'rows': len(results)})
+        return results, steps, skipped
+
+    def evaluate(self, q):
+        if isinstance(q, str):
+            return self._evalTerm(q)
+        key = nodeKey(q)
+        if key in self._nodes:
+            st, p = self._nodes[key]
+            return st, {'op': p.get('op'), 'est': p.get('est'), 'rows': p.get('rows'), 'memo': True}
+        results = None
+        plan = {}
+        for k in q:
+            if k not in SET_OPERANDS:
+                continue
+            children = [qq for qq in q[k] if isinstance(qq, (str, dict))]
+            skipped = []
+            if k == 'and':
+                results, steps, skipped = self._evalAnd(children)
+            else:
+                found = []
+                steps = []
+                for qq in children:
+                    st, p = self.evaluate(qq)
+                    steps.append(p)
+                    if st is not None:
+                        found.append(st)
+                results = unionAll(found) if found else None
+            plan = {'op': k, 'est': self.estimate(q), 'rows': None if results is None else len(results),
+                    'children': steps}
+            if skipped:
+                plan['skipped'] = skipped
+        self._nodes[key] = (results, plan)
+        return results, plan
+
+#==============================================================================
+def planQuery(q, leaf, plan=None):
+    results, p = QueryPlanner(leaf).evaluate(q)
+    if plan is not None:
+        plan['plan'] = p
+    return results
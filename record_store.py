@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  record_store.py
+#
+import os
+import sys
+import mmap
+import json
+import struct
+import argparse
+import weakref
+import threading
+from array import array
+from collections import OrderedDict
+
+parser = argparse.ArgumentParser()
+parser.add_argument( '-records', dest='recsFile', help='records file', required=True, metavar="FILE" )
+
+OFF_SUFFIX = '.off'
+OFF_MAGIC = b'RECOFF02'
+OFF_HEADER = struct.Struct('<8sQQQQ') # magic, source size, source mtime_ns, record count, bad rows
+FRAG_BYTES = 32 * 1024 * 1024 # default size of the projected field fragment cache
+
+#==============================================================================
+def txtToJson(text):
+    ok = True
+    j = None
+    try:
+        j = json.loads(text)
+    except:
+        ok = False
+    return j, ok
+
+#==============================================================================
+def fileId(st):
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+MAPPED = weakref.WeakValueDictionary() # real path -> RecordStore mapping it
+
+#==============================================================================
+def mapFile(path):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+#==============================================================================
+def scanOffsets(buf):
+    # offset of the first byte of every line plus the end of the last one,
+    # lines are split on '\n' like fileinput does
+    offsets = array('Q', [0])
+    pos = 0
+    size = len(buf)
+    while pos < size:
+        nl = buf.find(b'\n', pos)
+        pos = size if nl < 0 else nl + 1
+        offsets.append(pos)
+    return offsets
+
+#==============================================================================
+def isBadObject(line):
+    # a line that looks like a JSON object but does not parse as one, it
+    # can not be spliced into a response as it is
+    if line[:1] != b'{':
+        return False
+    try:
+        return not isinstance(json.loads(line), dict)
+    except ValueError:
+        return True
+
+#==============================================================================
+def scanBad(buf, offsets):
+    # rows of the lines isBadObject, found once when the offsets are built
+    bad = array('Q')
+    for i in range(len(offsets) - 1):
+        if buf[offsets[i]:offsets[i] + 1] == b'{' and isBadObject(buf[offsets[i]:offsets[i + 1]]):
+            bad.append(i)
+    return bad
+
+#==============================================================================
+def buildOffsets(path, offPath=None):
+    offPath = offPath or path + OFF_SUFFIX
+    st = os.stat(path)
+    buf = mapFile(path)
+    offsets = scanOffsets(buf)
+    bad = scanBad(buf, offsets)
+    tmp = f'{offPath}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(OFF_HEADER.pack(OFF_MAGIC, st.st_size, st.st_mtime_ns, len(offsets) - 1, len(bad)))
+        f.write(offsets.tobytes())
+        f.write(bad.tobytes())
+    os.replace(tmp, offPath)
+    return offPath
+
+#==============================================================================
+def loadOffsets(path, offPath=None):
+    # (line offsets, bad rows): the offsets file is mapped, not read, so
+    # opening the store costs the same for ten records or ten million; it
+    # is rebuilt when the records file no longer matches the size/mtime
+    # recorded in its header
+    offPath = offPath or path + OFF_SUFFIX
+    st = os.stat(path)
+    for attempt in range(2):
+        if os.path.exists(offPath):
+            buf = mapFile(offPath)
+            if len(buf) >= OFF_HEADER.size:
+                magic, size, mtime, count, nbad = OFF_HEADER.unpack_from(buf, 0)
+                if magic == OFF_MAGIC and size == st.st_size and mtime == st.st_mtime_ns and \
+                   len(buf) == OFF_HEADER.size + (count + 1 + nbad) * 8:
+                    view = memoryview(buf)[OFF_HEADER.size:].cast('Q')
+                    return view[:count + 1], view[count + 1:]
+        if attempt == 0:
+            try:
+                buildOffsets(path, offPath)
+            except OSError as e:
+                print(f'FAILED TO WRITE {offPath}: {e}, KEEPING OFFSETS IN MEMORY')
+                break
+    buf = mapFile(path)
+    offsets = scanOffsets(buf)
+    return offsets, scanBad(buf, offsets)
+
+#==============================================================================
+class RecordStore:
+    # read-only view of a JSON lines records file: the file is mmapped and
+    # a record is decoded only when it is asked for, nothing is kept resident
+    # but the fragments of projected fields, bounded by fragBytes.
+    # a mapped file must never be written in place (readers of a generation
+    # still using it get SIGBUS or torn records), new records replace it by
+    # a rename; a store opened on a file that was rewritten in place while
+    # another store maps it raises ValueError, which fails the reload
+    def __init__(self, path, fragBytes=FRAG_BYTES, buf=None, offsets=None, bad=None):
+        # buf and offsets, when given, are the records and their line
+        # offsets already mapped from somewhere else (a snapshot), bad the
+        # rows isBadObject or None to check every blob as it is served
+        self.path = path
+        self.fileId = None
+        if buf is None:
+            self.fileId = fileId(os.stat(path))
+            real = os.path.realpath(path)
+            other = MAPPED.get(real)
+            if other is not None and other.fileId[:2] == self.fileId[:2] and other.fileId != self.fileId:
+                raise ValueError(f'{path} was rewritten in place while it is mapped, replace it with a rename')
+            MAPPED[real] = self
+        self._buf = mapFile(path) if buf is None else buf
+        if offsets is None:
+            offsets, bad = loadOffsets(path)
+        self._offsets = offsets
+        self._bad = None if bad is None else frozenset(bad.tolist())
+        self._frags = OrderedDict()
+        self._fragBytes = 0
+        self._maxFragBytes = fragBytes
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def raw(self, i):
+        if i < 0:
+            i += len(self)
+        start, end = self._offsets[i], self._offsets[i + 1]
+        if end > start and self._buf[end - 1:end] == b'\n':
+            end -= 1
+        return bytes(self._buf[start:end])
+
+    def __getitem__(self, i):
+        l = self.raw(i).decode('utf-8')
+        j, ok = txtToJson(l)
+        return j if ok else l
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def blob(self, i):
+        # record i as JSON bytes: an object line is the JSON already and is
+        # returned as is, anything else (a malformed line included) goes
+        # through __getitem__ and dumps
+        if i < 0:
+            i += len(self)
+        b = self.raw(i)
+        if b[:1] == b'{' and (i not in self._bad if self._bad is not None else not isBadObject(b)):
+            return b
+        return json.dumps(self[i]).encode('utf-8')
+
+    def _putFragments(self, frags):
+        if self._maxFragBytes <= 0:
+            return
+        with self._lock:
+            for key, frag in frags:
+                if key in self._frags:
+                    continue
+                self._frags[key] = frag
+                self._fragBytes += 64 + (len(frag) if frag is not None else 0)
+            while self._fragBytes > self._maxFragBytes and self._frags:
+                key, frag = self._frags.popitem(last=False)
+                self._fragBytes -= 64 + (len(frag) if frag is not None else 0)
+
+    def fragments(self, i, fields):
+        # b'"field": value' of each field of record i, None for a field the
+        # record does not have; the record is decoded at most once per call
+        # and only when some of the fields are not cached yet
+        out = []
+        todo = []
+        with self._lock:
+            for n, f in enumerate(fields):
+                frag = self._frags.get((i, f), False)
+                if frag is False:
+                    todo.append(n)
+                else:
+                    self._frags.move_to_end((i, f))
+                out.append(frag)
+        if not todo:
+            return out
+        rec = self[i]
+        frags = []
+        for n in todo:
+            f = fields[n]
+            out[n] = (json.dumps(f) + ': ' + json.dumps(rec[f])).encode('utf-8') \
+                     if isinstance(rec, dict) and isinstance(f, str) and f in rec else None
+            frags.append(((i, f), out[n]))
+        self._putFragments(frags)
+        return out
+
+    def fragStats(self):
+        with self._lock:
+            return {'entries': len(self._frags), 'bytes': self._fragBytes, 'max_bytes': self._maxFragBytes}
+
+#==============================================================================
+def main(args):
+    opts = parser.parse_args()
+    offPath = buildOffsets(opts.recsFile)
+    print(f'RECORDS: {len(RecordStore(opts.recsFile))} OFFSETS: {offPath}')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+
+
+'''
+record_store.py -records data/sdn.json
+'''
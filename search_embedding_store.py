@@ -13,8 +13,30 @@ import faiss
 import argparse
 import pickle
 import re
-import sqlite3
+import gc
+import signal
+import shutil
+import tempfile
+import traceback
+import threading
+import time
+import numpy as np
+from collections import deque, OrderedDict
 from datetime import datetime
+from query_cache import QueryCache, canonicalQuery
+from paging import pageRequest, pageResults, isStreaming, streamEnvelope, envelope, writeChunked
+import metrics
+from profiler import PROFILER, SlowQueryLog
+from generation import Generation, Generations
+from snapshot import Snapshot
+from segments import SegmentStore
+from startup import Startup, loadParallel, timed
+from bulk import CHUNK, runBulk
+from record_store import RecordStore
+from prefix_dict import PrefixDict
+from postings import KEYS, loadPrefixes, unionAll, toIds
+from query_plan import planQuery, Negation
+from urllib.parse import urlsplit, parse_qs
 from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
 from sentence_transformers import SentenceTransformer
 
@@ -26,64 +48,403 @@ parser = argparse.ArgumentParser()
 parser.add_argument( '-faiss', action='store_const', const=True, default=False, dest='loadFaiss', help='load faiss index default: false' )
 parser.add_argument( '-search', action='store_const', const=True, default=False, dest='runSearch', help='run interactive search' )
 parser.add_argument( '-server', action='store_const', const=True, default=False, dest='webSearch', help='run web search server' )
-parser.add_argument( '-index', dest='idxFile', help='vector storage file', required=True, metavar="FILE" )
-parser.add_argument( '-records', dest='recsFile', help='records file', required=True, metavar="FILE" )
-parser.add_argument( '-prefixes', dest='pfxFile', help='prefixes file', required=True, metavar="FILE" )
+parser.add_argument( '-index', dest='idxFile', help='vector storage file', metavar="FILE" )
+parser.add_argument( '-records', dest='recsFile', help='records file', metavar="FILE" )
+parser.add_argument( '-prefixes', dest='pfxFile', help='prefixes file', metavar="FILE" )
+parser.add_argument( '-snapshot', dest='snapFile', help='snapshot bundle written by snapshot.py, replaces -index, -records and -prefixes', metavar="FILE" )
+parser.add_argument( '-qcache', dest='qCache', type=int, default=64, help='query result cache size in MB, 0 disables', metavar="MB" )
+parser.add_argument( '-qttl', dest='qTtl', type=float, default=60, help='query result cache ttl in seconds, 0 never expires', metavar="SEC" )
+parser.add_argument( '-fragcache', dest='fragCache', type=int, default=32, help='projected record field cache size in MB, 0 disables', metavar="MB" )
+parser.add_argument( '-slowms', dest='slowMs', type=float, default=500, help='log requests slower than this many milliseconds, 0 disables', metavar="MS" )
+parser.add_argument( '-slowlog', dest='slowLog', help='slow query log file, default: stdout', metavar="FILE" )
 parser.add_argument( '-port', dest='port', type=str, default="8888", help='server port', metavar="SYMBOL" )
-parser.add_argument( '-query', dest='query', type=str, help='query', metavar="SYMBOL" )
+parser.add_argument( '-query', dest='query', type=str, help='run the JSON lines file of queries offline', metavar="FILE" )
+parser.add_argument( '-out', dest='outFile', help='results of -query as JSON lines, default: the query file + .results.jsonl', metavar="FILE" )
+parser.add_argument( '-resume', action='store_const', const=True, default=False, dest='resume', help='continue an interrupted -query run from its checkpoint' )
+parser.add_argument( '-chunk', dest='chunk', type=int, default=CHUNK, help='queries per encoder batch for -query', metavar="INT" )
+parser.add_argument( '-maxbatch', dest='maxBatch', type=int, default=64, help='max terms per encoder batch in server mode', metavar="INT" )
+parser.add_argument( '-workers', dest='workers', type=int, default=0, help='number of pre-forked server or -query processes, 0 runs in this process', metavar="INT" )
+parser.add_argument( '-embcache', dest='embCache', type=int, default=64, help='query embedding cache size in MB, 0 disables', metavar="MB" )
+parser.add_argument( '-kmax', dest='kMax', type=int, default=200, help='neighbour cap for radius search, 0 uses fixed k search', metavar="INT" )
+parser.add_argument( '-segments', dest='segDir', help='directory of a segmented index taking live ingests: ingest logs, compacted bases and their manifest', metavar="DIR" )
+parser.add_argument( '-compactrows', dest='compactRows', type=int, default=100000, help='compact once this many delta vectors and tombstones piled up, 0 only on POST /admin/compact', metavar="INT" )
+parser.add_argument( '-maxwait', dest='maxWait', type=float, default=2.0, help='max milliseconds to wait for a batch to fill', metavar="MS" )
 
 locale.setlocale( locale.LC_ALL, '')
 
 not_rx = re.compile('^!(.*)', re.S)
-wc_rx_a = re.compile('[*]', re.S)
-wc_rx_q = re.compile('[?]', re.S)
 wc_rx = re.compile('(?s).*[*?].*')
 
 SET_OPERANDS = set(['and', 'or'])
 DISTANCE = 10 #20 probing distance
 MAT = 0.089   # maximum acceptable distance threashold
 WEL = 20      # wild card expansion limit
-NEL = 200     # not expansion limit
+KMAX = 200    # most neighbours a radius search may return per term
 
+MODEL_NAME = 'all-MiniLM-L6-v2'
 IDX_FILE = 'index.idx'
 IDX_INFO = 'index-info.json'
+WORKER_GRACE = 30 # seconds a retired worker waits for its requests
+WORKER_SETTLE = 1.0
+WORKER_STARTUP = 10.0 # seconds a worker has to live not to count as failing to start
+WORKER_FAILURES = 5   # failed starts in a row before the server gives up
+RELOAD_PATHS = set(['index', 'records', 'prefixes', 'snapshot'])
 
 class HttpServerWrapper:
-    def __init__(self, prefixes, records, searcher, dbconn, port):
+    def __init__(self, gens, qcache, slowlog, startup, port, segments=None):
         def handler(*args):
-            RequestHandler(prefixes, records, searcher, dbconn, *args)
+            RequestHandler(gens, qcache, slowlog, startup, self.reload, segments, *args)
+        self._gens = gens
+        self._worker = False
         self._server = ThreadingHTTPServer(('', port), handler)
     def serve_forever(self):
         self._server.serve_forever()
+    def shutdown(self):
+        self._server.shutdown()
     def server_close(self):
         self._server.server_close()
 
+    def reload(self, paths=None):
+        # (started, message); a worker asks the parent, which loads the new
+        # generation once and replaces the workers with ones forked from it
+        if not self._worker:
+            if self._gens.reload(paths):
+                return True, 'reload started'
+            return False, 'a reload is already running'
+        if paths:
+            return False, 'paths can not be changed when running with -workers'
+        os.kill(os.getppid(), signal.SIGHUP)
+        return True, 'reload requested from the parent process'
+
+    def serve_workers(self, workers, onWorkerStart=None):
+        # False when it stopped because workers kept dying at startup
+        # the listening socket, index, records and model are already loaded
+        # here, forked workers accept on the inherited socket and share all
+        # of it copy-on-write, the model is only run in them (onWorkerStart);
+        # the parent only restarts workers that die, and gives up once
+        # WORKER_FAILURES in a row died at startup.
+        # on SIGHUP the parent loads the next generation and forks new
+        # workers, the old ones stop accepting and exit once drained
+        gc.freeze() # keep refcount updates away from the shared pages
+        children = {}
+        retiring = set()
+        failures = 0
+        waited = {signal.SIGHUP, signal.SIGCHLD}
+        shared = tempfile.mkdtemp(prefix='search-metrics-') # /metrics sums every worker
+
+        def spawn(n):
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=self._server.shutdown, daemon=True).start())
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, waited)
+                self._worker = True
+                metrics.REGISTRY.share(shared)
+                code = 0
+                try:
+                    if onWorkerStart:
+                        onWorkerStart(n)
+                    self._server.serve_forever()
+                    # retired: let connections accepted before the shutdown
+                    # reach their generation, then wait for them to finish
+                    time.sleep(WORKER_SETTLE)
+                    self._gens.drain(WORKER_GRACE)
+                except KeyboardInterrupt:
+                    pass
+                except:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    try:
+                        metrics.REGISTRY.dump()
+                    finally:
+                        os._exit(code)
+            print(f'WORKER {n} STARTED, PID {pid}', flush=True)
+            children[pid] = (n, time.monotonic())
+
+        def terminate(signum, frame):
+            raise KeyboardInterrupt
+
+        def exited(pid, status):
+            nonlocal failures
+            metrics.REGISTRY.fold(shared, pid)
+            if pid in retiring:
+                retiring.discard(pid)
+                print(f'RETIRED WORKER PID {pid} EXITED WITH STATUS {status}', flush=True)
+                return
+            if pid not in children:
+                return
+            n, started = children.pop(pid)
+            failures = failures + 1 if time.monotonic() - started < WORKER_STARTUP else 0
+            if failures >= WORKER_FAILURES:
+                print(f'WORKER {n} PID {pid} EXITED WITH STATUS {status}, {failures} WORKERS IN A ROW '
+                      f'DIED AT STARTUP, STOPPING', flush=True)
+                raise KeyboardInterrupt
+            print(f'WORKER {n} PID {pid} EXITED WITH STATUS {status}, RESTARTING', flush=True)
+            if failures:
+                time.sleep(1.0) # do not spin on a worker that dies at startup
+            spawn(n)
+
+        def roll():
+            gid = self._gens.current().id
+            gc.unfreeze()
+            self._gens.reload(wait=True)
+            gc.freeze()
+            if self._gens.current().id == gid:
+                print(f'RELOAD FAILED, KEEPING GENERATION {gid}: {self._gens.lastError}', flush=True)
+                return
+            for pid in list(children):
+                n, started = children.pop(pid)
+                retiring.add(pid)
+                spawn(n)
+                os.kill(pid, signal.SIGHUP)
+
+        # SIGHUP and SIGCHLD stay blocked and are taken one at a time by
+        # sigwaitinfo, so neither can interrupt reaping or a reload; the
+        # children are reaped without blocking as SIGCHLDs coalesce
+        signal.pthread_sigmask(signal.SIG_BLOCK, waited)
+        for n in range(workers):
+            spawn(n)
+        signal.signal(signal.SIGTERM, terminate)
+        try:
+            while children or retiring:
+                info = signal.sigwaitinfo(waited)
+                if info.si_signo == signal.SIGHUP:
+                    roll()
+                    continue
+                while children or retiring:
+                    pid, status = os.waitpid(-1, os.WNOHANG)
+                    if pid == 0:
+                        break
+                    exited(pid, status)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN) # finish stopping the workers
+            for pid in list(children) + list(retiring):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for pid in list(children) + list(retiring):
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+            shutil.rmtree(shared, ignore_errors=True)
+        return failures < WORKER_FAILURES
+
 class RequestHandler(BaseHTTPRequestHandler):
     _startTime = datetime.now()
+    protocol_version = 'HTTP/1.1' # needed for chunked responses
 
-    def __init__(self, prefixes, records, searcher, dbconn, *args):
-        self._searcher = searcher
-        self._prefixes = prefixes
-        self._records = records
-        self._dbconn  = dbconn
+    def __init__(self, gens, qcache, slowlog, startup, reload, segments, *args):
+        self._gens = gens
+        self._qcache = qcache
+        self._slowlog = slowlog
+        self._startup = startup
+        self._reload = reload
+        self._segments = segments
         BaseHTTPRequestHandler.__init__(self, *args)
 
     def _getResponseTemplate(self):
         return {'data':[], 'message':'', 'count':'0', 'status':'ok'}
 
-    def _prepareResponse(self, code):
+    def _prepareResponse(self, code, length=None, contentType='application/json; charset=utf-8'):
+        metrics.REQUESTS.add(1, self.command, str(code))
+        trace = metrics.currentTrace()
+        if trace is not None:
+            trace['status'] = code
         self.send_response(code)
-        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Content-type', contentType)
+        if length is None:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(length))
         self.end_headers()
 
+    def _sendResponse(self, code, body, contentType='application/json; charset=utf-8'):
+        self._prepareResponse(code, len(body), contentType)
+        self.wfile.write(body)
+
+    def _health(self, path):
+        # /live answers while the process serves at all, /ready only once
+        # the first generation and the model are loaded and warmed
+        d = self._getResponseTemplate()
+        d['count'] = 1
+        d['data'] = [self._startup.stats()]
+        ok = path == '/live' or self._startup.ready
+        d['message'] = 'live' if path == '/live' else 'ready' if ok else self._startup.error or 'starting'
+        if not ok:
+            d['status'] = 'failed'
+        self._sendResponse(200 if ok else 503, bytes(json.dumps(d), "utf-8"))
+
+    def _notReady(self):
+        # everything but health, metrics and profiles waits for the startup
+        if self._startup.ready:
+            return False
+        d = self._getResponseTemplate()
+        d['status'] = 'failed'
+        d['message'] = self._startup.error or 'starting'
+        self.close_connection = True # the request body is not read
+        self._sendResponse(503, bytes(json.dumps(d), "utf-8"))
+        return True
+
     def do_GET(self):
         print("GET request,\nPath: %s\nHeaders:\n%s\n", str(self.path), str(self.headers))
-        self._prepareResponse(200)
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            # with -workers the totals of all of them, whichever answers
+            self._sendResponse(200, metrics.REGISTRY.expose().encode('utf-8'), metrics.CONTENT_TYPE)
+            return
+        if url.path == '/admin/profile':
+            self._profile(parse_qs(url.query))
+            return
+        if url.path in ('/live', '/ready'):
+            self._health(url.path)
+            return
+        if self._notReady():
+            return
+        gen = self._gens.current()
+        searcher = gen.searcher
         d = self._getResponseTemplate()
         d['message'] = f'hearbeat, uptime: {datetime.now() - self._startTime}'
-        self.wfile.write(bytes(json.dumps(d), "utf-8"))
+        d['generation'] = gen.id
+        if self.path == '/cachestats' and isinstance(searcher, (SearchWrapper, BatchScheduler)):
+            d['count'] = 1
+            d['data'] = [searcher.cacheStats()]
+            d['message'] = 'embedding cache stats request'
+        elif self.path == '/querycachestats' and self._qcache is not None:
+            d['count'] = 1
+            d['data'] = [self._qcache.stats()]
+            d['message'] = 'query cache stats request'
+        elif self.path == '/batchstats' and isinstance(searcher, BatchScheduler):
+            d['count'] = 1
+            d['data'] = [searcher.stats()]
+            d['message'] = 'batch stats request'
+        elif self.path == '/admin/generation':
+            d['count'] = 1
+            d['data'] = [self._gens.stats()]
+            d['message'] = 'generation request'
+        elif self.path == '/admin/segments' and self._segments is not None:
+            d['count'] = 1
+            d['data'] = [self._segments.stats()]
+            d['message'] = 'segments request'
+        self._sendResponse(200, bytes(json.dumps(d), "utf-8"))
+
+    def _profile(self, args):
+        # /admin/profile?seconds=10&requests=0&interval=0.005&idle=0 samples
+        # this process and answers with collapsed stacks for a flame graph
+        d = self._getResponseTemplate()
+        try:
+            seconds = float(args.get('seconds', ['10'])[0])
+            requests = int(args.get('requests', ['0'])[0])
+            interval = max(0.001, float(args.get('interval', ['0.005'])[0]))
+            idle = args.get('idle', ['0'])[0] not in ('0', '', 'false')
+        except ValueError as e:
+            d['status'] = 'failed'
+            d['message'] = f'invalid profile arguments: {e}'
+            self._sendResponse(400, bytes(json.dumps(d), "utf-8"))
+            return
+        stacks = PROFILER.profile(seconds, requests, interval, idle)
+        if stacks is None:
+            d['status'] = 'failed'
+            d['message'] = 'a profile is already running'
+            self._sendResponse(409, bytes(json.dumps(d), "utf-8"))
+            return
+        self._sendResponse(200, stacks.encode('utf-8'), 'text/plain; charset=utf-8')
+
+    def _adminReload(self):
+        # POST /admin/reload, the body may name new files:
+        # {"index": DIR, "records": FILE, "prefixes": FILE, "snapshot": FILE}
+        # files named without a snapshot replace the one being served. a
+        # file reloaded under the same path must have been replaced by a
+        # rename, the old generation keeps the old one mapped until drained
+        cl = int(self.headers['Content-Length'] or 0)
+        d = self._getResponseTemplate()
+        try:
+            j = json.loads(self.rfile.read(cl).decode('utf-8')) if cl else {}
+            if not isinstance(j, dict) or set(j) - RELOAD_PATHS:
+                raise ValueError(f'expected an object with any of {sorted(RELOAD_PATHS)}')
+            if j and 'snapshot' not in j:
+                j['snapshot'] = None
+        except ValueError as e:
+            d['status'] = 'failed'
+            d['message'] = f'invalid reload request: {e}'
+            self._sendResponse(400, bytes(json.dumps(d), "utf-8"))
+            return
+        if j and self._segments is not None:
+            d['status'] = 'failed'
+            d['message'] = 'the files are those of the -segments manifest, POST /admin/compact makes new ones'
+            self._sendResponse(409, bytes(json.dumps(d), "utf-8"))
+            return
+        ok, d['message'] = self._reload(j)
+        d['generation'] = self._gens.current().id
+        if not ok:
+            d['status'] = 'failed'
+        self._sendResponse(202 if ok else 409, bytes(json.dumps(d), "utf-8"))
+
+    def _ingest(self):
+        # POST /admin/ingest {"add": [records], "delete": [record ids]}:
+        # the records are searchable once it answered, no rebuild involved
+        cl = int(self.headers['Content-Length'] or 0)
+        body = self.rfile.read(cl)
+        d = self._getResponseTemplate()
+        if self._segments is None:
+            d['status'] = 'failed'
+            d['message'] = 'ingest needs -segments'
+            self._sendResponse(404, bytes(json.dumps(d), "utf-8"))
+            return
+        try:
+            result = self._segments.ingest(json.loads(body.decode('utf-8')))
+        except ValueError as e:
+            d['status'] = 'failed'
+            d['message'] = f'invalid ingest request: {e}'
+            self._sendResponse(400, bytes(json.dumps(d), "utf-8"))
+            return
+        d['count'] = 1
+        d['data'] = [result]
+        d['message'] = 'ingest request'
+        d['generation'] = self._gens.current().id
+        self._sendResponse(200, bytes(json.dumps(d), "utf-8"))
+
+    def _compact(self):
+        # POST /admin/compact merges the delta segments into a new base
+        d = self._getResponseTemplate()
+        ok, d['message'] = self._segments.compact() if self._segments is not None else (False, 'compaction needs -segments')
+        if not ok:
+            d['status'] = 'failed'
+        self._sendResponse(202 if ok else 409, bytes(json.dumps(d), "utf-8"))
 
     def do_POST(self):
+        if self._notReady():
+            return
+        path = urlsplit(self.path).path
+        if path == '/admin/reload':
+            self._adminReload()
+            return
+        if path == '/admin/ingest':
+            self._ingest()
+            return
+        if path == '/admin/compact':
+            self.rfile.read(int(self.headers['Content-Length'] or 0))
+            self._compact()
+            return
+        t = time.perf_counter()
+        metrics.IN_FLIGHT.add(1)
+        trace = metrics.startTrace()
+        try:
+            self._search()
+        finally:
+            metrics.endTrace()
+            metrics.IN_FLIGHT.add(-1)
+            elapsed = time.perf_counter() - t
+            metrics.REQUEST_SECONDS.observe(elapsed)
+            PROFILER.requestDone()
+            if self._slowlog is not None:
+                self._slowlog.check(elapsed, trace)
+
+    def _search(self):
         cl = int(self.headers['Content-Length'])
         pd = self.rfile.read(cl).decode('utf-8') # read request body
         print(f'CONTENT LENGTH: {cl}\nBODY: {pd}\nHEADERS: {str(self.headers)}')
@@ -91,92 +452,436 @@ class RequestHandler(BaseHTTPRequestHandler):
         d['message'] = 'search request'
 
         try:
-            j = json.loads(pd)
-        except:
+            with metrics.STAGE_SECONDS.time('parse'):
+                j = json.loads(pd)
+                if not isinstance(j, dict):
+                    raise ValueError('query must be a json object')
+                offset, limit = pageRequest(j)
+                getNeighbourLimit(j)
+        except ValueError as e:
             d['status'] = 'failed'
-            d['message'] = 'invalid query or invalid json syntaxis'
-            self._prepareResponse(400)
-            self.wfile.write(bytes(json.dumps(d), "utf-8"))
+            d['message'] = f'invalid query or invalid json syntaxis: {e}'
+            self._sendResponse(400, bytes(json.dumps(d), "utf-8"))
             return
 
-        results = runQuery(j, self._searcher, self._prefixes, self._dbconn)
+        gen = self._gens.acquire()
+        try:
+            self._searchGeneration(gen, j, offset, limit)
+        finally:
+            self._gens.release(gen)
+
+    def _searchGeneration(self, gen, j, offset, limit):
+        # everything the request reads comes from gen, a reload swapping in
+        # the next generation meanwhile does not change it under us
+        d = self._getResponseTemplate()
+        d['message'] = 'search request'
+        d['generation'] = gen.id
+        trace = metrics.currentTrace()
+        if trace is not None:
+            trace['query'] = j
+            trace['generation'] = gen.id
+        stream = isStreaming(j)
+        version = gen.id if gen.segments is None else f'{gen.id}.{gen.segments.version}' # ingests change results
+        key = f'{version}:{canonicalQuery(j)}' if self._qcache is not None and not stream else None
+        body = self._qcache.get(key) if key is not None else None
+        if body is not None and trace is not None:
+            trace['cached'] = True
+        if body is None:
+            plan = {} if j.get('debug') else None
+            results = runQuery(j, gen.searcher, gen.prefixes, gen.pdict, plan)
+            page, cursor = pageResults(j, results, offset, limit)
+
+            d['total'] = 0 if results is None else len(results)
+            if cursor:
+                d['next_cursor'] = cursor
+            if plan is not None:
+                d['plan'] = plan.get('plan')
+            d['count'] = 0 if page is None else len(page)
+            metrics.RESULT_ROWS.observe(d['total'])
+            metrics.RETURNED_ROWS.observe(d['count'])
+            if trace is not None:
+                trace['total'] = d['total']
+                trace['count'] = d['count']
+            if stream:
+                # records are fetched and spliced in as they are written
+                self._prepareResponse(200)
+                with metrics.STAGE_SECONDS.time('stream'):
+                    writeChunked(self.wfile, streamEnvelope(d, iterBlobs(j, page, gen.records)))
+                return
+            with metrics.STAGE_SECONDS.time('fetch'):
+                blobs = list(iterBlobs(j, page, gen.records))
+            with metrics.STAGE_SECONDS.time('serialize'):
+                body = envelope(d, blobs)
+            if key is not None:
+                self._qcache.put(key, body)
+        self._sendResponse(200, body)
+
+class NeighbourTable:
+    # neighbours within the build time MAT of every indexed label, written
+    # by create_embedding_store.py -neighbours or a compaction, nearest first per label;
+    # z is the loaded npz or the same arrays mapped from a snapshot
+    def __init__(self, z):
+        self.offsets = z['offsets']
+        self.labels = z['labels']
+        self.distances = z['distances']
+        self.mat = float(z['mat'])
 
-        lst = fetchRecords(j, results, self._records)
-        #if len(lst) and isinstance(lst[0], dict):
-        #    lst = sorted(lst, key=lambda x: x['name'])
-        d['count'] = len(lst)
-        d['data'] = lst
-        #for i in range(len(lst))
-        #    d['data'].append(lst[i])
-        self._prepareResponse(200)
-        self.wfile.write(bytes(json.dumps(d), "utf-8"))
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, label, cap=None):
+        s, e = self.offsets[label], self.offsets[label + 1]
+        return self.distances[s:e][:cap], self.labels[s:e][:cap]
 
 class FaissIndexWrapper:
     def __init__(self, indexer, distance):
         self.indexer = indexer
         self.distance = distance
+        self.neighbours = None
+        self.params = None # search parameters, the IDSelector of tombstoned labels
+        self.path = None # file the index is mapped from
+
+    def __len__(self):
+        return self.indexer.ntotal
 
     def search(self, xq):
-        return self.indexer.search(xq, self.distance)
+        return self.searchK(xq, self.distance)
+
+    def searchK(self, xq, k):
+        if self.params is None:
+            return self.indexer.search(xq, k)
+        return self.indexer.search(xq, k, params=self.params)
+
+    def rangeSearch(self, xq, radius, cap):
+        # faiss keeps results strictly below the radius, MAT is inclusive
+        r = float(np.nextafter(np.float32(radius), np.float32(np.inf)))
+        try:
+            if self.params is None:
+                lims, D, I = self.indexer.range_search(xq, r)
+            else:
+                lims, D, I = self.indexer.range_search(xq, r, params=self.params)
+        except RuntimeError: # index type without range search support
+            return escalatingSearch(self.searchK, xq, radius, self.distance, cap, self.indexer.ntotal)
+        Ds, Is = [], []
+        for i in range(len(xq)):
+            d, l = D[lims[i]:lims[i + 1]], I[lims[i]:lims[i + 1]]
+            order = np.argsort(d, kind='stable')[:cap]
+            Ds.append(d[order])
+            Is.append(l[order])
+        return Ds, Is
 
 class HnswIndexWrapper:
     def __init__(self, indexer, distance):
         self.indexer = indexer
         self.distance = distance
+        self.neighbours = None
+        self.deleted = 0 # labels marked deleted (tombstones), still counted by the index
         indexer.set_ef(50)
         print(f'NUMBER OF THREADS {indexer.num_threads}\n', flush=True)
         # indexer.set_num_threads(8)
 
+    def __len__(self):
+        return self.indexer.get_current_count()
+
+    def live(self):
+        return self.indexer.get_current_count() - self.deleted
+
     def search(self, xq):
-        labels, distances = self.indexer.knn_query(xq, self.distance)
+        return self.searchK(xq, self.distance)
+
+    def searchK(self, xq, k):
+        # knn_query raises when k is more than the labels not deleted
+        k = min(k, self.live())
+        if k <= 0:
+            return np.empty((len(xq), 0), dtype=np.float32), np.empty((len(xq), 0), dtype=np.uint64)
+        labels, distances = self.indexer.knn_query(xq, k)
         return distances, labels
 
+    def rangeSearch(self, xq, radius, cap):
+        return escalatingSearch(self.searchK, xq, radius, self.distance, cap, self.live())
+
+class EmbeddingCache:
+    # thread safe LRU of normalized term -> query vector, bounded by bytes;
+    # keys carry the model name so a model change never serves stale vectors
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self, modelName, maxBytes):
+        self._modelName = modelName
+        self._maxBytes = maxBytes
+        self._map = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _entrySize(self, key, vec):
+        return vec.nbytes + len(key[1]) + self.ENTRY_OVERHEAD
+
+    def get(self, term):
+        key = (self._modelName, term)
+        with self._lock:
+            vec = self._map.get(key)
+            if vec is None:
+                self.misses += 1
+                return None
+            self._map.move_to_end(key)
+            self.hits += 1
+            return vec
+
+    def put(self, term, vec):
+        key = (self._modelName, term)
+        sz = self._entrySize(key, vec)
+        if sz > self._maxBytes:
+            return
+        with self._lock:
+            old = self._map.pop(key, None)
+            if old is not None:
+                self._bytes -= self._entrySize(key, old)
+            self._map[key] = vec
+            self._bytes += sz
+            while self._bytes > self._maxBytes:
+                k, v = self._map.popitem(last=False)
+                self._bytes -= self._entrySize(k, v)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'model': self._modelName, 'entries': len(self._map), 'bytes': self._bytes,
+                    'max_bytes': self._maxBytes, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
 class SearchWrapper:
-    def __init__(self, indexerWrapper, embModel):
+    def __init__(self, indexerWrapper, embModel, cache=None, kmax=KMAX):
         self.indexerWrapper = indexerWrapper
         self.embModel = embModel
+        self.cache = cache
+        self.kmax = kmax
 
     def search(self, q):
-        xq = self.embModel.encode([q]) # query
-        return self.indexerWrapper.search(xq)
+        return self.searchBatch([q])
 
-class setOp:
-    def __init__(self, op):
-        self.__op = op
-        self.__myset = None
+    def encode(self, qs):
+        # terms are encoded folded with or without the cache, so that
+        # 'Name:Mustafa ' and 'name:mustafa' share one cache entry and the
+        # cache never changes what a term is encoded as
+        terms = [foldTerm(q) for q in qs]
+        if self.cache is None:
+            return self.embModel.encode(terms)
+        vecs = [self.cache.get(t) for t in terms]
+        missing = list(dict.fromkeys(t for t, v in zip(terms, vecs) if v is None))
+        if missing:
+            encoded = dict(zip(missing, self.embModel.encode(missing)))
+            for t, v in encoded.items():
+                self.cache.put(t, v.copy()) # do not pin the whole batch array
+            vecs = [v if v is not None else encoded[t] for t, v in zip(terms, vecs)]
+        return np.stack(vecs)
 
-    def setOperation(self, st):
-        if self.__myset is not None and st is not None:
-            self.__myset = self.__myset.intersection(st) if self.__op == 'and' else self.__myset.union(st)
-        else:
-            self.__myset = st
-        return self.__myset
+    def clampCap(self, cap):
+        # neighbours per term a search with cap returns at most, the fixed
+        # k of a knn search (kmax 0) whatever the cap
+        if self.kmax <= 0:
+            return self.indexerWrapper.distance
+        return self.kmax if cap is None else max(1, min(cap, self.kmax))
+
+    def searchBatch(self, qs, cap=None):
+        # returns per query arrays of distances and labels within MAT,
+        # nearest first; with kmax 0 it is a fixed DISTANCE knn search
+        with metrics.STAGE_SECONDS.time('encode'):
+            xq = self.encode(qs) # one forward pass for all cache misses
+        with metrics.STAGE_SECONDS.time('ann'):
+            if self.kmax > 0:
+                return self.indexerWrapper.rangeSearch(xq, MAT, self.clampCap(cap))
+            D, I = self.indexerWrapper.search(xq)
+        return list(D), list(I)
+
+    def setModel(self, embModel):
+        self.embModel = embModel
+
+    def cacheStats(self):
+        return self.cache.stats() if self.cache is not None else {}
+
+    def neighbourTable(self):
+        return self.indexerWrapper.neighbours
+
+class BatchJob:
+    def __init__(self, terms, cap):
+        self.terms = terms
+        self.cap = cap
+        self.D = None
+        self.I = None
+        self.error = None
+        self.trace = None
+        self.done = threading.Event()
+
+class BatchScheduler:
+    # owns the searcher and groups terms submitted by concurrent request
+    # threads into one encoder forward pass and one index search
+    def __init__(self, searcher, maxBatch, maxWait):
+        self._searcher = searcher
+        self._maxBatch = max(1, maxBatch)
+        self._maxWait = max(0.0, maxWait) / 1000.0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+        self._bounds = [1 << i for i in range(self._maxBatch.bit_length())]
+        if self._bounds[-1] < self._maxBatch:
+            self._bounds.append(self._maxBatch)
+        self._buckets = [0] * (len(self._bounds) + 1)
+        self._batches = 0
+        self._batchedTerms = 0
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join()
+
+    def searchBatch(self, terms, cap=None):
+        job = BatchJob(terms, cap)
+        with self._cond:
+            self._pending.append(job)
+            self._cond.notify()
+        job.done.wait()
+        metrics.addTrace(job.trace)
+        if job.error is not None:
+            raise job.error
+        return job.D, job.I
+
+    def search(self, q):
+        return self.searchBatch([q])
 
-    def __call__(self, st):
-        return self.setOperation(st)
-    def __str__(self):
-        return f'{__class__.__name__}.{self.__op}'
+    def setModel(self, embModel):
+        self._searcher.setModel(embModel)
 
-    @property
-    def results(self):
-        return self.__myset
+    def clampCap(self, cap):
+        return self._searcher.clampCap(cap)
+
+    def cacheStats(self):
+        return self._searcher.cacheStats()
+
+    def neighbourTable(self):
+        return self._searcher.neighbourTable()
+
+    def _nextBatch(self):
+        with self._cond:
+            while self._running and not self._pending:
+                self._cond.wait()
+            if not self._pending:
+                return []
+            deadline = time.monotonic() + self._maxWait
+            jobs = [self._pending.popleft()]
+            size = len(jobs[0].terms)
+            while size < self._maxBatch:
+                if not self._pending:
+                    left = deadline - time.monotonic()
+                    if left <= 0 or not self._running:
+                        break
+                    self._cond.wait(left)
+                    continue
+                if size + len(self._pending[0].terms) > self._maxBatch:
+                    break
+                job = self._pending.popleft()
+                jobs.append(job)
+                size += len(job.terms)
+            return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._nextBatch()
+            if not jobs:
+                return
+            # identical terms from different requests share one row
+            rows = {}
+            for job in jobs:
+                for t in job.terms:
+                    rows.setdefault(t, len(rows))
+            caps = [self._searcher.clampCap(job.cap) for job in jobs]
+            trace = metrics.startTrace() # encode/ann timings of this batch
+            try:
+                # run with the largest cap, results are nearest first so
+                # each job is cut back to its own cap
+                D, I = self._searcher.searchBatch(list(rows), None if None in caps else max(caps))
+                for job, cap in zip(jobs, caps):
+                    idx = [rows[t] for t in job.terms]
+                    job.D = [D[r][:cap] for r in idx]
+                    job.I = [I[r][:cap] for r in idx]
+            except Exception as e:
+                for job in jobs:
+                    job.error = e
+            metrics.endTrace()
+            self._observe(len(rows))
+            for job in jobs:
+                job.trace = trace
+                job.done.set()
+
+    def _observe(self, size):
+        i = 0
+        while i < len(self._bounds) and size > self._bounds[i]:
+            i += 1
+        self._buckets[i] += 1
+        self._batches += 1
+        self._batchedTerms += size
+
+    def stats(self):
+        hist = {}
+        cumulative = 0
+        for b, c in zip(self._bounds + ['+Inf'], self._buckets):
+            cumulative += c
+            hist[str(b)] = cumulative
+        return {'max_batch': self._maxBatch, 'max_wait_ms': self._maxWait * 1000.0,
+                'batches': self._batches, 'terms': self._batchedTerms,
+                'pending': len(self._pending), 'batch_size_histogram': hist}
 
 #==============================================================================
-def fetchRecords(query_json, results, recs):
-    lst = []
+def iterRecords(query_json, results, recs):
     filter_fields = query_json['filter_fields'] \
                    if 'filter_fields' in query_json and \
                    isinstance(query_json['filter_fields'], list) else []
-    if not results:
-        return lst
-    for i in results:
+    if results is None or not len(results):
+        return
+    for i in toIds(results):
         rec1 = recs[i]
         rec2 = {}
         for f in filter_fields:
             rec2[f] = rec1[f] if f in rec1 else f'unknown field{f}'
-        lst.append(rec2 if rec2 else rec1)
+        yield rec2 if rec2 else rec1
+
+#==============================================================================
+def fetchRecords(query_json, results, recs):
+    return list(iterRecords(query_json, results, recs))
 
-    return lst
+#==============================================================================
+def iterBlobs(query_json, results, recs):
+    # same records as iterRecords but as JSON bytes for the response: whole
+    # records are the file lines as they are, projections are joined from
+    # per record/field fragments cached by the record store
+    filter_fields = query_json['filter_fields'] \
+                   if 'filter_fields' in query_json and \
+                   isinstance(query_json['filter_fields'], list) else []
+    if results is None or not len(results):
+        return
+    if not filter_fields:
+        for i in toIds(results):
+            yield recs.blob(i)
+        return
+    fields = list(dict.fromkeys(filter_fields))
+    missing = [(json.dumps(str(f)) + ': ' + json.dumps(f'unknown field{f}')).encode('utf-8') for f in fields]
+    for i in toIds(results):
+        frags = recs.fragments(i, fields)
+        yield b'{' + b', '.join(m if frag is None else frag for frag, m in zip(frags, missing)) + b'}'
+#==============================================================================
+def foldTerm(term):
+    # case and whitespace folding only, prefix keys are lower case already
+    return ' '.join(term.split()).lower()
 #==============================================================================
 def isWildCardPresent(term):
         return re.match(wc_rx, term)
@@ -184,105 +889,193 @@ def isWildCardPresent(term):
 def isNotConditionPresent(term):
     return re.match(not_rx, term)
 #==============================================================================
-def pfxsToDb(pfxs):
-    dbname = ':memory:' #'pfxs.db'
-    sql = 'create table if not exists pfx(id integer primary key autoincrement , prefix text);'
-    sqlite3.threadsafety = 3
-    conn = sqlite3.connect(dbname, check_same_thread = False)
-    conn.execute(sql)
-    # conn.execute('delete from pfx')
-    for pfx in pfxs:
-        sql = f"insert into pfx(prefix) values('{pfx[0]}')"
-        conn.execute(sql)
-
-    conn.commit()
-    return conn
-#==============================================================================
-def wildCardToQueryObj(term, dbconn):
-    t = re.sub(wc_rx_q, '_', re.sub(wc_rx_a, '%', term))
-    #print(t)
-
-    recs = dbconn.execute(f""" select prefix from pfx where prefix like '{t}'\
-                               order by length(prefix) limit {WEL}""")
-    lst = []
-    for rec in recs:
-        lst.append(rec[0])
+def wildCardToQueryObj(term, pdict):
+    lst = [key for key, row in pdict.match(term, WEL)]
     return {"or":lst}, len(lst) > 0
 
 #==============================================================================
-def notToQueryObj(term, dbconn):
-    t = re.match(not_rx, re.sub(wc_rx_q, '_', re.sub(wc_rx_a, '%', term))).group(1)
+def notToNegation(term, pdict, fuzzy=False):
+    # '!field:value' is every record having field minus the ones matching
+    # field:value, a wildcard value is matched lexically and in full
+    t = re.match(not_rx, term).group(1)
     ss = t.split(':')
-    prefix = f" like '{':'.join(ss[:len(ss) - 1])}%' and prefix " if len(ss) > 1 else ''
-    sql = f"""select prefix from pfx where prefix {prefix}
-              not like '{t}' order by prefix limit {NEL}"""
-
-    recs = dbconn.execute(sql)
-    lst = []
-    for rec in recs:
-        lst.append(rec[0])
-    return {"or":lst}, len(lst) > 0
+    field = ':'.join(ss[:len(ss) - 1]) if len(ss) > 1 else ''
+    row = None if fuzzy else pdict.get(t)
+    if isWildCardPresent(t):
+        rows = pdict.matchAll(t)
+        match = (pdict.size(rows), lambda: pdict.postings(rows))
+        metrics.traceExpansion(term, len(rows))
+    elif row is not None:
+        match = (pdict.size([row]), lambda: pdict.postings([row]))
+    else:
+        match = t
+    universe = pdict.universe(field)
+    return Negation(match, (len(universe), lambda: universe))
 
 #==============================================================================
-def runQuery(q, searcher, prefixes, dbconn):
-
-    # do query validation somewhere here
-    # each query is map of list and each list may contain
-    # strings to search or other maps of list
-    # each map can have only "and" or "or" as keys
-    # so below we expect to see only single key - "and" or "or"
-    cnt = 1
+def collectTerms(q, pdict, expanded, exact, terms, fuzzy=False):
+    # first pass over the query tree: expand wildcard and not leaves,
+    # resolve terms that are prefix keys verbatim and collect every leaf
+    # that still needs a semantic lookup, so that all of them can be
+    # encoded and searched in one batch. fuzzy sends verbatim keys to the
+    # semantic search too; wildcard expansions are always exact keys
     for k in q:
         if k not in SET_OPERANDS:
             continue
-        op = setOp(k)
-        print(f'{k} -> {q[k]} {op}')
         for qq in q[k]:
             if isinstance(qq, str):
-                sys.stdout.write(f'{cnt}\n')
-
+                if qq in expanded:
+                    continue
                 if isNotConditionPresent(qq):
-                    obj, ok = notToQueryObj(qq, dbconn)
-                    if ok:
-                        op(runQuery(obj, searcher, prefixes, dbconn))
+                    expanded[qq] = neg = notToNegation(qq, pdict, fuzzy)
+                    if isinstance(neg.match, str):
+                        terms[neg.match] = None
+                    continue
                 elif isWildCardPresent(qq):
-                    obj, ok = wildCardToQueryObj(qq, dbconn)
-                    if ok:
-                        op(runQuery(obj, searcher, prefixes, dbconn))
-                else:
-                    D, I = searcher.search(qq)
-                    # print(f'D {D[0]}\nI {I[0]}\n')
-                    rec = filterRecordByDistance(D[0], I[0], prefixes)
-                    if isinstance(rec, list):
-                        op(set(rec))
-                '''
-                if not isWildCardPresent(qq):
-                    D, I = searcher.search(qq)
-                    rec = filterRecordByDistance(D[0], I[0], prefixes)
-                    if isinstance(rec, list):
-                        op(set(rec))
+                    obj, ok = wildCardToQueryObj(qq, pdict)
+                    metrics.traceExpansion(qq, len(obj['or']))
                 else:
-                    obj, ok = wildCardToQueryObj(qq, dbconn)
-                    if ok:
-                        op(runQuery(obj, searcher, prefixes, dbconn))
-                '''
-                cnt += 1
+                    row = None if fuzzy else pdict.get(qq)
+                    if row is not None:
+                        exact[qq] = row
+                    else:
+                        terms[qq] = None
+                    continue
+                expanded[qq] = obj if ok else None
+                if ok:
+                    collectTerms(obj, pdict, expanded, exact, terms)
             elif isinstance(qq, dict):
-                op(runQuery(qq, searcher, prefixes, dbconn))
-    # print(f'OP: {op.results}')
-    return op.results
+                collectTerms(qq, pdict, expanded, exact, terms, fuzzy)
+    return terms
+
+#==============================================================================
+def searchTerms(terms, searcher, prefixes, pdict, cap=None):
+    # terms naming an indexed label take its precomputed neighbours,
+    # cut like a search would be; only the rest is encoded and searched.
+    # a term is its label when it folds to the key (the text encoded is
+    # the folded term, see SearchWrapper.encode)
+    found = {}
+    table = searcher.neighbourTable()
+    live = []
+    t = time.perf_counter()
+    for term in terms:
+        row = pdict.getFolded(foldTerm(term)) if table is not None else None
+        hit = table.get(row, searcher.clampCap(cap)) if row is not None and row < len(table) else None
+        if hit is not None and len(hit[1]): # a label is its own neighbour, none: no vector since a compaction
+            found[term] = filterRecordByDistance(*hit, prefixes)
+        else:
+            live.append(term)
+    if table is not None: # a stage of its own, the live search below is 'ann'
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - t, 'neighbours')
+    if not live:
+        return found
+    D, I = searcher.searchBatch(live, cap)
+    for i, term in enumerate(live):
+        found[term] = filterRecordByDistance(D[i], I[i], prefixes)
+    return found
+
+#==============================================================================
+def runQuery(q, searcher, prefixes, pdict, plan=None):
+
+    # each query is map of list and each list may contain
+    # strings to search or other maps of list
+    # each map can have only "and" or "or" as keys
+    expanded = {}
+    exact = {}
+    with metrics.STAGE_SECONDS.time('expand'):
+        terms = list(collectTerms(q, pdict, expanded, exact, {}, isFuzzy(q)))
+    found = searchTerms(terms, searcher, prefixes, pdict, getNeighbourLimit(q))
+
+    with metrics.STAGE_SECONDS.time('setops'):
+        return planQuery(q, queryLeaves(expanded, exact, found, prefixes), plan)
+
+#==============================================================================
+def queryLeaves(expanded, exact, found, prefixes):
+    # leaf(term) for planQuery: expanded wildcard/not terms, semantic
+    # matches found by searchTerms, the rest are verbatim prefix keys
+    def leaf(term):
+        if term in expanded:
+            return expanded[term]
+        if term in found:
+            return len(found[term]), lambda: found[term]
+        return len(prefixes[exact[term]][1]), lambda: prefixes[exact[term]][1]
+    return leaf
+
+#==============================================================================
+def runQueries(qs, searcher, prefixes, pdict):
+    # runQuery over many queries at once (offline -query runs): the semantic
+    # terms of all of them go through one encoder pass and index search per
+    # neighbour cap; a query that fails gets its exception as its result
+    states = []
+    byCap = {}
+    with metrics.STAGE_SECONDS.time('expand'):
+        for q in qs:
+            expanded = {}
+            exact = {}
+            try:
+                terms = collectTerms(q, pdict, expanded, exact, {}, isFuzzy(q))
+                cap = getNeighbourLimit(q)
+            except Exception as e:
+                states.append(e)
+                continue
+            byCap.setdefault(cap, {}).update(terms)
+            states.append((expanded, exact, cap))
+    found = {cap: searchTerms(list(terms), searcher, prefixes, pdict, cap) for cap, terms in byCap.items()}
+
+    results = []
+    with metrics.STAGE_SECONDS.time('setops'):
+        for q, state in zip(qs, states):
+            if isinstance(state, Exception):
+                results.append(state)
+                continue
+            expanded, exact, cap = state
+            try:
+                results.append(planQuery(q, queryLeaves(expanded, exact, found[cap], prefixes)))
+            except Exception as e:
+                results.append(e)
+    return results
 
 #==============================================================================
 def filterRecordByDistance(distances, offsets, prefixes):
-    lst = []
-    for idx in range(len(distances)):
-       if distances[idx] <= MAT:
-           print(f'PFX: {prefixes[offsets[idx]][0]}\t{distances[idx]}')
-           lst.extend(prefixes[offsets[idx]][1])
-    return lst
+    keep = np.asarray(offsets)[(np.asarray(distances) <= MAT) & (np.asarray(offsets) >= 0)]
+    return unionAll([prefixes[i][1] for i in keep.tolist()])
 
 #==============================================================================
-def searchIdx(prefixes, recs, searcher, dbconn):
+def escalatingSearch(searchK, xq, radius, k, cap, total):
+    # knn with a growing k, a query is finished once its farthest returned
+    # neighbour is beyond the radius or k reached the cap
+    n = len(xq)
+    if total <= 0:
+        return [np.empty(0, dtype=np.float32)] * n, [np.empty(0, dtype=np.int64)] * n
+    Ds, Is = [None] * n, [None] * n
+    rows = np.arange(n)
+    limit = max(1, min(cap, total))
+    k = min(k, limit)
+    while len(rows):
+        D, I = searchK(xq[rows], k)
+        D, I = np.asarray(D), np.asarray(I)
+        done = (D[:, -1] > radius) | (k >= limit)
+        for r, d, l in zip(rows[done], D[done], I[done]):
+            m = (d <= radius) & (l >= 0)
+            Ds[r], Is[r] = d[m], l[m]
+        rows = rows[~done]
+        k = min(k * 2, limit)
+    return Ds, Is
+
+#==============================================================================
+def isFuzzy(query_json):
+    return 'fuzzy' in query_json and query_json['fuzzy'] is True
+
+#==============================================================================
+def getNeighbourLimit(query_json):
+    # the query's neighbour cap or None; raises ValueError on a bad one
+    kmax = query_json.get('kmax')
+    if kmax is not None and (not isinstance(kmax, int) or isinstance(kmax, bool) or kmax < 1):
+        raise ValueError('kmax must be a positive integer')
+    return kmax
+
+#==============================================================================
+def searchIdx(prefixes, recs, searcher, pdict):
     print( "Enter your query below or 'q' to quit:")
 
     for line in sys.stdin:
@@ -298,9 +1091,13 @@ def searchIdx(prefixes, recs, searcher, dbconn):
             print(f'invalid query or invalid json syntaxis')
             continue
 
-        results = runQuery(json.loads(q), searcher, prefixes, dbconn)
+        try:
+            results = runQuery(j, searcher, prefixes, pdict)
+        except ValueError as e:
+            print(f'invalid query: {e}')
+            continue
         lst = []
-        [lst.append(recs[i]) for i in results]
+        [lst.append(recs[i]) for i in toIds(results)]
         if len(lst) and isinstance(lst[0], dict):
             lst = sorted(lst, key=lambda x: x['name'])
         print(f'TOTAL: {len(lst)}\nRESULTS: ')
@@ -308,6 +1105,65 @@ def searchIdx(prefixes, recs, searcher, dbconn):
         [print(f'{i+1} -> {lst[i]}') for i in range(len(lst))]
         print( "Enter your query below or 'q' to quit: ")
 
+#==============================================================================
+BULK = None # generation of an offline -query run, inherited by its workers
+
+def initBulkWorker(workers):
+    # the parent loaded the model but never ran it before the pool forked
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # the parent stops the run
+    startEncoder(BULK, max(1, (os.cpu_count() or 1) // workers))
+
+#==============================================================================
+def bulkChunk(first, lines):
+    # one chunk of an offline -query run: the queries are run together by
+    # runQueries and each gets the line the server would have answered,
+    # plus its line number in the query file; blank lines are skipped
+    gen = BULK
+    out = []
+    todo = []
+    for n, l in enumerate(lines, first + 1):
+        if not l.strip():
+            continue
+        d = {'data': [], 'message': 'search request', 'count': '0', 'status': 'ok', 'line': n}
+        out.append(d)
+        try:
+            j = json.loads(l)
+            if not isinstance(j, dict):
+                raise ValueError('query must be a json object')
+            offset, limit = pageRequest(j)
+            getNeighbourLimit(j)
+        except ValueError as e:
+            d['status'] = 'failed'
+            d['message'] = f'invalid query or invalid json syntaxis: {e}'
+            continue
+        todo.append((len(out) - 1, j, offset, limit))
+
+    results = runQueries([j for i, j, offset, limit in todo], gen.searcher, gen.prefixes, gen.pdict)
+    for (i, j, offset, limit), res in zip(todo, results):
+        d = out[i]
+        if isinstance(res, Exception):
+            d['status'] = 'failed'
+            d['message'] = f'query failed: {res}'
+            continue
+        page, cursor = pageResults(j, res, offset, limit)
+        d['total'] = 0 if res is None else len(res)
+        if cursor:
+            d['next_cursor'] = cursor
+        d['count'] = 0 if page is None else len(page)
+        out[i] = envelope(d, iterBlobs(j, page, gen.records)) + b'\n'
+    return [d if isinstance(d, bytes) else bytes(json.dumps(d), "utf-8") + b'\n' for d in out]
+
+#==============================================================================
+def bulkQuery(opts, paths, cache, segments=None):
+    global BULK
+    if opts.workers > 0:
+        forkSafeTorch()
+    BULK = loadGeneration(1, paths, opts, None, cache, segments=segments, forked=opts.workers > 0)
+    outFile = opts.outFile or opts.query + '.results.jsonl'
+    print(f'RUNNING {opts.query} INTO {outFile} WITH {opts.workers} WORKERS', flush=True)
+    return runBulk(opts.query, outFile, bulkChunk, opts.workers, max(1, opts.chunk), opts.resume,
+                   (lambda: initBulkWorker(opts.workers)) if opts.workers > 0 else None)
+
 #==============================================================================
 def txtToJson(text):
     ok = True
@@ -337,13 +1193,113 @@ def loadIdx(path, dist, isFaiss):
     print(f"OPTS: {opts}\nPATH: {path}")
     if isFaiss:
         index = FaissIndexWrapper(faiss.read_index(path, faiss.IO_FLAG_MMAP), dist)
+        index.path = path
     else:
         index = hnswlib.Index(space=opts['type'], dim=int(opts['dim']))
         index.load_index(path)
         index.num_threads = int(opts['threads'])
         index = HnswIndexWrapper(index, dist)
+    index.info = opts
+    if opts.get('neighbours'):
+        useNeighbours(index, NeighbourTable(np.load(os.path.join(os.path.dirname(path), opts['neighbours']))))
+    return index
+
+#==============================================================================
+def loadSnapshotIdx(snap, dist):
+    # the index stored in a snapshot, the library is the one it was built with
+    print(f"OPTS: {snap.info}\nSNAPSHOT: {snap.path}")
+    if snap.info.get('idxLib') == 'faiss':
+        index = FaissIndexWrapper(snap.index(), dist)
+    else:
+        index = HnswIndexWrapper(snap.index(), dist)
+    index.info = snap.info
+    z = snap.neighbours()
+    if z is not None:
+        useNeighbours(index, NeighbourTable(z))
     return index
 
+#==============================================================================
+def useNeighbours(index, table):
+    if table.mat >= MAT:
+        index.neighbours = table
+        print(f'NEIGHBOUR TABLE: {len(table)} LABELS, MAT {table.mat}')
+    else:
+        print(f'NEIGHBOUR TABLE IGNORED: BUILT FOR MAT {table.mat} < {MAT}')
+
+#==============================================================================
+def warmSearch(searcher, pfxs):
+    # an encode and search of one key so the first request does not pay for it
+    for pfx in (pfxs[r] for r in range(min(2, len(pfxs)))):
+        if isinstance(pfx, list) and pfx and pfx[0] != KEYS:
+            searcher.searchBatch([str(pfx[0])])
+
+#==============================================================================
+def forkSafeTorch():
+    # before a parent that forks workers loads the model: with one intra-op
+    # thread torch starts no thread pool for the workers to inherit broken,
+    # so the model can be loaded once and its pages shared copy-on-write
+    import torch
+    torch.set_num_threads(1)
+
+#==============================================================================
+def startEncoder(gen, threads):
+    # in a forked worker, the model of a generation loaded with forked=True
+    # gets its torch threads and is warmed here, never in the parent
+    import torch
+    torch.set_num_threads(threads)
+    warmSearch(gen.searcher, gen.prefixes)
+
+#==============================================================================
+def loadGeneration(gid, paths, opts, model, cache, times=None, segments=None, forked=False):
+    # index, records and prefixes named by paths, loaded side by side and
+    # warmed so the first request does not pay for it; the model and the
+    # embedding cache are shared by every generation, with model None it is
+    # loaded along with the first one. with forked the generation is served
+    # by workers forked from this process: the model is not run here (see
+    # forkSafeTorch), each worker warms it with startEncoder.
+    # a snapshot replaces the three files, all but the index is mapped.
+    # with segments the base files are the ones of its manifest and the
+    # ingest logs are replayed on them
+    times = {} if times is None else times
+    manifest = segments.manifest() if segments is not None else None
+    if manifest is not None:
+        paths = segments.paths(paths, manifest)
+    if paths.get('snapshot'):
+        snap = Snapshot(paths['snapshot'])
+        def prefixes():
+            pfxs = snap.prefixes()
+            return pfxs, snap.prefixDict(pfxs)
+        loaders = {'index': lambda: loadSnapshotIdx(snap, DISTANCE),
+                   'records': lambda: snap.records(opts.fragCache * 1024 * 1024),
+                   'prefixes': prefixes}
+    else:
+        def prefixes():
+            pfxs = loadPrefixes(paths['prefixes'])
+            return pfxs, PrefixDict(pfxs)
+        loaders = {'index': lambda: loadIdx(paths['index'], DISTANCE, opts.loadFaiss),
+                   'records': lambda: RecordStore(paths['records'], opts.fragCache * 1024 * 1024),
+                   'prefixes': prefixes}
+    if model is None:
+        loaders['model'] = lambda: SentenceTransformer(MODEL_NAME)
+    parts = loadParallel(loaders, times)
+    index, recs, (pfxs, pdict) = parts['index'], parts['records'], parts['prefixes']
+    model = parts.get('model', model)
+    live = None
+    if segments is not None:
+        live = timed('segments', lambda: segments.attach(index, recs, pfxs, pdict, model, manifest), times)
+        index, recs, pfxs, pdict = live.index, live.records, live.prefixes, live.pdict
+    searcher = SearchWrapper(index, model, cache, opts.kMax)
+
+    def warmUp():
+        if not forked:
+            warmSearch(searcher, pfxs)
+        if len(recs):
+            recs.blob(0)
+    timed('warmup', warmUp, times)
+    print(f'GENERATION {gid}: {len(index)} VECTORS, {len(recs)} RECORDS, {len(pdict)} PREFIXES', flush=True)
+    return Generation(gid, paths, index=index, records=recs, prefixes=pfxs, pdict=pdict, searcher=searcher,
+                      model=model, segments=live, loadTimes=times)
+
 #==============================================================================
 def printRecs(recs, limit, pattern=None):
 
@@ -358,35 +1314,90 @@ def printRecs(recs, limit, pattern=None):
 #==============================================================================
 def main(args):
     opts = parser.parse_args()
-    index = loadIdx(opts.idxFile, DISTANCE, opts.loadFaiss)
-    recs = loadRecords(opts.recsFile)
-    pfxs = loadRecords(opts.pfxFile)
-    dbconn = pfxsToDb(pfxs)
-    # printRecs(pfxs, 440)
-    searcher = SearchWrapper(index, SentenceTransformer('all-MiniLM-L6-v2'))
+    if opts.segDir and opts.workers > 0:
+        parser.error('-segments can not be combined with -workers, an ingest would only reach one of them')
+    store = SegmentStore(opts.segDir, opts.compactRows) if opts.segDir else None
+    compacted = store is not None and store.manifest()['base']
+    if not compacted and not opts.snapFile and not (opts.idxFile and opts.recsFile and opts.pfxFile):
+        parser.error('either -snapshot or all of -index, -records and -prefixes are required')
+    paths = {'index': opts.idxFile, 'records': opts.recsFile, 'prefixes': opts.pfxFile, 'snapshot': opts.snapFile}
+    model = None # loaded along with the first generation
+    cache = EmbeddingCache(MODEL_NAME, opts.embCache * 1024 * 1024) if opts.embCache > 0 else None
     # runQuery(json.loads(query), searcher, recs)
 
     print(f'OPTS: {opts} SEARCH: {opts.runSearch} SVR: {opts.webSearch} QUERY: {opts.query}')
-    try:
+    if opts.runSearch:
+        gen = loadGeneration(1, paths, opts, model, cache, segments=store)
+        searchIdx(gen.prefixes, gen.records, gen.searcher, gen.pdict)
+    elif opts.webSearch:
+        print(f'Starting server on port {opts.port}\n')
+        startup = Startup()
+
+        def load(gid, paths):
+            nonlocal model
+            gen = loadGeneration(gid, paths, opts, model, cache, startup.times if gid == 1 else None, store,
+                                 forked=opts.workers > 0)
+            model = gen.model
+            gen.searcher = BatchScheduler(gen.searcher, opts.maxBatch, opts.maxWait)
+            gen.onClose = lambda g: g.searcher.stop()
+            if gid > 1 and opts.workers <= 0:
+                gen.searcher.start() # the first one is started below
+            return gen
+
+        gens = Generations(load, paths, start=False)
+        if store is not None:
+            store.reload = lambda paths: gens.reload(paths, wait=True)
+        qcache = QueryCache(opts.qCache * 1024 * 1024, opts.qTtl, [p for p in paths.values() if p]) \
+                 if opts.qCache > 0 else None
+        slowlog = SlowQueryLog(opts.slowMs, opts.slowLog) if opts.slowMs > 0 else None
+        metrics.REGISTRY.gauge('search_generation', 'id of the generation serving new requests', fn=lambda: gens.current().id)
+        metrics.REGISTRY.gauge('search_index_vectors', 'vectors in the loaded index', fn=lambda: len(gens.current().index))
+        metrics.REGISTRY.gauge('search_records', 'records in the records file', fn=lambda: len(gens.current().records))
+        metrics.REGISTRY.gauge('search_prefixes', 'prefix keys loaded', fn=lambda: len(gens.current().pdict))
 
-        if opts.runSearch:
-            searchIdx(pfxs, recs, searcher, dbconn)
-        elif opts.webSearch:
-            print(f'Starting server on port {opts.port}\n')
-            server = HttpServerWrapper(pfxs, recs, searcher, dbconn, int(opts.port))
+        def boot():
+            gens.start()
+            if opts.workers <= 0:
+                gens.current().searcher.start()
 
+        workersOk = True
+        if opts.workers > 0:
+            forkSafeTorch()
+            # workers are forked from a loaded parent, the socket is only
+            # opened once there is something to share with them
+            boot()
+            startup.done()
+            server = HttpServerWrapper(gens, qcache, slowlog, startup, int(opts.port))
+
+            def startWorker(n):
+                # threads do not survive fork, start the scheduler and the
+                # torch threads in the worker
+                gen = gens.current()
+                gen.searcher.start()
+                startEncoder(gen, max(1, (os.cpu_count() or 1) // opts.workers))
+            workersOk = server.serve_workers(opts.workers, startWorker)
+        else:
+            # answers /live at once and everything else with 503 until the
+            # startup thread has loaded and warmed the first generation
+            server = HttpServerWrapper(gens, qcache, slowlog, startup, int(opts.port), store)
+            threading.Thread(target=startup.run, args=(boot, server.shutdown), name='startup', daemon=True).start()
+            signal.signal(signal.SIGHUP, lambda signum, frame: server.reload())
             try:
                 server.serve_forever()
             except KeyboardInterrupt:
                 pass
-            print('Stopping server...\n')
-            server.server_close()
-        elif opts.query:
-            pass
-        else:
-            print("query is empty!\nspecify at least one option: -server , -search or -query")
-    finally:
-        dbconn.close()
+        print('Stopping server...\n')
+        server.server_close()
+        if slowlog is not None:
+            slowlog.close()
+        if gens.current() is not None:
+            gens.current().searcher.stop()
+        if startup.error or not workersOk:
+            return 1
+    elif opts.query:
+        return bulkQuery(opts, paths, cache, store)
+    else:
+        print("query is empty!\nspecify at least one option: -server , -search or -query")
 
     return 0
 
@@ -10,69 +10,222 @@ import json
 import fileinput
 import locale
 import argparse
+import time
+import signal
+import threading
 import sqlite3
 from datetime import datetime
+from query_cache import QueryCache, canonicalQuery
+from paging import pageRequest, pageResults, isStreaming, streamEnvelope, envelope, writeChunked
+import metrics
+from profiler import PROFILER, SlowQueryLog
+from generation import Generation, Generations
+from snapshot import Snapshot
+from startup import Startup, loadParallel, timed
+from record_store import RecordStore
+from prefix_dict import PrefixDict
+from postings import KEYS, loadPrefixes, unionAll, toIds
+from query_plan import planQuery, Negation
+from urllib.parse import urlsplit, parse_qs
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 if sys.version_info[0] > 2:
    xrange = range
 
 parser = argparse.ArgumentParser()
-parser.add_argument( '-records', dest='recsFile', help='records file', required=True, metavar="FILE" )
-parser.add_argument( '-prefixes', dest='pfxFile', help='prefixes file', required=True, metavar="FILE" )
+parser.add_argument( '-records', dest='recsFile', help='records file', metavar="FILE" )
+parser.add_argument( '-prefixes', dest='pfxFile', help='prefixes file', metavar="FILE" )
+parser.add_argument( '-snapshot', dest='snapFile', help='snapshot bundle written by snapshot.py, replaces -records and -prefixes', metavar="FILE" )
+parser.add_argument( '-qcache', dest='qCache', type=int, default=64, help='query result cache size in MB, 0 disables', metavar="MB" )
+parser.add_argument( '-qttl', dest='qTtl', type=float, default=60, help='query result cache ttl in seconds, 0 never expires', metavar="SEC" )
+parser.add_argument( '-fragcache', dest='fragCache', type=int, default=32, help='projected record field cache size in MB, 0 disables', metavar="MB" )
+parser.add_argument( '-slowms', dest='slowMs', type=float, default=500, help='log requests slower than this many milliseconds, 0 disables', metavar="MS" )
+parser.add_argument( '-slowlog', dest='slowLog', help='slow query log file, default: stdout', metavar="FILE" )
 parser.add_argument( '-port', dest='port', type=str, default="5555", help='server port', metavar="SYMBOL" )
 parser.add_argument( '-server', action='store_const', const=True, default=False, dest='webSearch', help='run web search server' )
 parser.add_argument( '-dumpdb', action='store_const', const=True, default=False, dest='dumpDb', help='dump prefixes to db' )
 
 locale.setlocale( locale.LC_ALL, '')
-wc_rx_a = re.compile('[*]', re.S)
-wc_rx_q = re.compile('[?]', re.S)
+not_rx = re.compile('^!(.*)', re.S)
 wc_rx = re.compile('(?s).*[*?].*')
 
 PFXDB = 'pfxs.db'
 SET_OPERANDS = set(['and', 'or'])
 WEL = 20      # wild card expansion limit
+RELOAD_PATHS = set(['records', 'prefixes', 'snapshot'])
 
 class HttpServerWrapper:
-    def __init__(self, prefixes, records, dbconn, port):
+    def __init__(self, gens, qcache, slowlog, startup, port):
         def handler(*args):
-            RequestHandler(prefixes, records, dbconn, *args)
+            RequestHandler(gens, qcache, slowlog, startup, self.reload, *args)
+        self._gens = gens
         self._server = ThreadingHTTPServer(('', port), handler)
     def serve_forever(self):
         self._server.serve_forever()
+    def shutdown(self):
+        self._server.shutdown()
     def server_close(self):
         self._server.server_close()
 
+    def reload(self, paths=None):
+        if self._gens.reload(paths):
+            return True, 'reload started'
+        return False, 'a reload is already running'
+
 class RequestHandler(BaseHTTPRequestHandler):
     _startTime = datetime.now()
-
-    def __init__(self, prefixes, records, dbconn, *args):
-        self._prefixes = prefixes
-        self._records = records
-        self._dbconn  = dbconn
+    protocol_version = 'HTTP/1.1' # needed for chunked responses
+
+    def __init__(self, gens, qcache, slowlog, startup, reload, *args):
+        self._gens = gens
+        self._qcache = qcache
+        self._slowlog = slowlog
+        self._startup = startup
+        self._reload = reload
         BaseHTTPRequestHandler.__init__(self, *args)
 
     def _getResponseTemplate(self):
         return {'data':[], 'message':'', 'count':'0', 'status':'ok'}
 
-    def _prepareResponse(self, code):
+    def _prepareResponse(self, code, length=None, contentType='application/json; charset=utf-8'):
+        metrics.REQUESTS.add(1, self.command, str(code))
+        trace = metrics.currentTrace()
+        if trace is not None:
+            trace['status'] = code
         self.send_response(code)
-        self.send_header('Content-type', 'application/json; charset=utf-8')
+        self.send_header('Content-type', contentType)
+        if length is None:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Content-Length', str(length))
         self.end_headers()
 
+    def _sendResponse(self, code, body, contentType='application/json; charset=utf-8'):
+        self._prepareResponse(code, len(body), contentType)
+        self.wfile.write(body)
+
+    def _health(self, path):
+        # /live answers while the process serves at all, /ready only once
+        # the first generation is loaded and warmed
+        d = self._getResponseTemplate()
+        d['count'] = 1
+        d['data'] = [self._startup.stats()]
+        ok = path == '/live' or self._startup.ready
+        d['message'] = 'live' if path == '/live' else 'ready' if ok else self._startup.error or 'starting'
+        if not ok:
+            d['status'] = 'failed'
+        self._sendResponse(200 if ok else 503, bytes(json.dumps(d), "utf-8"))
+
+    def _notReady(self):
+        # everything but health, metrics and profiles waits for the startup
+        if self._startup.ready:
+            return False
+        d = self._getResponseTemplate()
+        d['status'] = 'failed'
+        d['message'] = self._startup.error or 'starting'
+        self.close_connection = True # the request body is not read
+        self._sendResponse(503, bytes(json.dumps(d), "utf-8"))
+        return True
+
     def do_GET(self):
         print(f"GET request,\nPath: {str(self.path)}\nHeaders:\n{str(self.headers)}\n")
-        self._prepareResponse(200)
+        url = urlsplit(self.path)
+        if url.path == '/metrics':
+            self._sendResponse(200, metrics.REGISTRY.expose().encode('utf-8'), metrics.CONTENT_TYPE)
+            return
+        if url.path == '/admin/profile':
+            self._profile(parse_qs(url.query))
+            return
+        if url.path in ('/live', '/ready'):
+            self._health(url.path)
+            return
+        if self._notReady():
+            return
+        gen = self._gens.current()
         d = self._getResponseTemplate()
         d['message'] = f'hearbeat, uptime: {datetime.now() - self._startTime}'
+        d['generation'] = gen.id
         if self.path == '/keys':
-            print(f'KEYS: {self._prefixes[0]}\n')
+            print(f'KEYS: {gen.prefixes[0]}\n')
             d['count'] = 1
-            d['data'] = sorted(self._prefixes[0][1])
+            d['data'] = sorted(gen.prefixes[0][1])
             d['message'] = 'keys request'
-        self.wfile.write(bytes(json.dumps(d), "utf-8"))
+        elif self.path == '/querycachestats' and self._qcache is not None:
+            d['count'] = 1
+            d['data'] = [self._qcache.stats()]
+            d['message'] = 'query cache stats request'
+        elif self.path == '/admin/generation':
+            d['count'] = 1
+            d['data'] = [self._gens.stats()]
+            d['message'] = 'generation request'
+        self._sendResponse(200, bytes(json.dumps(d), "utf-8"))
+
+    def _profile(self, args):
+        # /admin/profile?seconds=10&requests=0&interval=0.005&idle=0 samples
+        # this process and answers with collapsed stacks for a flame graph
+        d = self._getResponseTemplate()
+        try:
+            seconds = float(args.get('seconds', ['10'])[0])
+            requests = int(args.get('requests', ['0'])[0])
+            interval = max(0.001, float(args.get('interval', ['0.005'])[0]))
+            idle = args.get('idle', ['0'])[0] not in ('0', '', 'false')
+        except ValueError as e:
+            d['status'] = 'failed'
+            d['message'] = f'invalid profile arguments: {e}'
+            self._sendResponse(400, bytes(json.dumps(d), "utf-8"))
+            return
+        stacks = PROFILER.profile(seconds, requests, interval, idle)
+        if stacks is None:
+            d['status'] = 'failed'
+            d['message'] = 'a profile is already running'
+            self._sendResponse(409, bytes(json.dumps(d), "utf-8"))
+            return
+        self._sendResponse(200, stacks.encode('utf-8'), 'text/plain; charset=utf-8')
+
+    def _adminReload(self):
+        # POST /admin/reload, the body may name new files:
+        # {"records": FILE, "prefixes": FILE, "snapshot": FILE}
+        # files named without a snapshot replace the one being served
+        cl = int(self.headers['Content-Length'] or 0)
+        d = self._getResponseTemplate()
+        try:
+            j = json.loads(self.rfile.read(cl).decode('utf-8')) if cl else {}
+            if not isinstance(j, dict) or set(j) - RELOAD_PATHS:
+                raise ValueError(f'expected an object with any of {sorted(RELOAD_PATHS)}')
+            if j and 'snapshot' not in j:
+                j['snapshot'] = None
+        except ValueError as e:
+            d['status'] = 'failed'
+            d['message'] = f'invalid reload request: {e}'
+            self._sendResponse(400, bytes(json.dumps(d), "utf-8"))
+            return
+        ok, d['message'] = self._reload(j)
+        d['generation'] = self._gens.current().id
+        if not ok:
+            d['status'] = 'failed'
+        self._sendResponse(202 if ok else 409, bytes(json.dumps(d), "utf-8"))
 
     def do_POST(self):
+        if self._notReady():
+            return
+        if urlsplit(self.path).path == '/admin/reload':
+            self._adminReload()
+            return
+        t = time.perf_counter()
+        metrics.IN_FLIGHT.add(1)
+        trace = metrics.startTrace()
+        try:
+            self._search()
+        finally:
+            metrics.endTrace()
+            metrics.IN_FLIGHT.add(-1)
+            elapsed = time.perf_counter() - t
+            metrics.REQUEST_SECONDS.observe(elapsed)
+            PROFILER.requestDone()
+            if self._slowlog is not None:
+                self._slowlog.check(elapsed, trace)
+
+    def _search(self):
         cl = int(self.headers['Content-Length'])
         pd = self.rfile.read(cl).decode('utf-8') # read request body
         print(f'CONTENT LENGTH: {cl}\nBODY: {pd}\nHEADERS: {str(self.headers)}')
@@ -80,65 +233,125 @@ class RequestHandler(BaseHTTPRequestHandler):
         d['message'] = 'search request'
 
         try:
-            j = json.loads(pd)
+            with metrics.STAGE_SECONDS.time('parse'):
+                j = json.loads(pd)
+                if not isinstance(j, dict):
+                    raise ValueError('query must be a json object')
+                offset, limit = pageRequest(j)
         except Exception as e:
             print(f'{e}')
             d['status'] = 'failed'
-            d['message'] = 'invalid query or invalid json syntaxis'
-            self._prepareResponse(400)
-            self.wfile.write(bytes(json.dumps(d), "utf-8"))
+            d['message'] = f'invalid query or invalid json syntaxis: {e}'
+            self._sendResponse(400, bytes(json.dumps(d), "utf-8"))
             return
-        wel = getExpansionLimit(j)
-        results = runQuery(j, wel, self._prefixes, self._dbconn)
-
-        lst = fetchRecords(j, results, self._records)
-
-        d['count'] = len(lst)
-        d['data'] = lst
-        self._prepareResponse(200)
-        self.wfile.write(bytes(json.dumps(d), "utf-8"))
-
-class setOp:
-    def __init__(self, op):
-        self.__op = op
-        self.__myset = None
-
-    def setOperation(self, st):
-        if self.__myset is not None and st is not None:
-            self.__myset = self.__myset.intersection(st) if self.__op == 'and' else self.__myset.union(st)
-        else:
-            self.__myset = st
-        return self.__myset
-
-    def __call__(self, st):
-        return self.setOperation(st)
-    def __str__(self):
-        return f'{__class__.__name__}.{self.__op}'
+        gen = self._gens.acquire()
+        try:
+            self._searchGeneration(gen, j, offset, limit)
+        finally:
+            self._gens.release(gen)
 
-    @property
-    def results(self):
-        return self.__myset
+    def _searchGeneration(self, gen, j, offset, limit):
+        # everything the request reads comes from gen, a reload swapping in
+        # the next generation meanwhile does not change it under us
+        d = self._getResponseTemplate()
+        d['message'] = 'search request'
+        d['generation'] = gen.id
+        trace = metrics.currentTrace()
+        if trace is not None:
+            trace['query'] = j
+            trace['generation'] = gen.id
+        stream = isStreaming(j)
+        key = f'{gen.id}:{canonicalQuery(j)}' if self._qcache is not None and not stream else None
+        body = self._qcache.get(key) if key is not None else None
+        if body is not None and trace is not None:
+            trace['cached'] = True
+        if body is None:
+            wel = getExpansionLimit(j)
+            plan = {} if j.get('debug') else None
+            results = runQuery(j, wel, gen.prefixes, gen.pdict, plan)
+            page, cursor = pageResults(j, results, offset, limit)
+
+            d['total'] = 0 if results is None else len(results)
+            if cursor:
+                d['next_cursor'] = cursor
+            if plan is not None:
+                d['plan'] = plan.get('plan')
+            d['count'] = 0 if page is None else len(page)
+            metrics.RESULT_ROWS.observe(d['total'])
+            metrics.RETURNED_ROWS.observe(d['count'])
+            if trace is not None:
+                trace['total'] = d['total']
+                trace['count'] = d['count']
+            if stream:
+                # records are fetched and spliced in as they are written
+                self._prepareResponse(200)
+                with metrics.STAGE_SECONDS.time('stream'):
+                    writeChunked(self.wfile, streamEnvelope(d, iterBlobs(j, page, gen.records)))
+                return
+            with metrics.STAGE_SECONDS.time('fetch'):
+                blobs = list(iterBlobs(j, page, gen.records))
+            with metrics.STAGE_SECONDS.time('serialize'):
+                body = envelope(d, blobs)
+            if key is not None:
+                self._qcache.put(key, body)
+        self._sendResponse(200, body)
 
 #==============================================================================
-def fetchRecords(query_json, results, recs):
-    lst = []
+def iterRecords(query_json, results, recs):
     filter_fields = query_json['select'] \
                    if 'select' in query_json and \
                    isinstance(query_json['select'], list) else []
-    if not results:
-        return lst
-    for i in results:
+    if results is None or not len(results):
+        return
+    for i in toIds(results):
         rec1 = recs[i]
         rec2 = {}
         for f in filter_fields:
             rec2[f] = rec1[f] if f in rec1 else f'unknown field {f}'
-        lst.append(rec2 if rec2 else rec1)
+        yield rec2 if rec2 else rec1
 
-    return lst
+#==============================================================================
+def fetchRecords(query_json, results, recs):
+    return list(iterRecords(query_json, results, recs))
+
+#==============================================================================
+def iterBlobs(query_json, results, recs):
+    # same records as iterRecords but as JSON bytes for the response: whole
+    # records are the file lines as they are, projections are joined from
+    # per record/field fragments cached by the record store
+    filter_fields = query_json['select'] \
+                   if 'select' in query_json and \
+                   isinstance(query_json['select'], list) else []
+    if results is None or not len(results):
+        return
+    if not filter_fields:
+        for i in toIds(results):
+            yield recs.blob(i)
+        return
+    fields = list(dict.fromkeys(filter_fields))
+    missing = [(json.dumps(str(f)) + ': ' + json.dumps(f'unknown field {f}')).encode('utf-8') for f in fields]
+    for i in toIds(results):
+        frags = recs.fragments(i, fields)
+        yield b'{' + b', '.join(m if frag is None else frag for frag, m in zip(frags, missing)) + b'}'
 #==============================================================================
 def isWildCardPresent(term):
         return re.match(wc_rx, term)
 #==============================================================================
+def isNotConditionPresent(term):
+    return re.match(not_rx, term)
+#==============================================================================
+def notToNegation(term, pdict):
+    # '!field:value' is every record having field minus the ones matching
+    # field:value, wildcards are matched in full regardless of wel
+    t = re.match(not_rx, term).group(1)
+    ss = t.split(':')
+    field = ':'.join(ss[:len(ss) - 1]) if len(ss) > 1 else ''
+    recs, ok = prefixSearch(t, -1, pdict)
+    if isWildCardPresent(t):
+        metrics.traceExpansion(term, len(recs))
+    universe = pdict.universe(field)
+    return Negation((pdict.size(recs), lambda: pdict.postings(recs)), (len(universe), lambda: universe))
+#==============================================================================
 def removeDb():
     try:
         if os.path.exists(PFXDB) and os.path.isfile(PFXDB):
@@ -169,46 +382,42 @@ def getExpansionLimit(query_json):
             if 'wel' in query_json and \
             isinstance(query_json['wel'], int) else WEL
 #==============================================================================
-def prefixSearch(term, wel, dbconn):
-    t = re.sub(wc_rx_q, '_', re.sub(wc_rx_a, '%', term))
-    # print(f'CHANGED? {t in term} [{t}] [{term}]')
-    sql1 = f"= '{t}'"
-    sql2 = f"like '{t}' order by length(prefix) limit {wel}"
-    sql = ' '.join([f"select id from pfx where prefix", sql1 if t in term else sql2] )
-
-    print(f'SQL QUERY: {sql}')
-    recs = dbconn.execute(sql)
-    lst = []
-    for rec in recs:
-        lst.append(rec[0])
+def prefixSearch(term, wel, pdict):
+    if not isWildCardPresent(term):
+        row = pdict.get(term)
+        lst = [] if row is None else [row]
+    else:
+        lst = [row for key, row in pdict.match(term, wel)]
     return lst, len(lst) > 0
 #==============================================================================
-def runQuery(q, wel, prefixes, dbconn):
+def runQuery(q, wel, prefixes, pdict, plan=None):
     print(f'EXPANSION LIMIT: {wel}')
-    cnt = 1
-    for k in q:
-        if k not in SET_OPERANDS:
-            continue
-        op = setOp(k)
-        print(f'{k} -> {q[k]} {op}')
-        for qq in q[k]:
-            if isinstance(qq, str):
-                sys.stdout.write(f'{cnt}\n')
-                lst = []
-                recs, ok = prefixSearch(qq, wel, dbconn)
-                for rec in recs:
-                    lst.extend(prefixes[rec][1])
-                    # print(f'---> {rec}')
-                op(set(lst))
-
-                cnt += 1
-            elif isinstance(qq, dict):
-                op(runQuery(qq, wel, prefixes, dbconn))
-    # print(f'OP: {op.results}')
-    return op.results
+
+    expanding = [0.0]
+
+    def leaf(term):
+        # the planner resolves leaves as it goes, their time is expansion
+        # and the rest of the evaluation is set algebra
+        t = time.perf_counter()
+        try:
+            if isNotConditionPresent(term):
+                return notToNegation(term, pdict)
+            recs, ok = prefixSearch(term, wel, pdict)
+            if isWildCardPresent(term):
+                metrics.traceExpansion(term, len(recs))
+            lst = [prefixes[rec][1] for rec in recs]
+            return sum(len(l) for l in lst), lambda: unionAll(lst)
+        finally:
+            expanding[0] += time.perf_counter() - t
+
+    t = time.perf_counter()
+    results = planQuery(q, leaf, plan)
+    metrics.STAGE_SECONDS.observe(expanding[0], 'expand')
+    metrics.STAGE_SECONDS.observe(time.perf_counter() - t - expanding[0], 'setops')
+    return results
 
 #==============================================================================
-def searchPfx(prefixes, recs, dbconn):
+def searchPfx(prefixes, recs, pdict):
     print( "Enter your query below or 'q' to quit:")
 
     for line in sys.stdin:
@@ -224,7 +433,7 @@ def searchPfx(prefixes, recs, dbconn):
             print(f'invalid query or invalid json syntaxis')
             continue
         wel = getExpansionLimit(query)
-        results = runQuery(query, wel, prefixes, dbconn)
+        results = runQuery(query, wel, prefixes, pdict)
         lst = fetchRecords(query, results, recs)
 
         for i in lst:
@@ -254,29 +463,73 @@ def loadRecords(path):
 
     return recs
 #==============================================================================
+def loadGeneration(gid, paths, opts, times=None):
+    # records and prefixes named by paths are loaded side by side, then the
+    # prefix dictionary is built (next to the sqlite dump with -dumpdb) and
+    # one key looked up before the generation takes requests; from a
+    # snapshot the dictionary is mapped as it was built, the index is unused
+    times = {} if times is None else times
+    if paths.get('snapshot'):
+        snap = Snapshot(paths['snapshot'])
+        parts = loadParallel({'records': lambda: snap.records(opts.fragCache * 1024 * 1024),
+                              'prefixes': snap.prefixes}, times)
+    else:
+        parts = loadParallel({'records': lambda: RecordStore(paths['records'], opts.fragCache * 1024 * 1024),
+                              'prefixes': lambda: loadPrefixes(paths['prefixes'])}, times)
+    recs, pfxs = parts['records'], parts['prefixes']
+    loaders = {'dictionary': (lambda: snap.prefixDict(pfxs)) if paths.get('snapshot') else (lambda: PrefixDict(pfxs))}
+    if opts.dumpDb and gid == 1 and removeDb():
+        loaders['sqlite'] = lambda: pfxsToDb(pfxs, PFXDB).close()
+    pdict = loadParallel(loaders, times)['dictionary']
+
+    def warmUp():
+        for pfx in pfxs[:2]:
+            if isinstance(pfx, list) and pfx and pfx[0] != KEYS:
+                prefixSearch(str(pfx[0]), WEL, pdict)
+        if len(recs):
+            recs.blob(0)
+    timed('warmup', warmUp, times)
+    print(f'GENERATION {gid}: {len(recs)} RECORDS, {len(pdict)} PREFIXES', flush=True)
+    return Generation(gid, paths, records=recs, prefixes=pfxs, pdict=pdict, loadTimes=times)
+
+#==============================================================================
 def main(args):
 
     opts = parser.parse_args()
-    recs = loadRecords(opts.recsFile)
-    pfxs = loadRecords(opts.pfxFile)
-
-    try:
-        dbconn = pfxsToDb(pfxs, PFXDB if opts.dumpDb and removeDb() else ':memory:')
-        if opts.webSearch:
-            print(f'Starting server on port {opts.port}\n')
-            server = HttpServerWrapper(pfxs, recs, dbconn, int(opts.port))
-
-            try:
-                server.serve_forever()
-            except KeyboardInterrupt:
-                pass
-            print('Stopping server...\n')
-            server.server_close()
-
-        else:
-            searchPfx(pfxs, recs, dbconn)
-    finally:
-        dbconn.close()
+    if not opts.snapFile and not (opts.recsFile and opts.pfxFile):
+        parser.error('either -snapshot or both -records and -prefixes are required')
+    paths = {'records': opts.recsFile, 'prefixes': opts.pfxFile, 'snapshot': opts.snapFile}
+    if opts.webSearch:
+        print(f'Starting server on port {opts.port}\n')
+        startup = Startup()
+        gens = Generations(lambda gid, paths: loadGeneration(gid, paths, opts, startup.times if gid == 1 else None),
+                           paths, start=False)
+        qcache = QueryCache(opts.qCache * 1024 * 1024, opts.qTtl, [p for p in paths.values() if p]) \
+                 if opts.qCache > 0 else None
+        slowlog = SlowQueryLog(opts.slowMs, opts.slowLog) if opts.slowMs > 0 else None
+        server = HttpServerWrapper(gens, qcache, slowlog, startup, int(opts.port))
+        metrics.REGISTRY.gauge('search_generation', 'id of the generation serving new requests', fn=lambda: gens.current().id)
+        metrics.REGISTRY.gauge('search_records', 'records in the records file', fn=lambda: len(gens.current().records))
+        metrics.REGISTRY.gauge('search_prefixes', 'prefix keys loaded', fn=lambda: len(gens.current().pdict))
+
+        # answers /live at once and everything else with 503 until the
+        # startup thread has loaded and warmed the first generation
+        threading.Thread(target=startup.run, args=(gens.start, server.shutdown), name='startup', daemon=True).start()
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.reload())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        print('Stopping server...\n')
+        server.server_close()
+        if slowlog is not None:
+            slowlog.close()
+        if startup.error:
+            return 1
+
+    else:
+        gen = loadGeneration(1, paths, opts)
+        searchPfx(gen.prefixes, gen.records, gen.pdict)
     return 0
 
 if __name__ == '__main__':
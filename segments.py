@@ -0,0 +1,724 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  segments.py
+#
+import os
+import json
+import time
+import shutil
+import threading
+import traceback
+import numpy as np
+from postings import KEYS, union, difference
+from record_store import txtToJson
+from prefix_dict import PrefixDict, wc_rx
+from json_to_prefix import jsonToPfx
+
+SEGMENT_ROWS = 4096    # vectors per delta segment
+COMPACT_BATCH = 65536  # vectors read from the old index and added at a time
+MANIFEST = 'manifest.json'
+IDX_FILE = 'index.idx'
+IDX_INFO = 'index-info.json'
+
+#==============================================================================
+def textValues(v):
+    # json_to_prefix.py only tokenizes strings, the other values of an
+    # ingested record are indexed as their JSON text (null as nothing)
+    if isinstance(v, dict):
+        return {k: textValues(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [textValues(x) for x in v]
+    if v is None:
+        return ''
+    return v if isinstance(v, str) else json.dumps(v)
+
+#==============================================================================
+def recordKeys(rec, i):
+    # ([prefix keys], {fields}) json_to_prefix.py makes of record i
+    pfxmap = {KEYS: set()}
+    if isinstance(rec, dict):
+        jsonToPfx('', pfxmap, i, textValues(rec))
+    fields = pfxmap.pop(KEYS)
+    return list(pfxmap), fields
+
+#==============================================================================
+def distances(space, xq, vecs):
+    # the distances hnswlib reports for its spaces, faiss L2 is 'l2' too
+    xq = np.asarray(xq, dtype=np.float32)
+    if space == 'l2':
+        d = (xq * xq).sum(1)[:, None] + (vecs * vecs).sum(1)[None, :] - 2 * (xq @ vecs.T)
+        return np.maximum(d, 0)
+    if space == 'cosine':
+        xq = xq / np.maximum(np.linalg.norm(xq, axis=1, keepdims=True), 1e-12)
+    return 1 - xq @ vecs.T
+
+#==============================================================================
+class LiveRecords:
+    # a RecordStore with the records ingested since it was loaded appended
+    def __init__(self, base):
+        self._base = base
+        self._n = len(base)
+        self._added = []
+
+    def __len__(self):
+        return self._n + len(self._added)
+
+    def append(self, blob):
+        self._added.append(blob)
+
+    def raw(self, i):
+        if i < 0:
+            i += len(self)
+        return self._base.raw(i) if i < self._n else self._added[i - self._n]
+
+    def __getitem__(self, i):
+        j, ok = txtToJson(self.raw(i).decode('utf-8'))
+        return j if ok else self.raw(i).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def blob(self, i):
+        return self._base.blob(i) if 0 <= i < self._n else self.raw(i)
+
+    def fragments(self, i, fields):
+        if 0 <= i < self._n:
+            return self._base.fragments(i, fields)
+        rec = self[i]
+        return [(json.dumps(f) + ': ' + json.dumps(rec[f])).encode('utf-8')
+                if isinstance(rec, dict) and isinstance(f, str) and f in rec else None for f in fields]
+
+    def fragStats(self):
+        return self._base.fragStats()
+
+#==============================================================================
+class LivePrefixes:
+    # the prefix rows of a generation with rows patched and appended by
+    # ingests; a row is replaced, never changed in place, so a reader holding
+    # one keeps a consistent [key, postings]
+    def __init__(self, base):
+        self.base = base
+        self.baseLen = len(base)
+        self._patched = {}
+        self._extra = []
+
+    def __len__(self):
+        return self.baseLen + len(self._extra)
+
+    def __getitem__(self, r):
+        if r < 0:
+            r += len(self)
+        row = self._patched.get(r)
+        if row is not None:
+            return row
+        return self.base[r] if r < self.baseLen else self._extra[r - self.baseLen]
+
+    def patch(self, r, row):
+        if r < self.baseLen:
+            self._patched[r] = row
+        else:
+            self._extra[r - self.baseLen] = row
+
+    def append(self, row):
+        self._extra.append(row)
+        return len(self) - 1
+
+#==============================================================================
+class LiveDict:
+    # the PrefixDict of the base rows plus a small one of the appended rows,
+    # rebuilt on every ingest that adds keys; both read the live postings
+    def __init__(self, base, prefixes):
+        self._base = base
+        self._prefixes = prefixes
+        self._delta = PrefixDict(prefixes, [])
+        self._universe = {}
+        base.rebind(prefixes)
+
+    def changed(self, newRows):
+        if newRows:
+            self._delta = PrefixDict(self._prefixes, range(self._prefixes.baseLen, len(self._prefixes)))
+        self._delta.rebind(self._prefixes)
+        self._base.rebind(self._prefixes)
+        self._universe = {}
+
+    def __len__(self):
+        return len(self._base) + len(self._delta)
+
+    def get(self, key):
+        row = self._base.get(key)
+        return row if row is not None else self._delta.get(key)
+
+    def getFolded(self, key):
+        row = self._base.getFolded(key)
+        return row if row is not None else self._delta.getFolded(key)
+
+    def match(self, pattern, limit):
+        found = self._base.match(pattern, limit) + self._delta.match(pattern, limit)
+        found.sort(key=lambda kr: (len(kr[0]), kr[1]))
+        return found if limit < 0 else found[:limit]
+
+    def matchAll(self, pattern):
+        return self._base.matchAll(pattern) + self._delta.matchAll(pattern)
+
+    def size(self, rows):
+        return self._base.size(rows)
+
+    def postings(self, rows):
+        return self._base.postings(rows)
+
+    def universe(self, field):
+        st = self._universe.get(field)
+        if st is None:
+            st = union(self._base.universe(field), self._delta.universe(field))
+            if not wc_rx.search(field):
+                self._universe[field] = st
+        return st
+
+#==============================================================================
+class DeltaSegment:
+    # up to SEGMENT_ROWS vectors of ingested prefix rows, searched exhaustively.
+    # rows are written before n moves past them, a search reads n first and
+    # never sees a half written row
+    def __init__(self, dim):
+        self.vecs = np.empty((SEGMENT_ROWS, dim), dtype=np.float32)
+        self.labels = np.empty(SEGMENT_ROWS, dtype=np.int64)
+        self.alive = np.zeros(SEGMENT_ROWS, dtype=bool)
+        self.n = 0
+
+    def room(self):
+        return SEGMENT_ROWS - self.n
+
+#==============================================================================
+class SegmentedIndex:
+    # the base index of a generation plus the delta segments of the prefix
+    # rows ingested since: searches fan out to all of them and are merged by
+    # distance. the label of a row whose postings ran empty is a tombstone,
+    # marked deleted in an hnswlib base, left out by an IDSelector in faiss
+    # and flagged in its delta segment
+    def __init__(self, base):
+        self.base = base
+        self.distance = base.distance
+        self.info = getattr(base, 'info', {})
+        self.isFaiss = hasattr(base.indexer, 'ntotal')
+        self.space = 'l2' if self.isFaiss else base.indexer.space
+        self.dim = base.indexer.d if self.isFaiss else base.indexer.dim
+        self.segments = []
+        self.where = {}      # delta label -> (segment, position)
+        self.dead = set()    # tombstoned base labels
+        self.deferred = None # base labels to mark once a compaction read the base
+        self.changed = False
+
+    @property
+    def neighbours(self):
+        # precomputed for the base alone, stale once anything was ingested
+        return None if self.changed else self.base.neighbours
+
+    def __len__(self):
+        return len(self.base) - len(self.dead) + sum(int(s.alive[:s.n].sum()) for s in self.segments)
+
+    def deltaRows(self):
+        return sum(s.n for s in self.segments)
+
+    def add(self, vecs, labels):
+        vecs = np.asarray(vecs, dtype=np.float32)
+        if self.space == 'cosine':
+            vecs = vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        done = 0
+        while done < len(labels):
+            if not self.segments or not self.segments[-1].room():
+                self.segments.append(DeltaSegment(self.dim))
+            seg = self.segments[-1]
+            k = min(seg.room(), len(labels) - done)
+            seg.vecs[seg.n:seg.n + k] = vecs[done:done + k]
+            seg.labels[seg.n:seg.n + k] = labels[done:done + k]
+            seg.alive[seg.n:seg.n + k] = True
+            for p in range(k):
+                self.where[int(labels[done + p])] = (seg, seg.n + p)
+            seg.n += k
+            done += k
+        self.changed = True
+
+    def kill(self, label):
+        if label in self.where:
+            seg, p = self.where[label]
+            seg.alive[p] = False
+        elif label not in self.dead:
+            self.dead.add(label)
+            if self.deferred is not None:
+                self.deferred.add(label)
+            else:
+                self._tombstone([label], True)
+        self.changed = True
+
+    def revive(self, label):
+        # False when the label has no vector anywhere
+        if label in self.where:
+            seg, p = self.where[label]
+            seg.alive[p] = True
+        elif label in self.dead:
+            self.dead.discard(label)
+            if self.deferred is not None and label in self.deferred:
+                self.deferred.discard(label)
+            else:
+                self._tombstone([label], False)
+        else:
+            return False
+        self.changed = True
+        return True
+
+    def defer(self):
+        # base tombstones are only recorded until undefer(): hnswlib does
+        # not hand out the vector of a label marked deleted
+        self.deferred = set()
+
+    def undefer(self):
+        labels, self.deferred = self.deferred or set(), None
+        self._tombstone(sorted(labels), True)
+
+    def _tombstone(self, labels, dead):
+        if self.isFaiss:
+            import faiss
+            if not self.dead:
+                self.base.params = None
+                return
+            batch = faiss.IDSelectorBatch(np.fromiter(self.dead, dtype=np.int64, count=len(self.dead)))
+            sel = faiss.IDSelectorNot(batch)
+            self.base.selector = (batch, sel) # the parameters do not keep them alive
+            ivf = faiss.try_extract_index_ivf(self.base.indexer)
+            if ivf is None:
+                self.base.params = faiss.SearchParameters(sel=sel)
+            else: # ivf parameters replace the index's own, nprobe included
+                self.base.params = faiss.SearchParametersIVF(sel=sel, nprobe=ivf.nprobe)
+            return
+        for label in labels:
+            if dead:
+                self.base.indexer.mark_deleted(label)
+            else:
+                self.base.indexer.unmark_deleted(label)
+        self.base.deleted += len(labels) if dead else -len(labels) # caps k, see HnswIndexWrapper
+
+    def _live(self):
+        return [(s, s.n) for s in self.segments if s.n]
+
+    def search(self, xq):
+        return self.searchK(xq, self.distance)
+
+    def searchK(self, xq, k):
+        D, I = self.base.searchK(xq, k)
+        live = self._live()
+        if not live:
+            return D, I
+        D, I = np.asarray(D, dtype=np.float32), np.asarray(I).astype(np.int64)
+        for s, n in live:
+            d = distances(self.space, xq, s.vecs[:n])
+            d[:, ~s.alive[:n]] = np.inf
+            D = np.concatenate([D, d], axis=1)
+            I = np.concatenate([I, np.broadcast_to(s.labels[:n], d.shape)], axis=1)
+        order = np.argsort(D, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(D, order, 1), np.take_along_axis(I, order, 1)
+
+    def rangeSearch(self, xq, radius, cap):
+        Ds, Is = self.base.rangeSearch(xq, radius, cap)
+        live = self._live()
+        if not live:
+            return Ds, Is
+        hits = []
+        for s, n in live:
+            d = distances(self.space, xq, s.vecs[:n])
+            hits.append((d, (d <= radius) & s.alive[:n], s.labels[:n]))
+        Ds, Is = list(Ds), list(Is)
+        for q in range(len(xq)):
+            d = np.concatenate([np.asarray(Ds[q], dtype=np.float32)] + [h[0][q][h[1][q]] for h in hits])
+            l = np.concatenate([np.asarray(Is[q]).astype(np.int64)] + [h[2][h[1][q]] for h in hits])
+            order = np.argsort(d, kind='stable')[:cap]
+            Ds[q], Is[q] = d[order], l[order]
+        return Ds, Is
+
+#==============================================================================
+class LiveSegments:
+    # what has been ingested into one generation on top of its base files:
+    # records appended, postings patched, rows of new keys appended with
+    # their vectors in delta segments and records deleted. record ids and
+    # rows are never reused, so the ingest log replays the same on the base
+    # it was written against and on the one compacted from it
+    def __init__(self, index, records, prefixes, pdict, model, manifestBase=None):
+        self.model = model
+        self.manifestBase = manifestBase
+        self.index = SegmentedIndex(index)
+        self.records = LiveRecords(records)
+        self.prefixes = LivePrefixes(prefixes)
+        self.pdict = LiveDict(pdict, self.prefixes)
+        self.deleted = set()
+        self.version = 0
+        self.ops = 0
+
+    def hasVector(self, row):
+        if row in self.index.where:
+            return True
+        return row < self.prefixes.baseLen and len(self.prefixes.base[row][1]) > 0
+
+    def pending(self):
+        # delta vectors and tombstones, what a compaction would fold in
+        return self.index.deltaRows() + len(self.index.dead)
+
+    def check(self, body):
+        # the op to log for an ingest request, ValueError when it is invalid:
+        # {"delete": [record ids], "add": [records]}, deletes go first so an
+        # update is the old id deleted and the new record added
+        if not isinstance(body, dict) or set(body) - set(['add', 'delete']):
+            raise ValueError('expected an object with "add" and/or "delete"')
+        add, delete = body.get('add', []), body.get('delete', [])
+        if not isinstance(add, list) or not isinstance(delete, list):
+            raise ValueError('"add" and "delete" must be lists')
+        for rec in add:
+            if not isinstance(rec, dict):
+                raise ValueError('records to add must be objects')
+            try:
+                recordKeys(rec, 0)
+            except Exception as e:
+                raise ValueError(f'record can not be indexed: {e}')
+        for i in delete:
+            if not isinstance(i, int) or isinstance(i, bool) or not 0 <= i < len(self.records):
+                raise ValueError(f'no record {i!r}')
+            if i in self.deleted:
+                raise ValueError(f'record {i} is already deleted')
+        if len(set(delete)) != len(delete):
+            raise ValueError('a record is deleted twice')
+        return {'first': len(self.records), 'delete': delete, 'add': add}
+
+    def apply(self, op):
+        if op['first'] != len(self.records):
+            raise ValueError(f'ingest log does not fit the base: it adds record {op["first"]}, '
+                             f'the base has {len(self.records)}')
+        added = [(op['first'] + n, rec) + recordKeys(rec, op['first'] + n) for n, rec in enumerate(op['add'])]
+        # keys without a vector are encoded before anything changes, an
+        # encoder failure leaves the state as it was
+        todo = list(dict.fromkeys(k for _, _, keys, _ in added for k in keys
+                                  if self.pdict.get(k) is None or not self.hasVector(self.pdict.get(k))))
+        vectors = dict(zip(todo, self.model.encode(todo, normalize_embeddings=True))) if todo else {}
+
+        for i in op['delete']:
+            self._delete(i)
+        newRows, newVecs, fields = [], [], set()
+        pending = {}
+        for i, rec, keys, recFields in added:
+            self.records.append(json.dumps(rec).encode('utf-8'))
+            fields |= recFields
+            ids = np.array([i], dtype=np.int32)
+            for key in keys:
+                row = pending.get(key, self.pdict.get(key))
+                if row is None:
+                    pending[key] = row = self.prefixes.append([key, ids])
+                    newRows.append(row)
+                    newVecs.append(vectors[key])
+                    continue
+                old = self.prefixes[row][1]
+                self.prefixes.patch(row, [key, union(old, ids)])
+                if not len(old) and not self.index.revive(row):
+                    newRows.append(row)
+                    newVecs.append(vectors[key])
+        if newRows:
+            self.index.add(np.stack(newVecs), newRows)
+        if self.prefixes.baseLen and self.prefixes[0][0] == KEYS and fields - set(self.prefixes[0][1]):
+            self.prefixes.patch(0, [KEYS, sorted(set(self.prefixes[0][1]) | fields)])
+        self.pdict.changed(len(pending))
+        self.ops += 1
+        self.version += 1
+        return list(range(op['first'], op['first'] + len(added)))
+
+    def _delete(self, i):
+        keys, _ = recordKeys(self.records[i], i)
+        ids = np.array([i], dtype=np.int32)
+        for key in keys:
+            row = self.pdict.get(key)
+            if row is None:
+                continue
+            rest = difference(self.prefixes[row][1], ids)
+            self.prefixes.patch(row, [key, rest])
+            if not len(rest):
+                self.index.kill(row)
+        self.deleted.add(i)
+
+    def freeze(self):
+        # what a compaction writes, taken under the ingest lock: rows are
+        # replaced and delta vectors appended, never changed, so shallow
+        # copies stay consistent while ingests go on
+        self.index.defer()
+        return {'records': self.records, 'nrecords': len(self.records), 'deleted': set(self.deleted),
+                'prefixes': self.prefixes, 'patched': dict(self.prefixes._patched),
+                'extra': list(self.prefixes._extra), 'index': self.index,
+                'delta': {l: s.vecs[p] for l, (s, p) in self.index.where.items()}}
+
+    def stats(self):
+        return {'version': self.version, 'ops': self.ops, 'records': len(self.records),
+                'records_added': len(self.records) - self.records._n, 'records_deleted': len(self.deleted),
+                'rows_added': len(self.prefixes) - self.prefixes.baseLen, 'delta_segments': len(self.index.segments),
+                'delta_vectors': self.index.deltaRows(), 'tombstones': len(self.index.dead)}
+
+#==============================================================================
+def frozenRow(frozen, r):
+    if r in frozen['patched']:
+        return frozen['patched'][r]
+    base = frozen['prefixes']
+    return base.base[r] if r < base.baseLen else frozen['extra'][r - base.baseLen]
+
+#==============================================================================
+def baseVectors(index, labels):
+    # vectors of labels in the base index, read back from it
+    indexer = index.base.indexer
+    if not index.isFaiss:
+        return np.asarray(indexer.get_items(labels), dtype=np.float32).reshape(len(labels), index.dim)
+    import faiss
+    ivf = faiss.try_extract_index_ivf(indexer)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    return indexer.reconstruct_batch(np.asarray(labels, dtype=np.int64))
+
+#==============================================================================
+def newIndex(index, size):
+    # empty index of the kind of the base: hnswlib with the base's build
+    # settings, faiss copied (keeping its training) with an id map for sparse labels
+    if not index.isFaiss:
+        import hnswlib
+        base = index.base.indexer
+        threads = index.info.get('threads', base.num_threads)
+        new = hnswlib.Index(space=index.space, dim=index.dim)
+        new.init_index(max_elements=max(1, size), ef_construction=base.ef_construction, M=base.M)
+        new.set_num_threads(threads)
+        return new, {'dim': index.dim, 'threads': threads, 'idxLib': 'hnswlib', 'type': index.space}
+    import faiss
+    if index.base.path: # mapped ivf lists cannot be cloned, read a copy
+        new = faiss.read_index(index.base.path)
+    else:
+        new = faiss.clone_index(index.base.indexer)
+    new.reset()
+    if not isinstance(new, faiss.IndexIDMap2):
+        new = faiss.IndexIDMap2(new)
+    return new, {'dim': index.dim, 'idxLib': 'faiss', 'type': index.info.get('type', 'l2')}
+
+#==============================================================================
+def writeBase(frozen, outDir):
+    # the records, prefixes and index a generation loads, with everything
+    # frozen folded in. ids and rows stay where they were: deleted records
+    # become {} and rows whose postings ran empty stay without a vector
+    tmp = outDir + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    idxDir = os.path.join(tmp, 'index')
+    os.makedirs(idxDir)
+    recs = frozen['records']
+    with open(os.path.join(tmp, 'records.jsonl'), 'wb') as f:
+        for i in range(frozen['nrecords']):
+            f.write(b'{}' if i in frozen['deleted'] else recs.raw(i))
+            f.write(b'\n')
+    labels = []
+    nrows = frozen['prefixes'].baseLen + len(frozen['extra'])
+    with open(os.path.join(tmp, 'prefixes.jsonl'), 'w') as f:
+        for r in range(nrows):
+            key, post = frozenRow(frozen, r)
+            if not isinstance(post, list):
+                post = post.tolist()
+            f.write(json.dumps([key, post]))
+            f.write('\n')
+            if post:
+                labels.append(r)
+
+    index = frozen['index']
+    delta = frozen['delta']
+    new, info = newIndex(index, len(labels))
+    isFaiss = index.isFaiss
+    # a base with a neighbour table gets one rebuilt over the new index,
+    # from the vectors kept on disk like create_embedding_store.py does
+    keep = index.info.get('neighbours') and labels
+    if keep:
+        from create_embedding_store import createNeighbourTable, VEC_FILE
+        vecPath = os.path.join(tmp, VEC_FILE)
+        vecFile = open(vecPath, 'wb')
+    for s in range(0, len(labels), COMPACT_BATCH):
+        batch = labels[s:s + COMPACT_BATCH]
+        fromBase = [l for l in batch if l not in delta]
+        vecs = dict(zip(fromBase, baseVectors(index, fromBase))) if fromBase else {}
+        X = np.stack([delta[l] if l in delta else vecs[l] for l in batch]).astype(np.float32)
+        if keep:
+            vecFile.write(X.tobytes())
+        if isFaiss:
+            if not new.is_trained:
+                new.train(X)
+            new.add_with_ids(X, np.asarray(batch, dtype=np.int64))
+        else:
+            new.add_items(X, np.asarray(batch))
+    if isFaiss:
+        import faiss
+        faiss.write_index(new, os.path.join(idxDir, IDX_FILE))
+    else:
+        new.save_index(os.path.join(idxDir, IDX_FILE))
+    with open(os.path.join(idxDir, IDX_INFO), 'w') as f:
+        f.write(json.dumps(info))
+    if keep:
+        vecFile.close()
+        X = np.memmap(vecPath, dtype=np.float32, mode='r', shape=(len(labels), index.dim))
+        createNeighbourTable(new, X, isFaiss, index.info['mat'], index.info['kmax'], idxDir, labels)
+        del X
+        os.remove(vecPath)
+    shutil.rmtree(outDir, ignore_errors=True)
+    os.replace(tmp, outDir)
+    return {'index': os.path.join(outDir, 'index'), 'records': os.path.join(outDir, 'records.jsonl'),
+            'prefixes': os.path.join(outDir, 'prefixes.jsonl'), 'snapshot': None}
+
+#==============================================================================
+class SegmentStore:
+    # the directory of a segmented index: manifest.json names the base files
+    # (none until the first compaction, the command line ones are used) and
+    # the ingest logs to replay on them. ingests are appended to the last log
+    # and applied to the live segments of the newest generation; a compaction
+    # starts a new log, writes the base folding in everything before it and
+    # reloads the server on that base and the new log alone
+    def __init__(self, path, compactRows=0, reload=None):
+        self.path = path
+        self.compactRows = compactRows
+        self.reload = reload # reload(paths) -> False while another reload runs
+        self.live = None
+        self.compacting = False
+        self.compactions = 0
+        self.lastCompaction = None
+        self.lastError = None
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        try:
+            with open(os.path.join(path, MANIFEST), 'r') as f:
+                self._manifest = json.loads(f.read())
+        except FileNotFoundError:
+            self._manifest = {'seq': 0, 'base': None, 'logs': ['ingest-0.log']}
+            self._writeManifest()
+        self._log = open(os.path.join(path, self._manifest['logs'][-1]), 'ab')
+
+    def _writeManifest(self):
+        p = os.path.join(self.path, MANIFEST)
+        tmp = f'{p}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(self._manifest))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, p)
+
+    def manifest(self):
+        with self._lock:
+            return json.loads(json.dumps(self._manifest))
+
+    def paths(self, paths, manifest=None):
+        base = (manifest or self.manifest())['base']
+        return dict(paths, **base) if base else dict(paths)
+
+    def attach(self, index, records, prefixes, pdict, model, manifest):
+        # live segments over a generation loaded from manifest's base with
+        # every log since replayed; ingests go to it from now on
+        with self._lock:
+            if self._manifest['base'] != manifest['base']:
+                raise RuntimeError('the segments were compacted meanwhile, load the new base')
+            live = LiveSegments(index, records, prefixes, pdict, model, manifest['base'])
+            for name in self._manifest['logs']:
+                self._replay(live, name)
+            self.live = live
+            return live
+
+    def _replay(self, live, name):
+        path = os.path.join(self.path, name)
+        if not os.path.exists(path):
+            return
+        good = 0
+        ops = 0
+        with open(path, 'rb') as f:
+            for raw in f:
+                if not raw.endswith(b'\n'):
+                    break # cut short by a crash
+                try:
+                    op = json.loads(raw)
+                except ValueError:
+                    break
+                live.apply(op)
+                good += len(raw)
+                ops += 1
+        if good < os.path.getsize(path):
+            print(f'{path}: DROPPING A TORN OP AFTER BYTE {good}', flush=True)
+            with open(path, 'r+b') as f:
+                f.truncate(good)
+        print(f'{name}: {ops} OPS REPLAYED', flush=True)
+
+    def ingest(self, body):
+        # applies one ingest request and logs it, ValueError when invalid
+        with self._lock:
+            live = self.live
+            if live is None:
+                raise ValueError('nothing is loaded yet')
+            op = live.check(body)
+            ids = live.apply(op)
+            self._log.write(json.dumps(op).encode('utf-8') + b'\n')
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            if self.compactRows > 0 and live.pending() >= self.compactRows:
+                self.compact()
+            return {'added': ids, 'deleted': op['delete'], 'version': live.version}
+
+    def compact(self):
+        # (started, message), the compaction runs in the background
+        with self._lock:
+            if self.reload is None:
+                return False, 'compaction needs the server'
+            if self.compacting:
+                return False, 'a compaction is already running'
+            if self.live is None:
+                return False, 'nothing is loaded yet'
+            self.compacting = True
+        threading.Thread(target=self._compact, name='compact', daemon=True).start()
+        return True, 'compaction started'
+
+    def _compact(self):
+        start = time.monotonic()
+        try:
+            with self._lock:
+                live = self.live
+                old = json.loads(json.dumps(self._manifest))
+                seq = old['seq'] + 1
+                log = f'ingest-{seq}.log'
+                self._manifest['logs'].append(log)
+                self._writeManifest()
+                self._log.close()
+                self._log = open(os.path.join(self.path, log), 'ab')
+                frozen = live.freeze()
+            print(f'COMPACTING {frozen["nrecords"]} RECORDS, {live.pending()} DELTA VECTORS AND TOMBSTONES', flush=True)
+            try:
+                paths = writeBase(frozen, os.path.join(self.path, f'base-{seq}'))
+            finally:
+                with self._lock:
+                    live.index.undefer()
+            base = {k: paths[k] for k in ('index', 'records', 'prefixes', 'snapshot')}
+            with self._lock:
+                self._manifest = {'seq': seq, 'base': base, 'logs': [log]}
+                self._writeManifest()
+            while not self.reload(paths):
+                time.sleep(1) # another reload is running
+            if self.live is None or self.live.manifestBase != base:
+                raise RuntimeError('the compacted base did not load')
+            for name in old['logs']:
+                if name != log and os.path.exists(os.path.join(self.path, name)):
+                    os.remove(os.path.join(self.path, name))
+            if old['base']:
+                shutil.rmtree(os.path.dirname(old['base']['records']), ignore_errors=True)
+            self.compactions += 1
+            self.lastCompaction = round(time.monotonic() - start, 3)
+            self.lastError = None
+            print(f'COMPACTED INTO base-{seq} IN {self.lastCompaction:.2f}s', flush=True)
+        except Exception as e:
+            traceback.print_exc()
+            self.lastError = f'compaction failed: {e}'
+        finally:
+            self.compacting = False
+
+    def stats(self):
+        live = self.live
+        d = live.stats() if live is not None else {}
+        d.update(compacting=self.compacting, compactions=self.compactions, compact_rows=self.compactRows,
+                 last_compaction_seconds=self.lastCompaction, last_error=self.lastError,
+                 manifest=self._manifest)
+        return d
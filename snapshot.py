@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  snapshot.py
+#
+import os
+import sys
+import json
+import time
+import pickle
+import struct
+import argparse
+import numpy as np
+from datetime import datetime
+from record_store import RecordStore, mapFile, scanOffsets, scanBad
+from prefix_dict import PrefixDict, StrList
+from postings import EMPTY, loadPrefixes
+
+parser = argparse.ArgumentParser()
+parser.add_argument( '-index', dest='idxFile', help='vector storage directory', required=True, metavar="FILE" )
+parser.add_argument( '-records', dest='recsFile', help='records file', required=True, metavar="FILE" )
+parser.add_argument( '-prefixes', dest='pfxFile', help='prefixes file', required=True, metavar="FILE" )
+parser.add_argument( '-o', dest='outFile', help='snapshot file to write', required=True, metavar="FILE" )
+
+SNAP_MAGIC = b'SRCHSNAP'
+SNAP_VERSION = 1
+SNAP_HEADER = struct.Struct('<8sIIQQ') # magic, version, reserved, manifest offset, manifest length
+ALIGN = 4096 # sections start on a page so every array can be mapped as is
+COPY_CHUNK = 16 * 1024 * 1024
+IDX_FILE = 'index.idx'
+IDX_INFO = 'index-info.json'
+
+#==============================================================================
+class SnapshotWriter:
+    # sections are appended page aligned, the manifest describing them goes
+    # last and the header pointing at it is written when everything else is
+    # on disk; the file is built aside and renamed into place
+    def __init__(self, path):
+        self.path = path
+        self._tmp = f'{path}.{os.getpid()}.tmp'
+        self._f = open(self._tmp, 'wb')
+        self._f.write(b'\0' * SNAP_HEADER.size)
+        self.sections = {}
+
+    def _start(self, name):
+        pos = self._f.tell()
+        if pos % ALIGN:
+            self._f.write(b'\0' * (ALIGN - pos % ALIGN))
+        return self._f.tell()
+
+    def add(self, name, data):
+        # data is bytes or a numpy array, arrays keep their type code
+        fmt = None
+        if isinstance(data, np.ndarray):
+            fmt = data.dtype.char
+            data = np.ascontiguousarray(data)
+        offset = self._start(name)
+        self._f.write(memoryview(data).cast('B'))
+        self.sections[name] = {'offset': offset, 'length': self._f.tell() - offset, 'format': fmt}
+
+    def addFile(self, name, path):
+        offset = self._start(name)
+        with open(path, 'rb') as f:
+            while True:
+                b = f.read(COPY_CHUNK)
+                if not b:
+                    break
+                self._f.write(b)
+        self.sections[name] = {'offset': offset, 'length': self._f.tell() - offset, 'format': None}
+
+    def close(self, manifest):
+        manifest = dict(manifest, sections=self.sections)
+        m = json.dumps(manifest).encode('utf-8')
+        offset = self._start('manifest')
+        self._f.write(m)
+        self._f.seek(0)
+        self._f.write(SNAP_HEADER.pack(SNAP_MAGIC, SNAP_VERSION, 0, offset, len(m)))
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        os.replace(self._tmp, self.path)
+        return self.path
+
+#==============================================================================
+def writeIndex(w, idxDir, info):
+    # hnswlib can only load from a path, its pickled state is stored instead
+    # with the arrays out of band so that they are mapped, not unpickled
+    path = os.path.join(idxDir, IDX_FILE)
+    if info.get('idxLib') == 'faiss':
+        import faiss
+        w.add('index', faiss.serialize_index(faiss.read_index(path)))
+        return []
+    import hnswlib
+    index = hnswlib.Index(space=info['type'], dim=int(info['dim']))
+    index.load_index(path)
+    buffers = []
+    w.add('index', pickle.dumps(index, protocol=5, buffer_callback=buffers.append))
+    names = []
+    for n, b in enumerate(buffers):
+        names.append(f'index_buffer_{n}')
+        w.add(names[-1], b.raw())
+    return names
+
+#==============================================================================
+def buildSnapshot(out, idxDir, recsFile, pfxFile):
+    with open(os.path.join(idxDir, IDX_INFO), 'r') as f: info = json.loads(f.read())
+    w = SnapshotWriter(out)
+
+    w.addFile('records', recsFile)
+    buf = mapFile(recsFile)
+    offsets = scanOffsets(buf)
+    w.add('record_offsets', np.frombuffer(offsets, dtype=np.uint64))
+    w.add('record_bad', np.frombuffer(scanBad(buf, offsets), dtype=np.uint64))
+
+    # rows that are [key, postings] are stored as arrays, anything else
+    # (the _keys_ row) goes into the manifest as it is
+    pfxs = loadPrefixes(pfxFile)
+    keys = []
+    lists = []
+    extra = {}
+    for row, pfx in enumerate(pfxs):
+        if isinstance(pfx, list) and len(pfx) == 2 and isinstance(pfx[1], np.ndarray):
+            keys.append(str(pfx[0]).encode('utf-8'))
+            lists.append(pfx[1])
+        else:
+            keys.append(b'')
+            lists.append(EMPTY)
+            extra[str(row)] = pfx
+    w.add('prefix_keys', b''.join(keys))
+    w.add('prefix_key_offsets', np.cumsum([0] + [len(k) for k in keys], dtype=np.uint64))
+    w.add('postings', np.concatenate(lists).astype(np.int32) if lists else EMPTY)
+    w.add('posting_offsets', np.cumsum([0] + [len(l) for l in lists], dtype=np.uint64))
+
+    arrays, end = PrefixDict(pfxs).dump()
+    for name, a in arrays.items():
+        w.add(f'dict_{name}', a)
+
+    buffers = writeIndex(w, idxDir, info)
+    mat = None
+    if info.get('neighbours'):
+        z = np.load(os.path.join(idxDir, info['neighbours']))
+        for name in ('offsets', 'labels', 'distances'):
+            w.add(f'nbr_{name}', z[name])
+        mat = float(z['mat'])
+
+    return w.close({'version': SNAP_VERSION, 'created': datetime.now().isoformat(), 'byteorder': sys.byteorder,
+                    'sources': {'index': os.path.abspath(idxDir), 'records': os.path.abspath(recsFile),
+                                'prefixes': os.path.abspath(pfxFile)},
+                    'index_info': info, 'index_buffers': buffers, 'neighbours_mat': mat,
+                    'records': len(offsets) - 1, 'prefix_rows': len(pfxs), 'extra_rows': extra,
+                    'dict_end': end})
+
+#==============================================================================
+class PrefixTable:
+    # the list loadPrefixes returns, over the snapshot arrays: row r is
+    # [key, postings] made when it is asked for, postings are not copied
+    def __init__(self, keys, postings, offsets, extra):
+        self._keys = keys
+        self._postings = postings
+        self._offsets = offsets
+        self._extra = extra
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self[i] for i in range(*r.indices(len(self)))]
+        if r < 0:
+            r += len(self)
+        if r < 0 or r >= len(self):
+            raise IndexError('prefix row out of range')
+        if r in self._extra:
+            return self._extra[r]
+        return [self._keys[r], self._postings[self._offsets[r]:self._offsets[r + 1]]]
+
+    def __iter__(self):
+        for r in range(len(self)):
+            yield self[r]
+
+#==============================================================================
+class Snapshot:
+    # read side of a bundle: the file is mapped once and every part is a
+    # view of it, opening costs the manifest parse plus the index load
+    def __init__(self, path):
+        self.path = path
+        self._buf = mapFile(path)
+        if len(self._buf) < SNAP_HEADER.size:
+            raise ValueError(f'{path}: not a snapshot')
+        magic, version, reserved, offset, length = SNAP_HEADER.unpack_from(self._buf, 0)
+        if magic != SNAP_MAGIC:
+            raise ValueError(f'{path}: not a snapshot')
+        if version != SNAP_VERSION:
+            raise ValueError(f'{path}: snapshot version {version}, expected {SNAP_VERSION}')
+        self.manifest = json.loads(self._buf[offset:offset + length])
+        if self.manifest['byteorder'] != sys.byteorder:
+            raise ValueError(f'{path}: snapshot written on a {self.manifest["byteorder"]} endian machine')
+        self._view = memoryview(self._buf)
+        self.info = self.manifest['index_info']
+
+    def section(self, name):
+        s = self.manifest['sections'][name]
+        v = self._view[s['offset']:s['offset'] + s['length']]
+        return v.cast(s['format']) if s['format'] else v
+
+    def ndarray(self, name):
+        s = self.manifest['sections'][name]
+        dtype = np.dtype(s['format'] or 'B')
+        return np.frombuffer(self._buf, dtype=dtype, count=s['length'] // dtype.itemsize, offset=s['offset'])
+
+    def records(self, fragBytes):
+        # snapshots written before bad rows were recorded check each blob
+        bad = self.ndarray('record_bad') if 'record_bad' in self.manifest['sections'] else None
+        return RecordStore(self.path, fragBytes, self.section('records'), self.section('record_offsets'), bad)
+
+    def prefixes(self):
+        extra = {int(r): v for r, v in self.manifest['extra_rows'].items()}
+        return PrefixTable(StrList(self.section('prefix_keys'), self.section('prefix_key_offsets')),
+                           self.ndarray('postings'), self.section('posting_offsets'), extra)
+
+    def prefixDict(self, pfxs):
+        names = ('folded', 'folded_offsets', 'rows', 'keys', 'keys_offsets', 'starts')
+        return PrefixDict.fromSnapshot(pfxs, {n: self.section(f'dict_{n}') for n in names}, self.manifest['dict_end'])
+
+    def index(self):
+        # the raw hnswlib or faiss index, both copy the mapped bytes in
+        if self.info.get('idxLib') == 'faiss':
+            import faiss
+            return faiss.deserialize_index(self.ndarray('index'))
+        buffers = [self.section(n) for n in self.manifest['index_buffers']]
+        index = pickle.loads(self.section('index'), buffers=buffers)
+        if 'threads' in self.info:
+            index.num_threads = int(self.info['threads'])
+        return index
+
+    def neighbours(self):
+        if self.manifest.get('neighbours_mat') is None:
+            return None
+        z = {n: self.ndarray(f'nbr_{n}') for n in ('offsets', 'labels', 'distances')}
+        z['mat'] = self.manifest['neighbours_mat']
+        return z
+
+#==============================================================================
+def main(args):
+    opts = parser.parse_args()
+    start = time.monotonic()
+    path = buildSnapshot(opts.outFile, opts.idxFile, opts.recsFile, opts.pfxFile)
+    print(f'SNAPSHOT: {path} {os.path.getsize(path)} BYTES IN {time.monotonic() - start:.2f}s')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
+
+
+'''
+snapshot.py -index data/idx -records data/sdn.json -prefixes data/sdn.json_idx.json -o data/sdn.snap
+'''
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  startup.py
+#
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+#==============================================================================
+def timed(name, fn, times=None):
+    # runs fn, prints and records how long it took under name
+    start = time.monotonic()
+    result = fn()
+    elapsed = time.monotonic() - start
+    print(f'{name.upper()} DONE IN {elapsed:.2f}s', flush=True)
+    if times is not None:
+        times[name] = elapsed
+    return result
+
+#==============================================================================
+def loadParallel(loaders, times=None):
+    # runs the {name: fn} loaders in threads, they spend most of their time
+    # reading files or in numpy, hnswlib/faiss and torch with the GIL
+    # released; returns {name: result}, a failure is raised once all are done
+    with ThreadPoolExecutor(max_workers=max(1, len(loaders)), thread_name_prefix='load') as ex:
+        futures = {name: ex.submit(timed, name, fn, times) for name, fn in loaders.items()}
+    return {name: f.result() for name, f in futures.items()}
+
+#==============================================================================
+class Startup:
+    # a server is live as soon as it answers and ready once the first
+    # generation is loaded and warmed; /ready is what a load balancer polls
+    def __init__(self):
+        self.started = time.monotonic()
+        self.times = {}
+        self.ready = False
+        self.readyAfter = None
+        self.error = None
+
+    def run(self, boot, onError=None):
+        # boot loads everything, in a thread while the server already answers
+        try:
+            boot()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = f'startup failed: {e}'
+            if onError is not None:
+                onError()
+            return
+        self.done()
+
+    def done(self):
+        self.readyAfter = time.monotonic() - self.started
+        self.ready = True
+        print(f'READY IN {self.readyAfter:.2f}s: ' + ', '.join(f'{k} {v:.2f}s' for k, v in self.times.items()), flush=True)
+
+    def stats(self):
+        return {'live': True, 'ready': self.ready, 'uptime': round(time.monotonic() - self.started, 3),
+                'ready_after': None if self.readyAfter is None else round(self.readyAfter, 3),
+                'load_seconds': {k: round(v, 3) for k, v in self.times.items()}, 'error': self.error}
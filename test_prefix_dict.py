@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_prefix_dict.py
+#
+import pytest
+from postings import KEYS, toPostings
+from prefix_dict import PrefixDict
+
+KEYS_ROW = [KEYS, ['name', 'type']]
+ROWS = ['name:a.b', 'name:axb', 'name:ab', 'name:a[1]', 'name:Abc', 'name:b*c', 'type:x', 'name:abc']
+
+def pfxs():
+    return [KEYS_ROW] + [[k, toPostings([i])] for i, k in enumerate(ROWS)]
+
+#==============================================================================
+@pytest.fixture(params=['built', 'snapshot'])
+def pdict(request):
+    # the dictionary as built and as mapped back from what dump() wrote
+    d = PrefixDict(pfxs())
+    if request.param == 'snapshot':
+        arrays, end = d.dump()
+        d = PrefixDict.fromSnapshot(pfxs(), arrays, end)
+    return d
+
+def keys(pdict, pattern, limit=-1):
+    return [k for k, _ in pdict.match(pattern, limit)]
+
+#==============================================================================
+def test_get(pdict):
+    assert pdict.get('name:Abc') == 5
+    assert pdict.get('name:abc') == 8
+    assert pdict.get('name:ABC') is None
+    assert pdict.get(KEYS) is None
+    assert pdict.getFolded('name:ABC') in (5, 8)
+    assert pdict.getFolded('name:a') is None
+
+def test_star(pdict):
+    assert keys(pdict, 'name:a*') == ['name:ab', 'name:a.b', 'name:axb', 'name:Abc', 'name:abc', 'name:a[1]']
+    assert keys(pdict, 'name:a*', 2) == ['name:ab', 'name:a.b']
+    assert keys(pdict, 'name:*c') == ['name:Abc', 'name:b*c', 'name:abc']
+    assert len(keys(pdict, '*')) == len(ROWS)
+    assert keys(pdict, 'nomatch*') == []
+
+def test_question_mark(pdict):
+    assert keys(pdict, 'name:a?b') == ['name:a.b', 'name:axb']
+    assert keys(pdict, 'name:?b') == ['name:ab']
+    assert keys(pdict, 'name:a?') == ['name:ab']
+
+def test_literal_characters(pdict):
+    # regex and LIKE specials other than '*' and '?' match themselves
+    assert keys(pdict, 'name:a.b') == ['name:a.b']
+    assert keys(pdict, 'name:a.*') == ['name:a.b']
+    assert keys(pdict, 'name:a[1]') == ['name:a[1]']
+    assert keys(pdict, 'name:a[*') == ['name:a[1]']
+    assert keys(pdict, 'name:a[?]') == ['name:a[1]']
+
+def test_case_folded(pdict):
+    assert keys(pdict, 'NAME:ABC') == ['name:Abc', 'name:abc']
+    assert sorted(pdict.matchAll('name:ab?')) == [5, 8]
+
+def test_universe(pdict):
+    assert pdict.universe('type').tolist() == [6]
+    assert pdict.universe('name').tolist() == [0, 1, 2, 3, 4, 5, 7]
+    assert pdict.universe('').tolist() == list(range(len(ROWS)))
+    assert pdict.universe('ty*').tolist() == [6]
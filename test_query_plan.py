@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_query_plan.py
+#
+from postings import toPostings
+from query_plan import planQuery, Negation
+
+POSTINGS = {'a': [1, 2, 3], 'b': [2, 3, 4], 'c': [3, 4, 5, 6], 'e': []}
+UNIVERSE = [1, 2, 3, 4, 5, 6]
+
+#==============================================================================
+class Leaves:
+    # leaf() of the planner over POSTINGS, counting what gets evaluated;
+    # '!t' is the negation of t, unknown terms add no constraint
+    def __init__(self):
+        self.evaluated = []
+
+    def _posting(self, term):
+        def evaluate():
+            self.evaluated.append(term)
+            return toPostings(POSTINGS[term])
+        return (len(POSTINGS[term]), evaluate)
+
+    def __call__(self, term):
+        if term.startswith('!'):
+            universe = (len(UNIVERSE), lambda: toPostings(UNIVERSE))
+            return Negation(self._posting(term[1:]), universe)
+        return self._posting(term) if term in POSTINGS else None
+
+def run(q, plan=None):
+    leaves = Leaves()
+    st = planQuery(q, leaves, plan)
+    return (None if st is None else st.tolist()), leaves.evaluated
+
+#==============================================================================
+def test_and_or():
+    assert run({'and': ['a', 'b']})[0] == [2, 3]
+    assert run({'or': ['a', 'b']})[0] == [1, 2, 3, 4]
+    assert run({'and': ['a', {'or': ['b', 'c']}]})[0] == [2, 3]
+
+def test_empty_and_adds_no_constraint():
+    assert run({'and': []}) == (None, [])
+    assert run({'and': ['zz']})[0] is None
+    assert run({'and': ['zz', 'a']})[0] == [1, 2, 3]
+
+def test_and_runs_smallest_first():
+    st, evaluated = run({'and': ['c', 'b', 'a']})
+    assert st == [3]
+    assert evaluated[0] in ('a', 'b') and evaluated[-1] == 'c'
+
+def test_and_stops_at_empty():
+    plan = {}
+    st, evaluated = run({'and': ['a', 'e', 'b']}, plan)
+    assert st == [] and evaluated == ['e']
+    assert set(plan['plan']['skipped']) == set(['a', 'b'])
+
+def test_and_with_negation():
+    assert run({'and': ['c', '!b']})[0] == [5, 6]
+    assert run({'and': ['!a']})[0] == [4, 5, 6]
+    assert run({'and': ['!a', '!c']})[0] == []
+
+def test_and_skips_negation_once_empty():
+    plan = {}
+    st, evaluated = run({'and': ['a', 'e', '!b']}, plan)
+    assert st == [] and evaluated == ['e']
+    assert '!b' in plan['plan']['skipped']
+    st, evaluated = run({'and': ['a', '!a', '!b']})
+    assert st == [] and 'b' not in evaluated
+
+def test_terms_evaluated_once():
+    st, evaluated = run({'or': ['a', {'and': ['a', 'b']}, {'and': ['b', 'a']}]})
+    assert st == [1, 2, 3]
+    assert sorted(evaluated) == ['a', 'b']
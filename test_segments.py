@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  test_segments.py
+#
+import os
+import json
+import time
+import zlib
+import numpy as np
+import pytest
+hnswlib = pytest.importorskip('hnswlib')
+from postings import KEYS, loadPrefixes
+from prefix_dict import PrefixDict
+from record_store import RecordStore
+from segments import SegmentStore, recordKeys, IDX_FILE, IDX_INFO
+
+DIM = 8
+RECORDS = [{'name': 'red apple', 'type': 'fruit'}, {'name': 'green pear', 'type': 'fruit'},
+           {'name': 'red brick', 'type': 'stone'}]
+
+#==============================================================================
+class Encoder:
+    # the model's encode(): a fixed random vector per text
+    def encode(self, texts, normalize_embeddings=True):
+        vecs = np.stack([np.random.default_rng(zlib.crc32(t.encode('utf-8'))).random(DIM) for t in texts])
+        return (vecs / np.linalg.norm(vecs, axis=1, keepdims=True)).astype(np.float32)
+
+class Index:
+    # the part of HnswIndexWrapper the segments use
+    def __init__(self, indexer, info):
+        self.indexer = indexer
+        self.info = info
+        self.distance = 10
+        self.neighbours = None
+        self.deleted = 0
+
+    def __len__(self):
+        return self.indexer.get_current_count()
+
+    def searchK(self, xq, k):
+        k = min(k, len(self) - self.deleted)
+        labels, distances = self.indexer.knn_query(xq, k)
+        return distances, labels
+
+#==============================================================================
+def writeFiles(d):
+    # records, prefixes and index the way the build scripts lay them out
+    keys = {}
+    fields = set()
+    for i, rec in enumerate(RECORDS):
+        recKeys, recFields = recordKeys(rec, i)
+        fields |= recFields
+        for k in recKeys:
+            keys.setdefault(k, []).append(i)
+    rows = [[KEYS, sorted(fields)]] + [[k, ids] for k, ids in sorted(keys.items())]
+    with open(os.path.join(d, 'records.jsonl'), 'w') as f:
+        f.write(''.join(json.dumps(r) + '\n' for r in RECORDS))
+    with open(os.path.join(d, 'prefixes.jsonl'), 'w') as f:
+        f.write(''.join(json.dumps(r) + '\n' for r in rows))
+    idxDir = os.path.join(d, 'index')
+    os.makedirs(idxDir)
+    index = hnswlib.Index(space='l2', dim=DIM)
+    index.init_index(max_elements=len(rows), ef_construction=100, M=8)
+    index.add_items(Encoder().encode([r[0] for r in rows]), np.arange(len(rows)))
+    index.save_index(os.path.join(idxDir, IDX_FILE))
+    with open(os.path.join(idxDir, IDX_INFO), 'w') as f:
+        f.write(json.dumps({'dim': DIM, 'threads': 1, 'idxLib': 'hnswlib', 'type': 'l2'}))
+    return {'index': idxDir, 'records': os.path.join(d, 'records.jsonl'),
+            'prefixes': os.path.join(d, 'prefixes.jsonl'), 'snapshot': None}
+
+def load(store, paths):
+    # what loadGeneration does with segments
+    manifest = store.manifest()
+    paths = store.paths(paths, manifest)
+    with open(os.path.join(paths['index'], IDX_INFO)) as f:
+        info = json.loads(f.read())
+    indexer = hnswlib.Index(space=info['type'], dim=info['dim'])
+    indexer.load_index(os.path.join(paths['index'], IDX_FILE))
+    pfxs = loadPrefixes(paths['prefixes'])
+    return store.attach(Index(indexer, info), RecordStore(paths['records']), pfxs, PrefixDict(pfxs),
+                        Encoder(), manifest)
+
+def postings(live, key):
+    row = live.pdict.get(key)
+    return None if row is None else live.prefixes[row][1].tolist()
+
+def nearest(live, key):
+    D, I = live.index.searchK(Encoder().encode([key]), 1)
+    return int(I[0][0]), float(D[0][0])
+
+@pytest.fixture
+def files(tmp_path):
+    return writeFiles(str(tmp_path)), str(tmp_path / 'segments')
+
+#==============================================================================
+def test_ingest_and_delete(files):
+    paths, segDir = files
+    store = SegmentStore(segDir)
+    live = load(store, paths)
+    r = store.ingest({'add': [{'name': 'blue plum', 'type': 'fruit', 'size': 3}]})
+    assert r['added'] == [3]
+    assert postings(live, 'name:plum') == [3]
+    assert postings(live, 'type:fruit') == [0, 1, 3]
+    assert postings(live, 'size:3') == [3]
+    assert 'size' in live.prefixes[0][1]
+    assert nearest(live, 'name:plum') == (live.pdict.get('name:plum'), pytest.approx(0, abs=1e-5))
+    store.ingest({'delete': [0]})
+    assert postings(live, 'name:apple') == []
+    assert postings(live, 'name:red') == [2]
+    assert live.pdict.get('name:apple') in live.index.dead
+    with pytest.raises(ValueError):
+        store.ingest({'delete': [0]})
+    with pytest.raises(ValueError):
+        store.ingest({'add': [1]})
+    assert live.version == 2
+
+def test_torn_log_replay(files):
+    paths, segDir = files
+    store = SegmentStore(segDir)
+    load(store, paths)
+    store.ingest({'add': [{'name': 'blue plum', 'type': 'fruit'}]})
+    store.ingest({'delete': [1]})
+    log = os.path.join(segDir, store.manifest()['logs'][-1])
+    good = os.path.getsize(log)
+    with open(log, 'ab') as f: # a crash in the middle of the next op
+        f.write(b'{"first": 4, "delete": [], "ad')
+    store._log.close()
+
+    store = SegmentStore(segDir)
+    live = load(store, paths)
+    assert os.path.getsize(log) == good
+    assert live.ops == 2 and len(live.records) == 4
+    assert postings(live, 'name:plum') == [3]
+    assert postings(live, 'name:pear') == []
+    # the log goes on where the good ops ended
+    store.ingest({'add': [{'name': 'white plum'}]})
+    store._log.close()
+    live = load(SegmentStore(segDir), paths)
+    assert live.ops == 3
+    assert postings(live, 'name:plum') == [3, 4]
+
+def test_compact_and_reload(files):
+    paths, segDir = files
+    loaded = []
+    store = SegmentStore(segDir, 0, lambda p: loaded.append(load(store, paths)) or True)
+    load(store, paths)
+    store.ingest({'add': [{'name': 'blue plum', 'type': 'fruit'}]})
+    store.ingest({'delete': [0]})
+    ok, _ = store.compact()
+    assert ok
+    for _ in range(100):
+        if not store.compacting:
+            break
+        time.sleep(0.1)
+    assert store.compactions == 1 and store.lastError is None
+
+    manifest = store.manifest()
+    assert manifest['seq'] == 1 and manifest['logs'] == ['ingest-1.log']
+    assert not os.path.exists(os.path.join(segDir, 'ingest-0.log'))
+    with open(manifest['base']['records']) as f:
+        assert [json.loads(l) for l in f] == [{}] + RECORDS[1:] + [{'name': 'blue plum', 'type': 'fruit'}]
+
+    live = loaded[-1]
+    assert store.live is live and live.pending() == 0 and live.ops == 0
+    for l in (live, load(SegmentStore(segDir), paths)):
+        assert len(l.records) == 4
+        assert postings(l, 'name:plum') == [3]
+        assert postings(l, 'name:apple') == []
+        assert postings(l, 'type:fruit') == [1, 3]
+        assert nearest(l, 'name:plum') == (l.pdict.get('name:plum'), pytest.approx(0, abs=1e-5))
+        assert l.pdict.get('name:apple') not in l.index.where
+        assert len(l.index.base) == l.prefixes.baseLen - 1 # no vector for apple
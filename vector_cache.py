@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  vector_cache.py
+#
+import os
+import mmap
+import struct
+import hashlib
+import numpy as np
+
+VEC_MAGIC = b'VECCACHE'
+VEC_VERSION = 1
+VEC_HEADER = struct.Struct('<8sII') # magic, version, dim
+KEY_BYTES = 20
+
+#==============================================================================
+def textKey(modelName, normalize, text):
+    return hashlib.sha1(f'{modelName}\0{int(bool(normalize))}\0{text}'.encode('utf-8')).digest()
+
+#==============================================================================
+class VectorCache:
+    # embeddings kept across index builds: fixed size (key, float32 vector)
+    # rows appended to one file and read through a mapping. the key is the
+    # sha1 of model name, normalization flag and text, so a text is encoded
+    # once per model whatever line it is on; a row cut short by a crash is
+    # dropped when the file is opened again
+    def __init__(self, path, modelName, normalize, dim):
+        self.path = path
+        self.modelName = modelName
+        self.normalize = normalize
+        self.dim = dim
+        self._dtype = np.dtype([('key', f'V{KEY_BYTES}'), ('vec', '<f4', (dim,))])
+        self._f = open(path, 'a+b')
+        size = self._f.seek(0, os.SEEK_END)
+        if size == 0:
+            self._f.write(VEC_HEADER.pack(VEC_MAGIC, VEC_VERSION, dim))
+            self._f.flush()
+        else:
+            self._f.seek(0)
+            magic, version, fileDim = VEC_HEADER.unpack(self._f.read(VEC_HEADER.size))
+            if magic != VEC_MAGIC or version != VEC_VERSION:
+                raise ValueError(f'{path}: not a vector cache')
+            if fileDim != dim:
+                raise ValueError(f'{path}: holds {fileDim} dimensional vectors, the model makes {dim}')
+            rows = (size - VEC_HEADER.size) // self._dtype.itemsize
+            if VEC_HEADER.size + rows * self._dtype.itemsize != size:
+                self._f.truncate(VEC_HEADER.size + rows * self._dtype.itemsize)
+        self._buf = None
+        self._data = np.empty(0, dtype=self._dtype)
+        self._map()
+        self._rows = {k: r for r, k in enumerate(self._data['key'].tolist())}
+        self._count = len(self._data) # rows in the file
+        self.hits = 0
+        self.misses = 0
+
+    def _map(self):
+        size = self._f.seek(0, os.SEEK_END)
+        rows = (size - VEC_HEADER.size) // self._dtype.itemsize
+        if rows:
+            self._buf = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._data = np.frombuffer(self._buf, dtype=self._dtype, count=rows, offset=VEC_HEADER.size)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def lookup(self, texts):
+        # (vectors, indexes of the texts not cached); the rows of missing
+        # texts are left for the caller to fill
+        X = np.empty((len(texts), self.dim), dtype=np.float32)
+        missing = []
+        for i, t in enumerate(texts):
+            r = self._rows.get(textKey(self.modelName, self.normalize, t))
+            if r is None:
+                missing.append(i)
+                continue
+            if r >= len(self._data):
+                self._map() # appended since the last mapping
+            X[i] = self._data['vec'][r]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        return X, missing
+
+    def add(self, texts, vecs):
+        rec = np.empty(len(texts), dtype=self._dtype)
+        n = 0
+        for t, v in zip(texts, vecs):
+            k = textKey(self.modelName, self.normalize, t)
+            if k in self._rows:
+                continue
+            rec[n]['key'] = np.void(k)
+            rec[n]['vec'] = v
+            self._rows[k] = self._count + n
+            n += 1
+        if n:
+            self._f.write(rec[:n].tobytes())
+            self._f.flush()
+            self._count += n
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'rows': len(self._rows), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+    def close(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()